@@ -0,0 +1,102 @@
+"""Prints the query plan and timing of the hot queries, before and after
+migrating.
+
+The database is copied to memory, the queries are run against the copy as
+it is, then the copy is migrated (see util/migrations.py) and the queries are
+run again. The file itself is never modified. Full scans show up as
+"SCAN outputs" in the plan, and index lookups as "SEARCH outputs USING ...".
+
+Typical usage:
+    python benchmark_queries.py
+    python benchmark_queries.py 10
+"""
+import sys
+import time
+from util.database_object import DatabaseObject
+from util.migrations import migrate, get_version
+
+# How many times to run each query. The fastest run is reported.
+repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+dbo = DatabaseObject(memory=True)
+cur = dbo.cur
+
+# Benchmark with a slice that exists.
+query = "SELECT model, distribution, split FROM outputs LIMIT 1"
+cur.execute(query)
+model, distribution, split = cur.fetchone()
+slice_parameters = (model, distribution, split)
+cur.execute("SELECT architecture, object_source FROM models LIMIT 1")
+architecture, object_source = cur.fetchone()
+
+# The query shapes of DatabaseObject, OutputCache, database_commands.py, and
+# the analysis scripts, by name.
+queries = {
+    "temp table build (get_temp_table)": (
+        "SELECT outputs.detections AS outputs_detections, "
+        "outputs.probabilities AS outputs_probabilities, "
+        "sentences.target as sentence_target, outputs.sentence AS "
+        "outputs_sentence, outputs.failure_mode AS outputs_failure_mode FROM "
+        "outputs JOIN sentences on sentences.id=outputs.sentence WHERE "
+        "outputs.model=? AND outputs.distribution=? AND outputs.split=?",
+        slice_parameters),
+    "slice load (OutputCache)": (
+        "SELECT outputs.id, outputs.sentence, sentences.target, "
+        "outputs.failure_mode, outputs.probabilities, outputs.detections, "
+        "targets.tlx, targets.tly, targets.brx, targets.bry FROM outputs "
+        "JOIN sentences ON sentences.id=outputs.sentence JOIN targets ON "
+        "targets.id=sentences.target WHERE outputs.model=? AND "
+        "outputs.distribution=? AND outputs.split=? ORDER BY "
+        "sentences.target, outputs.id", slice_parameters),
+    "random draw (calc_deferralfree_acc.py)": (
+        "SELECT outputs_id as id, outputs_failure_mode as failure_mode "
+        "FROM (SELECT outputs.id as outputs_id, outputs.failure_mode as "
+        "outputs_failure_mode, sentences.target as sentences_target FROM "
+        "outputs JOIN sentences ON outputs.sentence = sentences.id WHERE "
+        "model=? AND distribution=? AND split=? ORDER BY random()) GROUP BY "
+        "sentences_target", slice_parameters),
+    "one run (get_outputs_one_run)": (
+        "SELECT * FROM outputs WHERE model=? AND distribution=? and split=?",
+        slice_parameters),
+    "correct outputs (get_correct_outputs_one_run)": (
+        "SELECT * FROM outputs WHERE model=? AND distribution=? and split=? "
+        "and failure_mode=?",
+        (*slice_parameters, dbo.failure_to_idx_dict['correct'])),
+    "model group (get_model_ids)": (
+        "SELECT id FROM models WHERE architecture=? AND object_source=?",
+        (architecture, object_source)),
+}
+
+def run_benchmark():
+    """Prints the plan and fastest time of every query.
+
+    returns:
+        dict from query name to its fastest time, in seconds.
+    """
+    timings = {}
+    for name, (query, parameters) in queries.items():
+        cur.execute(f"EXPLAIN QUERY PLAN {query}", parameters)
+        plan = [row[3] for row in cur.fetchall()]
+
+        fastest = float("inf")
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            cur.execute(query, parameters)
+            cur.fetchall()
+            fastest = min(fastest, time.perf_counter()-start_time)
+        timings[name] = fastest
+
+        print(f"{name}: {fastest*1000:.2f} ms")
+        for step in plan:
+            print(f"    {step}")
+    return timings
+
+print(f"--- Before (schema version {get_version(dbo.con)}) ---")
+before = run_benchmark()
+migrate(dbo.con)
+print(f"--- After (schema version {get_version(dbo.con)}) ---")
+after = run_benchmark()
+
+print("--- Speedup ---")
+for name in queries:
+    print(f"{name}: {before[name]/max(after[name], 1e-9):.1f}x")
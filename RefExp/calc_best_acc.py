@@ -2,37 +2,73 @@
 
 Table 1, as of the time this comment was written
 
+The target and failure mode of every output of a (model, split,
+distribution) run are fetched in one query, and whether each target has a
+correct (or incorrect) output is found with a grouped reduction over the
+target ids. Models can be spread across processes with --workers, each with
+its own read-only connection to the database.
+
 Typical usage:
     python calc_acc_best_and_worst.py
+    python calc_acc_best_and_worst.py --workers 8
 """
-import sqlite3
+import argparse
+from multiprocessing import Pool
 import numpy as np
-from util.database_commands import adapt_array, convert_array,\
-        convert_reshape_array,\
-        get_failure_mode_dict, get_failure_mode_dict_reversed,\
-        get_distribution_dict, get_outputs_one_run,\
-        get_target_from_sentence
+from util.database_object import DatabaseObject
+from util.database_commands import get_failure_mode_dict,\
+        get_failure_mode_dict_reversed, get_distribution_dict,\
+        get_targets_and_failure_modes
+from util.calculation_utils import group_any
+
+parser = argparse.ArgumentParser(
+    description="Calculates the perfect deferral accuracy of all models.")
+parser.add_argument("--workers", type=int, default=1,
+                    help="how many processes to run models in")
+args = parser.parse_args()
 
 # How many trials to run for each scenario (model, obj source, dist)
 num_trials = 100
 
-# Connect to the database
-sqlite3.register_adapter(np.ndarray, adapt_array)
-sqlite3.register_converter("detections", convert_reshape_array)
-sqlite3.register_converter("probabilities", convert_array)
-con_tmp = sqlite3.connect("data/redatabase.sqlite3", detect_types=sqlite3.PARSE_COLNAMES)
+# The cursor of a pool worker. Set by init_worker.
+worker_cur = None
+
+def best_and_worst(model, split, distribution_id, correct_id, cur=None):
+    """Calculates the best and worst accuracy of one run.
+
+    args:
+        model: the model ID.
+        split: val, testA, or testB.
+        distribution_id: the distribution ID.
+        correct_id: the failure mode ID of correct outputs.
+        cur: the database cursor. Defaults to the pool worker's.
 
-# Copy to memory, for faster access.
-con = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_COLNAMES)
-con.row_factory = sqlite3.Row
-con_tmp.backup(con)
-con_tmp.close()
+    returns:
+        the fraction of targets with a correct output, and the fraction with
+        only correct outputs.
+    """
+    if cur is None:
+        cur = worker_cur
+    targets, failure_modes = get_targets_and_failure_modes(
+        model, split, distribution_id, cur)
+    correct = failure_modes == correct_id
+    correct_exists = group_any(correct, targets)
+    incorrect_exists = group_any(~correct, targets)
+    return correct_exists.mean(), 1-incorrect_exists.mean()
 
-# This line allows us to access the query results as a dict
-con.text_factory = lambda b: b.decode(errors='ignore')
+def init_worker():
+    """Connects a pool worker to the database, read-only."""
+    global worker_cur
+    worker_cur = DatabaseObject(memory=False, read_only=True,
+                                verbose=False).cur
 
-# And create the cursor.
-cur = con.cursor()
+# Connect to the database. Only dropout is analyzed, so only dropout outputs
+# are copied to memory. Workers read the file themselves.
+if args.workers > 1:
+    dbo = DatabaseObject(memory=False, read_only=True)
+else:
+    dbo = DatabaseObject(memory=True, distributions=["dropout"])
+cur = dbo.cur
 
 # Get the failure mode dict for lookup
 failure_dict_reversed = get_failure_mode_dict_reversed(cur)
@@ -65,6 +101,26 @@ for result in architectures_and_sources:
 
 # Now run the MAE/AMAE calculation.
 # for AMAE we assume that the failure mode has missed detections annotated.
+# Every run to calculate, in order.
+jobs = []
+for group in groups:
+    # and through every distribution
+    for distribution_id in distribution_ids:
+        # and split
+        for split in ["val", "testA", "testB"]:
+            if distribution_dict[distribution_id] != "dropout":
+                continue
+            for model in groups[group]:
+                jobs.append((model, split, distribution_id,
+                             failure_dict_forward['correct']))
+
+if args.workers > 1:
+    with Pool(args.workers, initializer=init_worker) as pool:
+        results = pool.starmap(best_and_worst, jobs)
+else:
+    results = [best_and_worst(*job, cur) for job in jobs]
+results = dict(zip(jobs, results))
+
 # Loop through every model type
 for group in groups:
     # and through every distribution
@@ -77,23 +133,10 @@ for group in groups:
             this_model_best = []
             this_model_worst = []
             for model in groups[group]:
-                run = get_outputs_one_run(model, split, distribution_id, cur)
-                correct_exists_dict = {}
-                incorrect_exists_dict = {}
-                for row in run:
-                    target = get_target_from_sentence(row['sentence'], cur)
-                    if target not in correct_exists_dict:
-                        correct_exists_dict[target] = False
-                        incorrect_exists_dict[target] = False
-                    if failure_dict_reversed[row['failure_mode']] == 'correct':
-                        correct_exists_dict[target] = True
-                    else:
-                        incorrect_exists_dict[target] = True
-                correct_exists_list = [int(correct_exists_dict[key]) for key in correct_exists_dict]
-                incorrect_exists_list = [int(incorrect_exists_dict[key]) for\
-                                         key in incorrect_exists_dict]
-                this_model_best.append(np.array(correct_exists_list).mean())
-                this_model_worst.append(1-np.array(incorrect_exists_list).mean())
+                best, worst = results[(model, split, distribution_id,
+                                       failure_dict_forward['correct'])]
+                this_model_best.append(best)
+                this_model_worst.append(worst)
             print(f"{group}-{distribution_dict[distribution_id]}-{split}"\
                   f"-best:{np.array(this_model_best).mean()}+-"\
                   f"{np.array(this_model_best).std()/np.sqrt(len(this_model_best))}")
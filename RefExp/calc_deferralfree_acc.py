@@ -2,36 +2,39 @@
 
 Table 1, as of the time this comment was written.
 
+The target and failure mode of every output of a (model, split,
+distribution) slice are loaded once, and each trial draws one output per
+target from those arrays. The trials of every model are drawn together, as
+one array of uniforms per model. --sql runs the original version instead,
+which draws every trial with an ORDER BY random() query.
+
 Typical usage:
     python calc_acc_pertarget_rand.py
+    python calc_acc_pertarget_rand.py --sql
 """
-import sqlite3
+import argparse
 import random
 import numpy as np
-from util.database_commands import adapt_array, convert_array,\
-        convert_reshape_array, get_failure_mode_dict,\
-        get_failure_mode_dict_reversed, get_distribution_dict
+from util.database_object import DatabaseObject
+from util.database_commands import get_failure_mode_dict,\
+        get_failure_mode_dict_reversed, get_distribution_dict,\
+        get_targets_and_failure_modes
+
+parser = argparse.ArgumentParser(
+    description="Calculates the deferral-free accuracy of all models.")
+parser.add_argument("--sql", action="store_true",
+                    help="draw every trial with a query, as originally done")
+parser.add_argument("--seed", type=int, default=0,
+                    help="seed of the trials (not used with --sql)")
+args = parser.parse_args()
 
 # How many trials to run for each scenario (model, obj source, dist)
 num_trials = 100
 
-# Connect to the database
-sqlite3.register_adapter(np.ndarray, adapt_array)
-sqlite3.register_converter("detections", convert_reshape_array)
-sqlite3.register_converter("probabilities", convert_array)
-con_tmp = sqlite3.connect("data/redatabase.sqlite3", detect_types=sqlite3.PARSE_COLNAMES)
-
-# Copy to memory, for faster access.
-con = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_COLNAMES)
-con.row_factory = sqlite3.Row
-con_tmp.backup(con)
-con_tmp.close()
-
-# This line allows us to access the query results as a dict
-con.text_factory = lambda b: b.decode(errors='ignore')
-
-# And create the cursor.
-cur = con.cursor()
+# Connect to the database. Rather than copying the whole database to memory,
+# reads are served from a read-only memory map of the file.
+dbo = DatabaseObject(memory=False, read_only=True)
+cur = dbo.cur
 
 # Get the failure mode dict for lookup
 failure_dict_reversed = get_failure_mode_dict_reversed(cur)
@@ -62,6 +65,52 @@ for result in architectures_and_sources:
     model_ids = cur.fetchall()
     groups[key] = [model_id[0] for model_id in model_ids]
 
+def load_slice(model, distribution_id, split):
+    """Loads the outputs of one slice, grouped by target.
+
+    args:
+        model: the model ID.
+        distribution_id: the distribution ID.
+        split: val, testA, or testB.
+
+    returns:
+        whether each output is correct, sorted by target, and the offsets of
+        each target's outputs.
+    """
+    targets, failure_modes = get_targets_and_failure_modes(
+        model, split, distribution_id, cur)
+    order = np.argsort(targets, kind="stable")
+    _, counts = np.unique(targets[order], return_counts=True)
+    offsets = np.zeros(counts.shape[0]+1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return failure_modes[order] == failure_dict_forward['correct'], offsets
+
+def run_trials(models, slices, rng):
+    """Runs every trial of one scenario.
+
+    args:
+        models: the model picked for every trial.
+        slices: dict from model to the output of load_slice.
+        rng: the numpy Generator to draw from.
+
+    returns:
+        the accuracy of every trial, or None if a picked model has no
+        outputs.
+    """
+    acc_results = np.zeros(len(models))
+    models = np.array(models)
+    for model in np.unique(models):
+        is_correct, offsets = slices[model]
+        if offsets.shape[0] < 2:
+            return None
+        trials = np.where(models == model)[0]
+        # One output per target, for every trial of this model.
+        counts = np.diff(offsets)
+        rows = offsets[:-1]+(rng.random((trials.shape[0], counts.shape[0]))*\
+                             counts).astype(np.int64)
+        acc_results[trials] = is_correct[rows].mean(axis=1)
+    return acc_results
+
 # Query to select a random element for every target
 query = "SELECT outputs_id as id, outputs_failure_mode as failure_mode "\
         "FROM (SELECT outputs.id as outputs_id, outputs.failure_mode as "\
@@ -70,6 +119,8 @@ query = "SELECT outputs_id as id, outputs_failure_mode as failure_mode "\
         "model=? AND distribution=? AND split=? ORDER BY random()) GROUP BY "\
         "sentences_target"
 
+rng = np.random.default_rng(args.seed)
+
 # We save the results to a csv
 with open("accuracies_random.csv", "w") as outfile:
     outfile.write("network,distribution,split,mean,stderr\n")
@@ -84,6 +135,21 @@ for split in ["val", "testA", "testB"]:
             mae_results = []
             acc_results = []
 
+            if not args.sql:
+                # Pick a model for every trial, then load each one once.
+                models = [int(rng.choice(groups[group]))
+                          for run in range(num_trials)]
+                slices = {model: load_slice(model, distribution_id, split)
+                          for model in set(models)}
+                acc_results = run_trials(models, slices, rng)
+                if acc_results is None:
+                    continue
+                with open("accuracies_random.csv", "a") as outfile:
+                    outfile.write(f"{group},{distribution_dict[distribution_id]},"\
+                                  f"{split},{acc_results.mean()},"\
+                                  f"{acc_results.std()/np.sqrt(len(acc_results))}\n")
+                continue
+
             # Run a bunch of trials
             for run in range(num_trials):
                 # Pick a model
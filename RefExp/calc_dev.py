@@ -2,69 +2,89 @@
 
 Tables 2 and 3 at the time of this writing.
 
+DEV and err@1 are estimated from --replicates bootstrap replicates (see
+util/bootstrap.py), with --ci percentile confidence intervals, which are
+written after the other columns. With --exact, they are calculated exactly
+instead (the intervals assuming normality), and only --check-replicates
+bootstrap replicates are drawn, to check them.
+
 Typical usage:
     python calc_dev.py armae_arrays/compiled.pickle
+    python calc_dev.py armae_arrays/compiled.store
+    python calc_dev.py armae_arrays/compiled.pickle --replicates 10000 \
+            --workers 8
+    python calc_dev.py armae_arrays/compiled.pickle --exact
 """
-import pickle
-import sys
-import numpy as np
+import argparse
+from util.results_store import open_results
+from util.bootstrap import group_by_method, run_for_methods, bootstrap_dev,\
+        exact_dev
 
-pickle_file = sys.argv[1]
+parser = argparse.ArgumentParser(
+    description="Generates a CSV of DEV metrics, and acc@1.")
+parser.add_argument("pickle_file",
+                    help="the compiled pickle, or a results store")
+parser.add_argument("--replicates", type=int, default=100,
+                    help="how many bootstrap replicates to draw")
+parser.add_argument("--workers", type=int, default=1,
+                    help="how many processes to run methods in")
+parser.add_argument("--ci", type=float, default=95,
+                    help="width of the confidence intervals, in percent")
+parser.add_argument("--seed", type=int, default=0,
+                    help="base seed of the bootstrap")
+parser.add_argument("--exact", action="store_true",
+                    help="calculate DEV and err@1 exactly, rather than "
+                    "estimating them by bootstrap")
+parser.add_argument("--check-replicates", type=int, default=100,
+                    help="with --exact, how many bootstrap replicates to "
+                    "draw to check the exact results (0 to skip the check)")
+args = parser.parse_args()
 
 # I just did this manually here to save queries to the database
 dist_dict = {1: 'softmax', 2: 'varratio', 3:'dropout', 4:'dropout_textonly',
              5:'varratio_textonly'}
 
-# Open the pickle
-with open(pickle_file, "rb") as infile:
-    data = pickle.load(infile)
+# Open the pickle, or the results store. Arrays in a store are only read
+# when their key is.
+data = open_results(args.pickle_file)
 
 # 3D integration.
 # Dict of dicts. First key is the method, second key is DDC.
-with_depth_dict = {}
-for key in data:
-    split_key = key.split("_")
-    if len(split_key) == 3:
-        split_key = ["_".join([split_key[0], split_key[1]]), split_key[2]]
-    method = split_key[0]
-    depth_constraint = int(split_key[1])
-
-    if method not in with_depth_dict.keys():
-        with_depth_dict[method] = {}
-
-    with_depth_dict[method][depth_constraint] = data[key]
-
-ares_and_keys = {}
+with_depth_dict = group_by_method(data)
 
-for method in with_depth_dict:
-    method_areas_under = []
-    method_accs_1 = []
-    for trial in range(100):
-        current_areas_under = []
-        current_accs_1 = []
-        for depth_constraint in with_depth_dict[method]:
-            if depth_constraint > 10 or depth_constraint <= 0:
-                continue
-            row = np.random.randint(with_depth_dict[method][depth_constraint]['errors'].shape[0])
-            current_areas_under.append(
-                with_depth_dict[method][depth_constraint]\
-                ['errors'][row, :].mean())
-            current_accs_1.append(
-                with_depth_dict[method][depth_constraint]\
-                ['errors'][row, -1].mean())
-        method_areas_under.append(np.array(current_areas_under).mean())
-        method_accs_1.append(np.array(current_accs_1).mean())
+if not args.exact:
+    ares_and_keys = run_for_methods(
+        bootstrap_dev, with_depth_dict, replicates=args.replicates, ci=args.ci,
+        workers=args.workers, seed=args.seed)
+else:
+    ares_and_keys = run_for_methods(
+        exact_dev, with_depth_dict, replicates=args.replicates, ci=args.ci)
 
-    ares_and_keys[method] = {}
-    ares_and_keys[method]['mean'] = (np.array(method_areas_under)*100).mean()
-    ares_and_keys[method]['stderr'] = (np.array(
-        method_areas_under)*100).std()/np.sqrt(len(method_areas_under))
-    ares_and_keys[method]['accs_1'] = (np.array(method_accs_1)*100).mean()
-    ares_and_keys[method]['stderr_accs_1'] = (
-        np.array(method_accs_1)*100).std()/np.sqrt(len(method_accs_1))
+if args.exact and args.check_replicates > 0:
+    # The means of a few bootstrap replicates should be within a few
+    # standard errors, for that many replicates, of the exact ones.
+    sampled = run_for_methods(
+        bootstrap_dev, with_depth_dict, replicates=args.check_replicates,
+        ci=args.ci, workers=args.workers, seed=args.seed)
+    check = run_for_methods(
+        exact_dev, with_depth_dict, replicates=args.check_replicates,
+        ci=args.ci)
+    for key in check:
+        for metric, stderr in (("mean", "stderr"),
+                               ("accs_1", "stderr_accs_1")):
+            difference = (sampled[key][metric]-check[key][metric])/\
+                    max(check[key][stderr], 1e-12)
+            if abs(difference) > 4:
+                print(f"WARNING: {key} {metric}: sampled "\
+                      f"{sampled[key][metric]} is {difference:.1f} "\
+                      f"standard errors from exact {check[key][metric]}")
+    print(f"Checked {len(check)} exact results against "\
+          f"{args.check_replicates} bootstrap replicates")
 
 with open("performance.csv", "w") as csv_file:
-    csv_file.write("split,net,source,dist,score,selection,DEV,stderr,err@1,stderr\n")
+    csv_file.write("split,net,source,dist,score,selection,DEV,stderr,err@1,"\
+                   "stderr,DEV_ci_low,DEV_ci_high,err@1_ci_low,"\
+                   "err@1_ci_high\n")
     for key in ares_and_keys:
         # A manual split of the keys back to semantic information
         split_key = key.split("-")
@@ -76,4 +96,6 @@ with open("performance.csv", "w") as csv_file:
         selection = split_key[5]
         csv_file.write(f'{split},{net},{source},{dist},{score},{selection},'\
                        f'{ares_and_keys[key]["mean"]},{ares_and_keys[key]["stderr"]},'
-                       f'{ares_and_keys[key]["accs_1"]},{ares_and_keys[key]["stderr_accs_1"]}\n')
+                       f'{ares_and_keys[key]["accs_1"]},{ares_and_keys[key]["stderr_accs_1"]},'
+                       f'{ares_and_keys[key]["ci"][0]},{ares_and_keys[key]["ci"][1]},'
+                       f'{ares_and_keys[key]["ci_accs_1"][0]},{ares_and_keys[key]["ci_accs_1"][1]}\n')
@@ -1,58 +1,120 @@
 """Combines pickles generated in parallel to a single pickle.
 
+Results stores (generate_performance_pickles.py --store) in the directory are
+combined too. With --store, the output is the results store compiled.store,
+and the keys of input stores are only added to its index; their arrays aren't
+copied.
+
+Inputs are merged one at a time, and each key is written to the output as
+soon as its coverages are filled. With --store, each input is released
+before the next is read, so memory use is bounded by the largest input. The
+time and array size of every key are printed, with the peak memory of the
+process so far.
+
 Typical usage example:
     python combine_pickles.py armae_arrays
+    python combine_pickles.py armae_arrays --store
 """
 
+import argparse
 import pickle
-import sys
 import os
-import numpy as np
+import resource
+import time
+from util.calculation_utils import fill_skipped_coverages
+from util.results_store import ResultsStore, is_results_store
+
+parser = argparse.ArgumentParser(
+    description="Combines pickles generated in parallel to a single pickle.")
+parser.add_argument("directory", help="the directory of pickles")
+parser.add_argument("--store", action="store_true",
+                    help="write the results store compiled.store instead of "
+                    "compiled.pickle")
+parser.add_argument("--compress", action="store_true",
+                    help="compress arrays copied into the results store")
+args = parser.parse_args()
+directory = args.directory
+
+def report(key, start_time, run=None):
+    """Prints the cost of combining one key.
 
-directory = sys.argv[1]
+    args:
+        key: the result key.
+        start_time: when work on the key started, from time.perf_counter.
+        run: the key's arrays, if they were read.
+    """
+    array_mb = 0 if run is None else sum(
+        array.nbytes for array in run.values())/1e6
+    # ru_maxrss is in kilobytes on Linux.
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1e3
+    print(f"{key}: {(time.perf_counter()-start_time)*1000:.1f} ms, "\
+          f"{array_mb:.1f} MB of arrays, peak memory {peak_mb:.0f} MB")
 
-files = os.listdir(directory)
+files = sorted(os.listdir(directory))
 
 # The dict that gets built then saved.
 compiled_dict = {}
+if args.store:
+    compiled_dict = ResultsStore(os.path.join(directory, "compiled.store"),
+                                 args.compress)
 # Loop through all the files in the directory
-
+combine_start = time.perf_counter()
 for filename in files:
     # Don't try to put compiled.pickle in itself.
     if "compiled" in filename:
         continue
 
+    # Input stores are linked into the output store, with coverages filled
+    # when they're read.
+    if is_results_store(os.path.join(directory, filename)):
+        in_store = ResultsStore(os.path.join(directory, filename))
+        for key in in_store:
+            start_time = time.perf_counter()
+            if args.store:
+                compiled_dict.link(key, in_store, fill_skipped=True)
+                report(key, start_time)
+            else:
+                compiled_dict[key] = fill_skipped_coverages(
+                    {name: array.copy() for name, array in
+                     in_store[key].items()})
+                report(key, start_time, compiled_dict[key])
+        continue
+
     # And ignore any other filetypes
     if filename.split(".")[-1].lower() != "pickle":
         continue
 
     # Open the input pickle
+    start_time = time.perf_counter()
     with open(os.path.join(directory, filename), "rb") as in_file:
         cur_dict = pickle.load(in_file)
+    print(f"Read {filename} in {(time.perf_counter()-start_time)*1000:.1f} ms")
 
     # Accidentally messed up one of the dict keys in generate_performance_pickles
     # Fortunately, completly fixable (but ugly)
-    new_dict = {}
-    for key in cur_dict.keys():
-        changed_key = key
+    for key in list(cur_dict.keys()):
+        start_time = time.perf_counter()
+        run = cur_dict.pop(key)
         if "{" in key:
             method = filename.split("-")[1]
-            changed_key = changed_key.replace("{replacement_method}", method)
-        new_dict[changed_key] = cur_dict[key]
-    cur_dict = new_dict
-    # Within the current pickle...
-    for key in cur_dict:
+            key = key.replace("{replacement_method}", method)
+        # for some of our methods, we don't update every coverage.
+        # e.g., because we need 3 queries to decide. So in cases where
+        # the value is zero, set it to the previous (higher coverage) val
+        fill_skipped_coverages(run)
         # ... update the compiled pickle
-        compiled_dict[key] = cur_dict[key]
-        if np.where(cur_dict[key]['rmaes'].sum(axis=0) == 0)[0].shape[0] > 0:
-            # for some of our methods, we don't update every coverage.
-            # e.g., because we need 3 queries to decide. So in cases where
-            # the value is zero, set it to the previous (higher coverage) val
-            for i in range(cur_dict[key]['rmaes'].shape[1]):
-                if cur_dict[key]['rmaes'][:,i].sum() == 0:
-                    cur_dict[key]['rmaes'][:,i] = cur_dict[key]['rmaes'][:, i-1]
-                    cur_dict[key]['errors'][:,i] = cur_dict[key]['errors'][:, i-1]
+        if args.store:
+            compiled_dict.write(key, run)
+        else:
+            compiled_dict[key] = run
+        report(key, start_time, run)
+    del cur_dict
 
 # save
-with open(os.path.join(directory, "compiled.pickle"), "wb") as out_file:
-    pickle.dump(compiled_dict, out_file)
+if args.store:
+    compiled_dict.flush()
+else:
+    with open(os.path.join(directory, "compiled.pickle"), "wb") as out_file:
+        pickle.dump(compiled_dict, out_file)
+print(f"Combined {len(compiled_dict)} keys in "\
+      f"{time.perf_counter()-combine_start:.1f}s")
@@ -46,9 +46,3 @@ CREATE TABLE "sentences" (
   "target" id,
 	FOREIGN KEY (target) references targets(id)
 );
-
-CREATE INDEX IF NOT EXISTS index_outputs_model ON outputs (model);
-CREATE INDEX IF NOT EXISTS index_outputs_sentence ON outputs (sentence);
-CREATE INDEX IF NOT EXISTS index_outputs_distribution ON outputs (distribution);
-CREATE INDEX IF NOT EXISTS index_outputs_failure_mode ON outputs (failure_mode);
-CREATE INDEX IF NOT EXISTS index_sentences_target ON sentences (target);
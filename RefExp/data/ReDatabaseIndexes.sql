@@ -0,0 +1,13 @@
+-- Indexes, and the schema version. Run after ReDatabase.sql, once the tables
+-- are loaded: building an index over loaded rows is much faster than updating
+-- it on every insert.
+CREATE INDEX IF NOT EXISTS index_outputs_model ON outputs (model);
+CREATE INDEX IF NOT EXISTS index_outputs_sentence ON outputs (sentence);
+CREATE INDEX IF NOT EXISTS index_outputs_distribution ON outputs (distribution);
+CREATE INDEX IF NOT EXISTS index_outputs_failure_mode ON outputs (failure_mode);
+CREATE INDEX IF NOT EXISTS index_sentences_target ON sentences (target);
+CREATE INDEX IF NOT EXISTS index_outputs_slice ON outputs (model, distribution, split, failure_mode, sentence);
+CREATE INDEX IF NOT EXISTS index_models_architecture ON models (architecture, object_source, instance);
+
+-- Matches the latest migration in util/migrations.py.
+PRAGMA user_version = 1;
@@ -0,0 +1,215 @@
+"""Exports the outputs, sentences, and targets tables to a columnar store.
+
+Every column is written to its own .npy file, which can be memory-mapped. The
+ragged blobs (probabilities and detections, plus the IoUs if precompute_ious.py
+has been run) are written as one flat buffer each, with an offsets array.
+Outputs are sorted by model, distribution, split, and target, so every
+(model, distribution, split) slice is a contiguous range of rows, and
+ColumnarObject can serve it as views into the mapped files.
+
+The store is written one slice at a time, so memory use doesn't grow with the
+size of the database. Rerunning replaces the store.
+
+Typical usage:
+    python export_columnar.py
+    python export_columnar.py data/columnar
+"""
+import json
+import os
+import sys
+import time
+import numpy as np
+from util.database_object import DatabaseObject
+from util.calculation_utils import rejection_score_methods
+
+out_dir = sys.argv[1] if len(sys.argv) > 1 else "data/columnar"
+
+# How many outputs to fetch from the database at once.
+batch_size = 50000
+
+def write_column(table, name, values):
+    """Writes an entire column to its .npy file.
+
+    args:
+        table: the table the column belongs to.
+        name: the name of the column.
+        values: the values of the column.
+    """
+    np.save(os.path.join(out_dir, table, f"{name}.npy"), values)
+
+def open_column(table, name, dtype, shape):
+    """Creates a column's .npy file, mapped so it can be filled in place.
+
+    args:
+        table: the table the column belongs to.
+        name: the name of the column.
+        dtype: the dtype of the column.
+        shape: the shape of the column.
+
+    returns:
+        a writable memmap of the column.
+    """
+    return np.lib.format.open_memmap(
+        os.path.join(out_dir, table, f"{name}.npy"), mode="w+", dtype=dtype,
+        shape=shape)
+
+def write_text_column(table, name, texts):
+    """Writes a text column as utf-8 bytes, with an offsets array.
+
+    args:
+        table: the table the column belongs to.
+        name: the name of the column.
+        texts: the strings in the column (None is stored as empty).
+    """
+    encoded = [("" if text is None else text).encode() for text in texts]
+    offsets = np.zeros(len(encoded)+1, dtype=np.int64)
+    np.cumsum([len(text) for text in encoded], out=offsets[1:])
+    write_column(table, f"{name}_offsets", offsets)
+    write_column(table, name, np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+start_time = time.time()
+dbo = DatabaseObject(memory=False)
+for table in ("outputs", "sentences", "targets"):
+    os.makedirs(os.path.join(out_dir, table), exist_ok=True)
+
+query = "SELECT name FROM sqlite_master WHERE type='table'"
+dbo.cur.execute(query)
+tables = [row[0] for row in dbo.cur.fetchall()]
+has_ious = "output_ious" in tables
+has_scores = "output_scores" in tables
+
+# Small tables go straight into the metadata.
+meta = {}
+dbo.cur.execute("SELECT * FROM models ORDER BY id")
+meta['models'] = [dict(row) for row in dbo.cur.fetchall()]
+meta['failure_modes'] = dbo.idx_to_failure_dict
+meta['distributions'] = dbo.idx_to_distribution_dict
+
+# Targets and sentences, sorted by ID.
+dbo.cur.execute("SELECT id, tlx, tly, brx, bry, image_loc FROM targets "
+                "ORDER BY id")
+rows = dbo.cur.fetchall()
+write_column("targets", "id", np.array([row[0] for row in rows],
+                                       dtype=np.int64))
+write_column("targets", "boxes", np.array(
+    [[row[1], row[2], row[3], row[4]] for row in rows],
+    dtype=np.float64).reshape(-1, 4))
+write_text_column("targets", "image_loc", [row[5] for row in rows])
+
+dbo.cur.execute("SELECT id, target, phrase FROM sentences ORDER BY id")
+rows = dbo.cur.fetchall()
+write_column("sentences", "id", np.array([row[0] for row in rows],
+                                         dtype=np.int64))
+write_column("sentences", "target", np.array([row[1] for row in rows],
+                                             dtype=np.int64))
+write_text_column("sentences", "phrase", [row[2] for row in rows])
+del rows
+
+# Size every output column up front, so they can be filled in place.
+dbo.cur.execute("SELECT COUNT(*), TOTAL(LENGTH(probabilities)), "
+                "TOTAL(LENGTH(detections)) FROM outputs")
+num_outputs, prob_bytes, det_bytes = dbo.cur.fetchone()
+columns = {
+    name: open_column("outputs", name, np.int64, (num_outputs,))
+    for name in ("id", "model", "sentence", "distribution", "failure_mode",
+                 "target")}
+prob_offsets = open_column("outputs", "probabilities_offsets", np.int64,
+                           (num_outputs+1,))
+probabilities = open_column("outputs", "probabilities", np.float32,
+                            (int(prob_bytes)//4,))
+det_offsets = open_column("outputs", "detections_offsets", np.int64,
+                          (num_outputs+1,))
+detections = open_column("outputs", "detections", np.float32,
+                          (int(det_bytes)//16, 4))
+prob_offsets[0] = 0
+det_offsets[0] = 0
+if has_ious:
+    ious = open_column("outputs", "ious", np.float32, (int(det_bytes)//16,))
+    argmax_correct = open_column("outputs", "argmax_correct", bool,
+                                 (num_outputs,))
+if has_scores:
+    scores = {method: open_column("outputs", method, np.float32,
+                                  (num_outputs,))
+              for method in rejection_score_methods}
+
+# Then write every slice, in order.
+dbo.cur.execute("SELECT DISTINCT model, distribution, split FROM outputs "
+                "ORDER BY model, distribution, split")
+slices = [tuple(row) for row in dbo.cur.fetchall()]
+meta['slices'] = {}
+row_idx = 0
+for model, distribution, split in slices:
+    slice_start = row_idx
+    query = "SELECT outputs.id, outputs.model, outputs.sentence, "\
+            "outputs.distribution, outputs.failure_mode, sentences.target, "\
+            "outputs.probabilities, outputs.detections"
+    if has_ious:
+        query += ", output_ious.ious, output_ious.argmax_correct"
+    if has_scores:
+        query += "".join([f", output_scores.{method}"
+                          for method in rejection_score_methods])
+    query += " FROM outputs JOIN sentences ON sentences.id=outputs.sentence "
+    if has_ious:
+        query += "LEFT JOIN output_ious ON output_ious.output=outputs.id "
+    if has_scores:
+        query += "LEFT JOIN output_scores ON output_scores.output=outputs.id "
+    query += "WHERE outputs.model=? AND outputs.distribution=? AND "\
+            "outputs.split=? ORDER BY sentences.target, outputs.id"
+    dbo.cur.execute(query, (model, distribution, split))
+    while True:
+        rows = dbo.cur.fetchmany(batch_size)
+        if len(rows) == 0:
+            break
+        stop = row_idx+len(rows)
+        for column, name in enumerate(("id", "model", "sentence",
+                                       "distribution", "failure_mode",
+                                       "target")):
+            columns[name][row_idx:stop] = [row[column] for row in rows]
+
+        # Append the blobs to the flat buffers.
+        for buffer, offsets, column, width in (
+                (probabilities, prob_offsets, 6, 1),
+                (detections, det_offsets, 7, 4)):
+            lengths = [len(row[column])//(4*width) for row in rows]
+            np.cumsum(lengths, out=offsets[row_idx+1:stop+1])
+            offsets[row_idx+1:stop+1] += offsets[row_idx]
+            values = np.frombuffer(b"".join([row[column] for row in rows]),
+                                   dtype=np.float32)
+            buffer[offsets[row_idx]:offsets[stop]] = values.reshape(
+                buffer[offsets[row_idx]:offsets[stop]].shape)
+        if has_ious:
+            # IoUs are laid out like the detections. Outputs without them
+            # are stored as NaN, and the reader computes them instead.
+            for i, row in enumerate(rows):
+                if row[8] is None:
+                    ious[det_offsets[row_idx+i]:det_offsets[row_idx+i+1]] =\
+                            np.nan
+                else:
+                    ious[det_offsets[row_idx+i]:det_offsets[row_idx+i+1]] =\
+                            np.frombuffer(row[8], dtype=np.float32)
+            argmax_correct[row_idx:stop] = [bool(row[9]) for row in rows]
+        if has_scores:
+            for column, method in enumerate(rejection_score_methods,
+                                            10 if has_ious else 8):
+                scores[method][row_idx:stop] = [
+                    np.nan if row[column] is None else row[column]
+                    for row in rows]
+        row_idx = stop
+    meta['slices'][f"{model}-{distribution}-{split}"] = [slice_start, row_idx]
+    print(f"{row_idx} of {num_outputs} outputs exported")
+
+meta['has_ious'] = has_ious
+meta['has_scores'] = has_scores
+for array in (*columns.values(), prob_offsets, probabilities, det_offsets,
+              detections):
+    array.flush()
+if has_ious:
+    ious.flush()
+    argmax_correct.flush()
+if has_scores:
+    for array in scores.values():
+        array.flush()
+
+with open(os.path.join(out_dir, "meta.json"), "w") as out_file:
+    json.dump(meta, out_file)
+print(f"Exported to {out_dir} in {time.time()-start_time:.1f}s")
@@ -5,40 +5,96 @@ split, then pulls models, distributions, object sources from database. Error
 and rmae at every coverage is calculated, then this is saved to a pickle with
 the arguments as its name.
 
+Trials can be spread across a process pool with --workers. Every trial draws
+from its own seed stream, derived from --seed, the split, group, distribution,
+and trial number, so results are identical for any number of workers.
+
+Every trial is written to a checkpoint as soon as it finishes. If the run is
+interrupted, running the same command again skips the trials that are done.
+The checkpoint is deleted once the pickle is written.
+
+With --store, the results are written to a results store (see
+util/results_store.py) instead of a pickle, which combine_pickles.py can
+combine without copying.
+
 Typical usage example:
     python generate_performance_pickles.py entropy ensemble_consensus_3 testA
+    python generate_performance_pickles.py entropy combined_3 testA --workers 32
 """
-import random
-import sys
-from collections import Counter
-from itertools import groupby
-import pickle
-import numpy as np
-from util.database_commands import \
-        convert_boxes_to_corners, get_random_draw,\
-        get_re_by_target
+import argparse
+from multiprocessing import Pool
 from util.database_object import DatabaseObject
-from util import calculation_utils
+from util.columnar_object import ColumnarObject
+from util import simulation
+from util import combined_kernel
+from util.checkpoint import CheckpointStore, atomic_pickle_dump
+from util.results_store import ResultsStore
+
 # Pull command line arguments
-scoring_method = sys.argv[1]
-replacement_method = sys.argv[2]
-split = sys.argv[3]
+parser = argparse.ArgumentParser(description="Calculates the error at all DRs.")
+parser.add_argument("scoring_method", help="entropy or sr")
+parser.add_argument("replacement_method", help="e.g. naive_3, combined_3")
+parser.add_argument("split", help="val, testA, or testB")
+parser.add_argument("--workers", type=int, default=1,
+                    help="how many processes to run trials in")
+parser.add_argument("--seed", type=int, default=0,
+                    help="base seed for every trial's random number stream")
+parser.add_argument("--batched", action="store_true",
+                    help="run naive and smart trials together, per model")
+parser.add_argument("--jit", action="store_true",
+                    help="run combined trials in the compiled kernel")
+parser.add_argument("--columnar", default=None,
+                    help="read from this columnar store (see "
+                    "export_columnar.py) instead of the database")
+parser.add_argument("--no-checkpoint", action="store_true",
+                    help="don't checkpoint finished trials")
+parser.add_argument("--store", action="store_true",
+                    help="write a results store instead of a pickle")
+parser.add_argument("--compress", action="store_true",
+                    help="compress the arrays of the results store")
+args = parser.parse_args()
+if args.jit and not combined_kernel.numba_available:
+    print("WARNING: numba is not installed, so --jit runs the combined "\
+          "kernel as plain Python, without any speedup")
+scoring_method = args.scoring_method
+replacement_method = args.replacement_method
+split = args.split
 
 # How many trials to run for each scenario (model, obj source, dist)
 num_trials = 100
 
-dbo = DatabaseObject(memory=True)
-
-# Now get all the kinds of models.
-query = "SELECT DISTINCT architecture, object_source FROM models"
-dbo.cur.execute(query)
-architectures_and_sources = dbo.cur.fetchall()
+if args.columnar is not None:
+    dbo = ColumnarObject(args.columnar)
+else:
+    # Only the split and distributions we simulate are loaded.
+    dbo = DatabaseObject(memory=True, distributions=["softmax", "dropout"],
+                         splits=[split])
 
 # Group models so we can randomly select results per-run
-groups = {}
-for result in architectures_and_sources:
-    key = f"{result['architecture']}-{result['object_source']}"
-    groups[key] = dbo.get_model_ids(result['architecture'], result['object_source'])
+groups = dbo.get_model_groups()
+distribution_ids = [distribution_id for distribution_id in
+                    dbo.idx_to_distribution_dict if
+                    dbo.idx_to_distribution_dict[distribution_id] in
+                    ["softmax", "dropout"]]
+
+# Load every slice up front, so pool workers can share them.
+caches = {}
+for group in groups:
+    for model in groups[group]:
+        for distribution_id in distribution_ids:
+            caches[(model, distribution_id, split)] = dbo.get_output_cache(
+                model, distribution_id, split)
+pool = None
+if args.workers > 1:
+    pool = Pool(args.workers, initializer=simulation.init_worker,
+                initargs=(caches,))
+
+out_path = f'armae_arrays/{scoring_method}-{replacement_method}-{split}.pickle'
+checkpoint = None
+if not args.no_checkpoint:
+    checkpoint = CheckpointStore(
+        f'armae_arrays/{scoring_method}-{replacement_method}-{split}'\
+        '.checkpoint', args.seed)
 
 saved_runs = {}
 
@@ -46,231 +102,38 @@ saved_runs = {}
 for group in groups:
     if len(groups[group]) == 0:
         continue
-    for distribution_id in dbo.idx_to_distribution_dict:
-        # This tracks errors across all runs and all coverages.
-        # Since we don't know its size yet, set to None here.
-        if dbo.idx_to_distribution_dict[distribution_id] not in ["softmax", "dropout"]:
-            continue
-        all_run_errors = None
+    for distribution_id in distribution_ids:
         print(split, group, distribution_id, scoring_method, replacement_method)
 
         # Let's get started on our trials.
-        for run in range(num_trials):
-            # select one output per target, from a random model.
-            draw = get_random_draw(
-                random.choice(groups[group]), distribution_id, split, dbo.cur)
-            # And if there is no response, just skip it.
-            if len(draw['target_ids']) == 0:
-                break
-
-            # If we haven't created the result arrays yet, do that.
-            if all_run_errors is None:
-                all_run_errors = np.zeros((num_trials, len(draw['target_ids'])+1))
-                all_run_rmaes = np.zeros((num_trials, len(draw['target_ids'])+1))
-
-            all_rq_counts = np.zeros((len(draw['target_ids'])+1), dtype=int)
-
-            # Loop through until DDC.
-            # We use a while loop here, since some methods require multiple
-            # queries per-update.
-            while all_rq_counts.sum() < len(draw['target_ids']):
-                # These operations are pretty clear from the method names.
-                all_run_errors[run, all_rq_counts.sum()] = calculation_utils.calc_error(draw)
-                all_run_rmaes[run, all_rq_counts.sum()] = calculation_utils.calc_rmae(draw)
-                to_requery, draw = calculation_utils.get_which_to_requery(
-                    draw, scoring_method)
-                replacement = get_re_by_target(
-                    draw['target_ids'][to_requery], dbo.cur)
-
-                # Update the belief based on the selection fn.
-
-                # In naive replacement, we always use the replacement seed.
-                if "naive" in replacement_method:
-                    max_depth = int(replacement_method.split("_")[-1])
-                    # We shift the RQ count by 1.
-                    all_rq_counts[to_requery] += 1
-                    # Naive replacement is simple: we can just update the
-                    # failure_mode column.
-                    draw['failure_modes'][to_requery] = replacement['outputs_failure_mode']
-                    # If we've reached max depth, we set the score to a very
-                    # low value, so it doesn't get re-queried.
-                    if all_rq_counts[to_requery] >= max_depth:
-                        draw['score'][to_requery] = -1e6
-                    else:
-                        draw['score'][to_requery] =\
-                                calculation_utils.calc_rejection_score(
-                                    replacement['probabilities'],
-                                    scoring_method)
-
-                elif "combined" in replacement_method:
-                    max_depth = int(replacement_method.split("_")[-1])
-                    # in combined replacement, we need to update everything.
-                    all_rq_counts[to_requery] += 1
-
-                    # Update the probabilities.
-                    draw['probabilities'][to_requery] = \
-                            draw['probabilities'][to_requery] *\
-                            replacement['probabilities']
-
-                    # Normalize
-                    draw['probabilities'][to_requery] = draw['probabilities']\
-                            [to_requery]/draw['probabilities'][to_requery].sum()
-
-                    # low value, so it doesn't get re-queried.
-                    if all_rq_counts[to_requery] >= max_depth:
-                        draw['score'][to_requery] = -1e6
-                    else:
-                        # Update the rejection score for the next query.
-                        draw['score'][to_requery] =\
-                                calculation_utils.calc_rejection_score(
-                                    draw['probabilities'][to_requery], scoring_method)
-
-                    # Figure out whether or not it's correct.
-                    # Start by getting the detected bboxes.
-                    converted_boxes = convert_boxes_to_corners(
-                        replacement['detections'])
-                    # Then calculate the IoUs with the ground truth.
-                    ious = calculation_utils.compute_all_IoUs(
-                        (replacement['tlx'], replacement['tly'],
-                         replacement['brx'], replacement['bry']),
-                        converted_boxes)
-
-                    # If correct, set as correct. If not, either leave as
-                    # missed detection, or set to undefined.
-                    if ious[draw['probabilities'][to_requery].argmax()] >= 0.5:
-                        draw['failure_modes'][to_requery] = dbo.failure_to_idx(
-                            'correct')
-                    elif draw['failure_modes'][to_requery] != dbo.failure_to_idx(
-                        'missed_detection'):
-                        draw['failure_modes'][to_requery] = dbo.failure_to_idx(
-                            'undefined')
-                elif "smart" in replacement_method:
-                    max_depth = int(replacement_method.split("_")[-1])
-                    # Smart replacement is pretty straightforward.
-                    # Updates one at a time.
-                    all_rq_counts[to_requery] += 1
-
-                    # Get the previous and new scores.
-                    score_previous = draw['score'][to_requery]
-                    score_new = calculation_utils.calc_rejection_score(
-                        replacement['probabilities'], scoring_method)
-
-                    # Set the failure mode based on which score is lower.
-                    draw['failure_modes'][to_requery] =\
-                            replacement['outputs_failure_mode'] if\
-                            score_new < score_previous else\
-                            draw['failure_modes'][to_requery]
-                    # And then update the score so that it doesn't get
-                    # re-re-queried.
-                    if all_rq_counts[to_requery] >= max_depth:
-                        draw['score'][to_requery] = -1e6
-                    else:
-                        draw['score'][to_requery] =\
-                                calculation_utils.calc_rejection_score(
-                                    replacement['probabilities'],
-                                    scoring_method)
-
-                elif "ensemble_mean" in replacement_method:
-                    # For ensemble mean, we use the name of the replacement
-                    # method to set the ensemble size parameter.
-                    # i.e., how many seeds we ensemble.
-                    ensemble_size = int(replacement_method.split("_")[-1])
-
-                    # We have to update the re-query count by more than one.
-                    # The original refexp counts as part of the ensemble.
-                    # So, i.e., for an ensemble of size 3, we would have the
-                    # original and two re-queries. meaning RQ count goes
-                    # up by 2.
-                    all_rq_counts[to_requery] += ensemble_size
-
-                    # Get every ensembled solution
-                    solutions = []
-                    for i in range(ensemble_size):
-                        solutions.append(get_re_by_target(
-                            draw['target_ids'][to_requery], dbo.cur))
-
-                    # Find the mean of all the queries.
-                    new_dist = draw['probabilities'][to_requery].copy()
-                    solution = None # Make sure solution has been defined.
-                    for solution in solutions:
-                        new_dist += solution['probabilities']
-                    new_dist = new_dist/(ensemble_size+1)
-
-                    # Figure out whether or not the detection occurred
-                    # First by finding the detected bboxes.
-                    converted_boxes = convert_boxes_to_corners(
-                        solution['detections'])
-
-                    # Then by calculating the IoUs.
-                    ious = calculation_utils.compute_all_IoUs(
-                        (solution['tlx'], solution['tly'], solution['brx'],
-                         solution['bry']), converted_boxes)
-
-                    # If the IoU is greater than 0.5, set to correct.
-                    if ious[new_dist.argmax()] >= 0.5:
-                        draw['failure_modes'][to_requery] =\
-                                dbo.failure_to_idx('correct')
-                    elif draw['failure_modes'][to_requery] !=\
-                            dbo.failure_to_idx('missed_detection'):
-                        # if it's not, either leave it as "missed detection", or
-                        # use unknown. This is relevant for RMAE.
-                        draw['failure_modes'][to_requery] = dbo.failure_to_idx(
-                            'undefined')
-                    # And set score to a very low value so it isn't requeried.
-                    draw['score'][to_requery] = -1e6
-                elif "ensemble_consensus" in replacement_method:
-                    # Consensus follows much the same method as mean, but,
-                    # obviously, we select via mode instead of argmax mean.
-
-                    # So ensemble size is from the method string, and requery
-                    # count updates appropriately.
-                    ensemble_size = int(replacement_method.split("_")[-1])
-                    all_rq_counts[to_requery] += ensemble_size
-
-                    # Pull n solutions
-                    solutions = []
-                    for i in range(ensemble_size):
-                        solutions.append(get_re_by_target(draw['target_ids'][to_requery], dbo.cur))
-                    # Choices are the indices of selected values.
-                    choices = [draw['probabilities'][to_requery].argmax()]
-                    solution = None # Make sure solution has been defined.
-                    for solution in solutions:
-                        choices.append(solution['probabilities'].argmax())
-
-                    # Find the IoUs of detected bounding boxes.
-                    converted_boxes = convert_boxes_to_corners(solution['detections'])
-                    ious = calculation_utils.compute_all_IoUs(
-                        (solution['tlx'], solution['tly'], solution['brx'],
-                         solution['bry']), converted_boxes)
-
-                    # Select the mode and figure out if it's correct.
-                    freqs = groupby(Counter(choices).most_common(), lambda x:x[1])
-                    mode_list = [val for val, count in next(freqs)[1]]
-                    if ious[random.choice(mode_list)] >= 0.5:
-                        draw['failure_modes'][to_requery] = dbo.failure_to_idx(
-                            'correct')
-                    elif draw['failure_modes'][to_requery] !=\
-                            dbo.failure_to_idx('missed_detection'):
-                        draw['failure_modes'][to_requery] = dbo.failure_to_idx(
-                            'undefined')
-                    draw['score'][to_requery] = -1e6
+        results = simulation.run_trials(
+            caches, groups[group], distribution_id, split, scoring_method,
+            replacement_method, dbo.failure_to_idx_dict, num_trials,
+            args.seed, group, pool, args.batched, args.jit, checkpoint)
+        if results is None:
+            continue
 
-            # Since the ensemble methods don't always divide evenly,
-            # add a check to make sure our coverage isn't less than zero.
-            if all_rq_counts.sum() < all_run_errors.shape[1]\
-               or "ensemble" not in replacement_method:
-                all_run_errors[run, all_rq_counts.sum()] =\
-                        calculation_utils.calc_error(draw)
-                all_run_rmaes[run, all_rq_counts.sum()] =\
-                        calculation_utils.calc_rmae(draw)
         # save this run into a big dict
-        if all_run_errors is not None:
-            saved_runs[f'{split}-{group}-{distribution_id}-{scoring_method}'\
-                       f'-{replacement_method}'] = {}
-            saved_runs[f'{split}-{group}-{distribution_id}-{scoring_method}'\
-                       f'-{replacement_method}']['errors'] = all_run_errors
-
-# And save that big dict into a pickle
-with open(f'armae_arrays/{scoring_method}-{replacement_method}-{split}.pickle',
-          'wb') as out_pickle:
-    pickle.dump(saved_runs, out_pickle)
+        saved_runs[f'{split}-{group}-{distribution_id}-{scoring_method}'\
+                   f'-{replacement_method}'] = {}
+        saved_runs[f'{split}-{group}-{distribution_id}-{scoring_method}'\
+                   f'-{replacement_method}']['errors'] = results[0]
+        saved_runs[f'{split}-{group}-{distribution_id}-{scoring_method}'\
+                   f'-{replacement_method}']['rmaes'] = results[1]
+
+if pool is not None:
+    pool.close()
+
+# And save that big dict into a pickle. With a checkpoint, every trial is
+# already in it, so the pickle is compacted from there.
+if checkpoint is not None:
+    saved_runs = checkpoint.compact(num_trials)
+if args.store:
+    store = ResultsStore(f'{out_path[:-len(".pickle")]}.store', args.compress)
+    for key in saved_runs:
+        store.write(key, saved_runs[key])
+    store.flush()
+else:
+    atomic_pickle_dump(saved_runs, out_path)
+if checkpoint is not None:
+    checkpoint.remove()
@@ -0,0 +1,19 @@
+"""Brings data/redatabase.sqlite3 up to the latest schema version.
+
+Applies every migration in util/migrations.py that the database hasn't had
+yet, then runs ANALYZE. Running it again on an up-to-date database does
+nothing.
+
+Typical usage:
+    python migrate_database.py
+"""
+from util.database_object import DatabaseObject
+from util.migrations import migrate, get_version, migrations
+
+# Migrate the file itself, not an in-memory copy.
+dbo = DatabaseObject(memory=False)
+start_version = migrate(dbo.con)
+if start_version == len(migrations):
+    print(f"Already at version {start_version}")
+else:
+    print(f"Now at version {get_version(dbo.con)}")
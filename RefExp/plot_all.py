@@ -4,12 +4,13 @@ Tables 2 and 5 at the time of this writing.
 
 Typical usage:
     python build_big_csv.py armae_arrays/compiled.pickle
+    python build_big_csv.py armae_arrays/compiled.store
 """
-import pickle
 import sys
 import numpy as np
 import pdb
 import matplotlib.pyplot as plt
+from util.marginal_cache import load_marginals
 
 #plt.rc('axes',titlesize=24)
 #plt.rc('axes',labelsize=22)
@@ -25,19 +26,16 @@ method_to_color = {'naive':'#FE6100', 'smart':'#DC267F','ensemble_consensus':'#F
 dist_dict = {1: 'softmax', 2: 'varratio', 3:'dropout', 4:'dropout_textonly',
              5:'varratio_textonly'}
 
-# Open the pickle
-with open(pickle_file, "rb") as infile:
-    data = pickle.load(infile)
+# The marginal of every key, computed once per results file and cached (see
+# util/marginal_cache.py).
+key_marginals = load_marginals(pickle_file)['keys']
 
 for split in ["val","testA","testB"]:
     for depth in [1,2,3,4,5,6,7,8,9,10]:
         for method in ['naive','smart','ensemble_consensus','ensemble_mean','combined']:
             cur_key = f"{split}-UNITER-gt-3-entropy-{method}_{depth}"
-            cur_data = data[cur_key]['errors']
-            cur_marginal = cur_data.mean(axis=0)
-            cur_marginal_stderr = cur_data.std(axis=0)/np.sqrt(cur_data.shape[0])
-            cur_marginal = cur_marginal*100
-            cur_marginal_stderr = cur_marginal_stderr * 100
+            cur_marginal = key_marginals[cur_key]['mean']
+            cur_marginal_stderr = key_marginals[cur_key]['stderr']
 
             x = np.arange(cur_marginal.shape[0])/cur_marginal.shape[0]
             plt.plot(x, cur_marginal, label=method_to_label[method], color=method_to_color[method])
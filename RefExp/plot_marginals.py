@@ -4,73 +4,42 @@ Tables 2 and 5 at the time of this writing.
 
 Typical usage:
     python build_big_csv.py armae_arrays/compiled.pickle
+    python build_big_csv.py armae_arrays/compiled.store
+    python build_big_csv.py armae_arrays/compiled.pickle --replicates 10000
 """
-import pickle
-import sys
+import argparse
 import numpy as np
 import pdb
 import matplotlib.pyplot as plt
+from util.marginal_cache import load_marginals
 
 plt.rc('axes',titlesize=24)
 plt.rc('axes',labelsize=22)
 plt.rc('xtick',labelsize=18)
 plt.rc('ytick',labelsize=18)
 plt.rc('legend',fontsize=18)
-pickle_file = sys.argv[1]
+parser = argparse.ArgumentParser(
+    description="Plots the DDC and deferral rate marginals.")
+parser.add_argument("pickle_file",
+                    help="the compiled pickle, or a results store")
+parser.add_argument("--replicates", type=int, default=100,
+                    help="how many bootstrap replicates to draw")
+parser.add_argument("--workers", type=int, default=1,
+                    help="how many processes to run methods in")
+parser.add_argument("--seed", type=int, default=0,
+                    help="base seed of the bootstrap")
+args = parser.parse_args()
 
 # I just did this manually here to save queries to the database
 dist_dict = {1: 'softmax', 2: 'varratio', 3:'dropout', 4:'dropout_textonly',
              5:'varratio_textonly'}
 
-# Open the pickle
-with open(pickle_file, "rb") as infile:
-    data = pickle.load(infile)
-
-# 3D integration.
-# Dict of dicts. First key is the actual method, second key is RQ depth.
-with_depth_dict = {}
-for key in data:
-    split_key = key.split("_")
-    if len(split_key) == 3:
-        split_key = ["_".join([split_key[0], split_key[1]]), split_key[2]]
-    method = split_key[0]
-    depth_constraint = int(split_key[1])
-
-    if method not in with_depth_dict.keys():
-        with_depth_dict[method] = {}
-
-    with_depth_dict[method][depth_constraint] = data[key]
-
-depth_marginals = {}
-for method in with_depth_dict:
-    method_areas_under = []
-    for trial in range(100):
-        current_areas_under = []
-        for depth_constraint in range(1, 11):
-            row = np.random.randint(with_depth_dict[method][depth_constraint]['errors'].shape[0])
-            current_areas_under.append(with_depth_dict[method][depth_constraint]['errors'][row, :].mean())
-
-        method_areas_under.append(np.array(current_areas_under))
-
-    depth_marginals[method] = {}
-    depth_marginals[method]['mean'] = (np.array(method_areas_under)*100).mean(axis=0)
-    depth_marginals[method]['stderr'] = (np.array(method_areas_under)*100).std(axis=0)/np.sqrt(len(method_areas_under))
-
-# rqr_marginals
-rqr_marginals = {}
-for method in with_depth_dict:
-    method_areas_under = []
-    for trial in range(100):
-        current_areas_under = []
-        for depth_constraint in range(1, 11):
-            row = np.random.randint(with_depth_dict[method][depth_constraint]['errors'].shape[0])
-            current_areas_under.append(with_depth_dict[method][depth_constraint]['errors'][row, :])
-
-        method_areas_under.append(np.array(current_areas_under).mean(axis=0))
-
-    rqr_marginals[method] = {}
-    rqr_marginals[method]['mean'] = (np.array(method_areas_under)*100).mean(axis=0)
-    rqr_marginals[method]['stderr'] = (np.array(method_areas_under)*100).std(axis=0)/np.sqrt(len(method_areas_under))
+# Every marginal, computed once per results file and cached (see
+# util/marginal_cache.py).
+marginals = load_marginals(args.pickle_file, args.replicates, args.workers,
+                           args.seed)
+depth_marginals = marginals['depth']
+rqr_marginals = marginals['dr']
 
 x = [*range(1, 11)]
 split = "testB"
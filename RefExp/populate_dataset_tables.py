@@ -5,6 +5,12 @@ This should be with no data/redatabase.sqlite3 file, then this file should
 be moved into the folder for the appropriate REC algorithm. The schema is
 available in the README.md file.
 
+The MSCOCO annotation files are streamed, so only the annotation id -> bbox
+map is held in memory rather than the whole parsed json. Rows are inserted
+in large batches in a single transaction, with journaling and syncing off
+(the database is rebuilt from scratch if loading fails), and the indexes in
+data/ReDatabaseIndexes.sql are built once everything is loaded.
+
 No command line arguments.
 
 typical usage:
@@ -13,69 +19,198 @@ typical usage:
 
 import sqlite3
 import pickle
-import os
 import json
-from util import database_commands
 import sys
+import time
+from util import database_commands
 
 # Change as necessary.
 mscoco_train_location = "/path/to/mscoco/annotations/instances_train2014.json"
 mscoco_val_location = "/path/to/mscoco/annotations/instances_val2014.json"
 
-# Load in the MSCOCO json
-with open(mscoco_train_location, "r") as in_file:
-    mscoco_train_json = json.load(in_file)
+# How many rows to insert per executemany.
+batch_size = 10000
 
-with open(mscoco_val_location, "r") as in_file:
-    mscoco_val_json = json.load(in_file)
+# How many characters to read from the json at once.
+read_size = 1 << 20
 
-# Create a dict where every annotation id keys to the corresponding bbox.
-mscoco_dict = {}
-for row in mscoco_train_json['annotations']:
-    if row['id'] in mscoco_dict.keys():
-        print("I guess ids are redundant...")
-        sys.exit()
-    mscoco_dict[row['id']] = row['bbox']
+class JSONStream:
+    """Decodes json values one at a time from a file, without reading all of
+    it at once."""
+    def __init__(self, in_file):
+        self.in_file = in_file
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def read_more(self):
+        """Reads the next block of the file into the buffer.
+
+        returns:
+            False if the file is exhausted.
+        """
+        if self.eof:
+            return False
+        block = self.in_file.read(read_size)
+        if not block:
+            self.eof = True
+            return False
+        # Drop what has already been decoded.
+        self.buffer = self.buffer[self.position:]+block
+        self.position = 0
+        return True
+
+    def peek(self):
+        """Skips whitespace, and returns the next character ("" at the end)."""
+        while True:
+            while self.position < len(self.buffer) and\
+                    self.buffer[self.position].isspace():
+                self.position += 1
+            if self.position < len(self.buffer) or not self.read_more():
+                return self.buffer[self.position:self.position+1]
+
+    def expect(self, chars):
+        """Consumes the next character, which must be one of chars.
+
+        returns:
+            the character.
+        """
+        char = self.peek()
+        if char == "" or char not in chars:
+            raise ValueError(f"Expected one of {chars!r} at character "\
+                             f"{self.position}, found {char!r}")
+        self.position += 1
+        return char
+
+    def decode(self):
+        """Decodes the next whole value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer,
+                                                     self.position)
+            except json.JSONDecodeError:
+                if not self.read_more():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the file.
+            if end == len(self.buffer) and self.read_more():
+                continue
+            self.position = end
+            return value
+
+    def array_elements(self):
+        """Yields the elements of the next value, which must be an array."""
+        self.expect("[")
+        if self.peek() == "]":
+            self.position += 1
+            return
+        while True:
+            yield self.decode()
+            if self.expect(",]") == "]":
+                return
 
-for row in mscoco_val_json['annotations']:
-    if row['id'] in mscoco_dict.keys():
-        print("I guess ids are redundant...")
-        sys.exit()
-    mscoco_dict[row['id']] = row['bbox']
+def stream_annotation_bboxes(path):
+    """Yields the id and bbox of every annotation in an MSCOCO json.
 
-# Create the database file
-command = "sqlite3 data/redatabase.sqlite3 < data/ReDatabase.sql"
+    args:
+        path: the location of the json.
 
-# I've read some warnings that I should use subprocess instead of os,
-# but that call seems to struggle with the syntax of this command.
-os.system(command)
+    returns:
+        a generator of (annotation id, bbox) tuples.
+    """
+    with open(path, "r") as in_file:
+        stream = JSONStream(in_file)
+        stream.expect("{")
+        if stream.peek() == "}":
+            return
+        while True:
+            key = stream.decode()
+            stream.expect(":")
+            if stream.peek() == "[":
+                # Arrays (images and annotations are huge) are walked one
+                # element at a time, and only annotations are kept.
+                for element in stream.array_elements():
+                    if key == "annotations":
+                        yield element['id'], element['bbox']
+            else:
+                stream.decode()
+            if stream.expect(",}") == "}":
+                return
+
+def batches(rows):
+    """Splits an iterable of rows into lists of batch_size rows."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+start_time = time.time()
+
+# Create a dict where every annotation id keys to the corresponding bbox.
+mscoco_dict = {}
+for location in [mscoco_train_location, mscoco_val_location]:
+    for annotation_id, bbox in stream_annotation_bboxes(location):
+        if annotation_id in mscoco_dict:
+            print("I guess ids are redundant...")
+            sys.exit()
+        mscoco_dict[annotation_id] = bbox
+print(f"Read {len(mscoco_dict)} MSCOCO annotations in "\
+      f"{time.time()-start_time:.1f}s")
 
 with open("data/refs(unc).p", "rb") as in_data:
     data = pickle.load(in_data)
 
-# add the distributions
-con = sqlite3.connect("data/redatabase.sqlite3")
+# Create the database file. Indexes are left until the rows are loaded.
+con = sqlite3.connect("data/redatabase.sqlite3", isolation_level=None)
 cur = con.cursor()
-cur.execute("INSERT INTO distributions(name) VALUES (?)", ("softmax",))
-cur.execute("INSERT INTO distributions(name) VALUES (?)", ("varratio",))
-cur.execute("INSERT INTO distributions(name) VALUES (?)", ("dropout",))
-cur.execute("INSERT INTO distributions(name) VALUES (?)", ("dropout_textonly",))
-cur.execute("INSERT INTO distributions(name) VALUES (?)", ("varratio_textonly",))
-con.commit()
+with open("data/ReDatabase.sql", "r") as in_file:
+    cur.executescript(in_file.read())
+
+# Nothing is lost if this fails partway, since the database would just be
+# regenerated, so skip the journal and syncing.
+cur.execute("PRAGMA journal_mode = OFF")
+cur.execute("PRAGMA synchronous = OFF")
+cur.execute("PRAGMA temp_store = MEMORY")
+cur.execute("PRAGMA cache_size = -1000000")
+cur.execute("PRAGMA locking_mode = EXCLUSIVE")
+
+cur.execute("BEGIN")
+# add the distributions
+cur.executemany("INSERT INTO distributions(name) VALUES (?)",
+                [("softmax",), ("varratio",), ("dropout",),
+                 ("dropout_textonly",), ("varratio_textonly",)])
 
 # add the failure modes
-cur.execute("INSERT INTO failure_modes(name) VALUES (?)", ("undefined",))
-cur.execute("INSERT INTO failure_modes(name) VALUES (?)", ("missed_detection",))
-cur.execute("INSERT INTO failure_modes(name) VALUES (?)", ("ambiguous",))
-cur.execute("INSERT INTO failure_modes(name) VALUES (?)", ("misunderstood",))
-cur.execute("INSERT INTO failure_modes(name) VALUES (?)", ("correct",))
-con.commit()
-
-# Add the rows.
-i = 0
-for row in data:
-    #print(i, len(data))
-    i+=1
-    database_commands.add_rows_from_dataset_entry(row, mscoco_dict, cur)
-con.commit()
+cur.executemany("INSERT INTO failure_modes(name) VALUES (?)",
+                [("undefined",), ("missed_detection",), ("ambiguous",),
+                 ("misunderstood",), ("correct",)])
+
+# Add the rows. Train entries aren't evaluated.
+entries = [row for row in data if row["split"] != "train"]
+for batch in batches(database_commands.get_target_row(row, mscoco_dict)
+                     for row in entries):
+    cur.executemany("INSERT INTO targets(id, tlx, tly, brx, bry, image_loc) "\
+                    "VALUES (?, ?, ?, ?, ?, ?)", batch)
+for batch in batches(sentence for row in entries for sentence in
+                     database_commands.get_sentence_rows(row)):
+    cur.executemany("INSERT INTO sentences(id, phrase, phrase_formatted, "\
+                    "target) VALUES (?, ?, ?, ?)", batch)
+cur.execute("COMMIT")
+print(f"Inserted {len(entries)} targets in {time.time()-start_time:.1f}s")
+
+# Build the indexes over the loaded rows, and stamp the schema version.
+with open("data/ReDatabaseIndexes.sql", "r") as in_file:
+    cur.executescript(in_file.read())
+cur.execute("ANALYZE")
+
+# Back to safe settings for whoever opens the database next.
+cur.execute("PRAGMA journal_mode = DELETE")
+cur.execute("PRAGMA synchronous = FULL")
 con.close()
+print(f"Built data/redatabase.sqlite3 in {time.time()-start_time:.1f}s")
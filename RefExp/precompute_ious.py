@@ -0,0 +1,84 @@
+"""Materializes the IoU of every detection against its target.
+
+For every row of outputs, stores the float32 IoU of each detection against the
+target box, and whether the argmax of the output's probabilities is correct at
+an IoU threshold (0.5 unless given). The simulation reads the IoUs instead
+of recomputing geometry on every re-query. argmax_correct, and so the
+threshold, are informational only: the simulation scores fused
+distributions against the IoUs at 0.5, the threshold the failure modes were
+labelled at. Rerunning replaces the table.
+
+Typical usage:
+    python precompute_ious.py
+    python precompute_ious.py 0.5
+"""
+import sys
+import numpy as np
+from util.database_object import DatabaseObject
+from util.database_commands import convert_ragged_arrays
+from util.calculation_utils import compute_output_IoUs, segment_argmax
+
+# IoU at which the argmax counts as correct.
+threshold = float(sys.argv[1]) if len(sys.argv) > 1 else 0.5
+
+# How many outputs to process per batch.
+batch_size = 50000
+
+# Write straight to the database file.
+dbo = DatabaseObject(memory=False)
+write_cur = dbo.con.cursor()
+
+write_cur.execute("DROP TABLE IF EXISTS output_ious")
+query = "CREATE TABLE output_ious (output INTEGER PRIMARY KEY, ious blob, "\
+        "argmax_correct int, threshold real, "\
+        "FOREIGN KEY (output) REFERENCES outputs(id))"
+write_cur.execute(query)
+
+# Every output, with the box of its target.
+query = "SELECT outputs.id AS output_id, outputs.probabilities AS "\
+        "probabilities, outputs.detections AS detections, targets.tlx AS tlx, "\
+        "targets.tly AS tly, targets.brx AS brx, targets.bry AS bry FROM "\
+        "outputs JOIN sentences ON sentences.id=outputs.sentence JOIN "\
+        "targets ON targets.id=sentences.target"
+dbo.cur.execute(query)
+
+num_outputs = 0
+num_correct = 0
+while True:
+    rows = dbo.cur.fetchmany(batch_size)
+    if len(rows) == 0:
+        break
+
+    # Decode the whole batch, then compute every IoU in one go.
+    prob_offsets, prob_buffer = convert_ragged_arrays(
+        [row['probabilities'] for row in rows])
+    det_offsets, det_buffer = convert_ragged_arrays(
+        [row['detections'] for row in rows], 4)
+    target_boxes = np.array(
+        [[row['tlx'], row['tly'], row['brx'], row['bry']] for row in rows],
+        dtype=np.float64)
+    # Stored as float32, so threshold the float32 values, the same as
+    # OutputCache does when reading them back.
+    ious = compute_output_IoUs(
+        det_buffer, det_offsets, target_boxes).astype(np.float32)
+
+    # Is the argmax of the probabilities a detection that overlaps the target?
+    guesses = segment_argmax(prob_buffer, prob_offsets)
+    has_guess = guesses < np.diff(det_offsets)
+    argmax_correct = np.zeros(len(rows), dtype=bool)
+    argmax_correct[has_guess] = ious[
+        det_offsets[:-1][has_guess]+guesses[has_guess]] >= threshold
+
+    write_cur.executemany(
+        "INSERT INTO output_ious(output, ious, argmax_correct, threshold) "
+        "VALUES (?, ?, ?, ?)",
+        ((rows[i]['output_id'], ious[det_offsets[i]:det_offsets[i+1]].tobytes(),
+          int(argmax_correct[i]), threshold) for i in range(len(rows))))
+
+    num_outputs += len(rows)
+    num_correct += int(argmax_correct.sum())
+    print(f"{num_outputs} outputs processed")
+
+dbo.con.commit()
+print(f"{num_correct} of {num_outputs} outputs have a correct argmax "\
+      f"at IoU {threshold}")
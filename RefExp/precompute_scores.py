@@ -0,0 +1,65 @@
+"""Materializes the rejection score of every output.
+
+Computes every score supported by calc_rejection_score (entropy and sr) for
+all rows of outputs in one vectorized sweep, and stores them in the
+output_scores table. Naive and smart replacement read these instead of
+rescoring each re-query. NaN and inf scores are stored as-is and counted in
+the report, rather than stopping the sweep. Rerunning replaces the table.
+
+Typical usage:
+    python precompute_scores.py
+"""
+import numpy as np
+from util.database_object import DatabaseObject
+from util.database_commands import convert_ragged_arrays
+from util.calculation_utils import calc_all_rejection_scores,\
+        rejection_score_methods
+
+# How many outputs to process per batch.
+batch_size = 50000
+
+# Write straight to the database file.
+dbo = DatabaseObject(memory=False)
+write_cur = dbo.con.cursor()
+
+write_cur.execute("DROP TABLE IF EXISTS output_scores")
+score_columns = ", ".join(
+    [f"{method} real" for method in rejection_score_methods])
+query = f"CREATE TABLE output_scores (output INTEGER PRIMARY KEY, "\
+        f"{score_columns}, FOREIGN KEY (output) REFERENCES outputs(id))"
+write_cur.execute(query)
+query = f"INSERT INTO output_scores(output, "\
+        f"{', '.join(rejection_score_methods)}) VALUES "\
+        f"({', '.join(['?']*(len(rejection_score_methods)+1))})"
+
+dbo.cur.execute("SELECT id, probabilities FROM outputs")
+
+num_outputs = 0
+num_nan = {method: 0 for method in rejection_score_methods}
+num_inf = {method: 0 for method in rejection_score_methods}
+while True:
+    rows = dbo.cur.fetchmany(batch_size)
+    if len(rows) == 0:
+        break
+
+    # Decode the batch and score it with every method.
+    prob_offsets, prob_buffer = convert_ragged_arrays(
+        [row['probabilities'] for row in rows])
+    scores = []
+    for method in rejection_score_methods:
+        method_scores = calc_all_rejection_scores(
+            prob_buffer, prob_offsets, method)
+        num_nan[method] += int(np.isnan(method_scores).sum())
+        num_inf[method] += int(np.isinf(method_scores).sum())
+        scores.append(method_scores.tolist())
+
+    write_cur.executemany(
+        query, zip([row['id'] for row in rows], *scores))
+
+    num_outputs += len(rows)
+    print(f"{num_outputs} outputs processed")
+
+dbo.con.commit()
+for method in rejection_score_methods:
+    print(f"{method}: {num_nan[method]} NaN and {num_inf[method]} inf scores "\
+          f"out of {num_outputs}")
@@ -0,0 +1,151 @@
+"""Runs the full grid of scoring methods, replacement methods, DDCs, and
+splits in a single process.
+
+This replaces running generate_performance_pickles.py once per combination
+and merging the results with combine_pickles.py. The database is loaded once,
+every (model, distribution, split) slice is cached once and shared by every
+combination, and the results are written to one consolidated pickle with the
+same layout as combine_pickles.py produces. Seeds match
+generate_performance_pickles.py, so for the same --seed the results are
+identical.
+
+With --checkpoint, every trial is written to a checkpoint as soon as it
+finishes, and running the same command again after an interruption skips the
+trials that are done.
+
+Typical usage example:
+    python run_sweep.py
+    python run_sweep.py --methods naive combined --ddcs 1 2 3 --splits testA \
+            --workers 32
+    python run_sweep.py --checkpoint armae_arrays/sweep.checkpoint
+    python run_sweep.py --output armae_arrays/compiled.store --store
+"""
+import argparse
+import os
+import time
+from multiprocessing import Pool
+from util.database_object import DatabaseObject
+from util.columnar_object import ColumnarObject
+from util.calculation_utils import fill_skipped_coverages
+from util import simulation
+from util import combined_kernel
+from util.checkpoint import CheckpointStore, atomic_pickle_dump
+from util.results_store import ResultsStore
+
+parser = argparse.ArgumentParser(
+    description="Runs every (scoring, method, DDC, split) combination.")
+parser.add_argument("--scoring", nargs="+", default=["entropy"],
+                    help="scoring methods, e.g. entropy sr")
+parser.add_argument("--methods", nargs="+",
+                    default=["naive", "smart", "combined", "ensemble_mean",
+                             "ensemble_consensus"],
+                    help="replacement methods, without the DDC")
+parser.add_argument("--ddcs", nargs="+", type=int, default=[*range(1, 11)],
+                    help="deferral depth constraints")
+parser.add_argument("--splits", nargs="+", default=["val", "testA", "testB"])
+parser.add_argument("--workers", type=int, default=1,
+                    help="how many processes to run trials in")
+parser.add_argument("--seed", type=int, default=0,
+                    help="base seed for every trial's random number stream")
+parser.add_argument("--batched", action="store_true",
+                    help="run naive and smart trials together, per model")
+parser.add_argument("--jit", action="store_true",
+                    help="run combined trials in the compiled kernel")
+parser.add_argument("--columnar", default=None,
+                    help="read from this columnar store (see "
+                    "export_columnar.py) instead of the database")
+parser.add_argument("--output", default="armae_arrays/compiled.pickle",
+                    help="where to write the consolidated results")
+parser.add_argument("--store", action="store_true",
+                    help="write --output as a results store (see "
+                    "util/results_store.py) instead of a pickle")
+parser.add_argument("--compress", action="store_true",
+                    help="compress the arrays of the results store")
+parser.add_argument("--checkpoint", default=None,
+                    help="checkpoint finished trials to this file, and skip "
+                    "the trials already in it")
+args = parser.parse_args()
+if args.jit and not combined_kernel.numba_available:
+    print("WARNING: numba is not installed, so --jit runs the combined "\
+          "kernel as plain Python, without any speedup")
+
+# How many trials to run for each scenario (model, obj source, dist)
+num_trials = 100
+
+start_time = time.time()
+if args.columnar is not None:
+    dbo = ColumnarObject(args.columnar)
+else:
+    # Only the splits and distributions we simulate are loaded.
+    dbo = DatabaseObject(memory=True, distributions=["softmax", "dropout"],
+                         splits=args.splits)
+
+groups = dbo.get_model_groups()
+distribution_ids = [distribution_id for distribution_id in
+                    dbo.idx_to_distribution_dict if
+                    dbo.idx_to_distribution_dict[distribution_id] in
+                    ["softmax", "dropout"]]
+
+# Load every slice once, up front, so every combination (and every pool
+# worker) shares them.
+caches = {}
+for split in args.splits:
+    for group in groups:
+        for model in groups[group]:
+            for distribution_id in distribution_ids:
+                caches[(model, distribution_id, split)] = dbo.get_output_cache(
+                    model, distribution_id, split)
+pool = None
+if args.workers > 1:
+    pool = Pool(args.workers, initializer=simulation.init_worker,
+                initargs=(caches,))
+print(f"Loaded {len(caches)} slices in {time.time()-start_time:.1f}s")
+
+checkpoint = None
+if args.checkpoint is not None:
+    checkpoint = CheckpointStore(args.checkpoint, args.seed)
+
+compiled_dict = {}
+for split in args.splits:
+    for scoring_method in args.scoring:
+        for method in args.methods:
+            for ddc in args.ddcs:
+                replacement_method = f"{method}_{ddc}"
+                for group in groups:
+                    if len(groups[group]) == 0:
+                        continue
+                    for distribution_id in distribution_ids:
+                        print(split, group, distribution_id, scoring_method,
+                              replacement_method)
+                        results = simulation.run_trials(
+                            caches, groups[group], distribution_id, split,
+                            scoring_method, replacement_method,
+                            dbo.failure_to_idx_dict, num_trials, args.seed,
+                            group, pool, args.batched, args.jit, checkpoint)
+                        if results is None:
+                            continue
+
+                        # Same keys and filling as combine_pickles.py.
+                        compiled_dict[f'{split}-{group}-{distribution_id}-'\
+                                      f'{scoring_method}-{replacement_method}'] =\
+                                fill_skipped_coverages(
+                                    {'errors': results[0],
+                                     'rmaes': results[1]})
+
+if pool is not None:
+    pool.close()
+
+# save
+if os.path.dirname(args.output) != "":
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+if args.store:
+    store = ResultsStore(args.output, args.compress)
+    for key in compiled_dict:
+        store.write(key, compiled_dict[key])
+    store.flush()
+else:
+    atomic_pickle_dump(compiled_dict, args.output)
+if checkpoint is not None:
+    checkpoint.remove()
+print(f"Wrote {len(compiled_dict)} results to {args.output} in "\
+      f"{time.time()-start_time:.1f}s")
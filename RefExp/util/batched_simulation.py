@@ -0,0 +1,114 @@
+"""Runs many trials of the deferral simulation at once.
+
+Rather than one Python loop per trial, every trial that shares a model is
+kept in (trial, target) arrays of scores, failure modes, and re-query counts.
+Each deferral step is a row-wise argmax, a gather of the replacement outputs,
+and a scatter of the updates, for every trial at once. Supports naive and
+smart replacement.
+
+Each trial still consumes its own seed stream exactly as
+simulation.run_trial does (one uniform per re-query), so the results are
+identical to running the trials one at a time.
+
+Typical usage:
+    errors, rmaes = run_trials_batched(cache, output_idx, uniforms, "entropy",
+                                       "naive_3", failure_ids)
+"""
+import numpy as np
+
+# Replacement methods that run_trials_batched supports.
+batched_methods = ["naive", "smart"]
+
+def supports_batched(replacement_method):
+    """Checks whether a replacement method can run batched.
+
+    args:
+        replacement_method: e.g. naive_3, combined_3.
+
+    returns:
+        True if run_trials_batched supports it.
+    """
+    return replacement_method.split("_")[0] in batched_methods
+
+def run_trials_batched(cache, output_idx, uniforms, scoring_method,
+                       replacement_method, failure_ids):
+    """Runs every trial for one model, from the initial draw to the DDC.
+
+    args:
+        cache: the OutputCache for the model, distribution, and split.
+        output_idx: a (trials, targets) array of initial draw output rows.
+        uniforms: a (trials, targets) array of uniforms in [0, 1). Trial t
+            uses uniforms[t, s] to pick its replacement at step s.
+        scoring_method: the scoring function applied to the distribution.
+        replacement_method: naive_[DDC] or smart_[DDC].
+        failure_ids: dict from failure mode name to database ID.
+
+    returns:
+        (trials, targets+1) arrays of the error and the rmae at every number
+        of re-queries.
+    """
+    method = replacement_method.split("_")[0]
+    max_depth = int(replacement_method.split("_")[-1])
+    correct_idx = failure_ids['correct']
+    missed_detection_idx = failure_ids['missed_detection']
+    cache_scores = cache.scores[scoring_method]
+
+    num_trials, num_targets = output_idx.shape
+    trials = np.arange(num_trials)
+    starts = cache.target_offsets[:-1]
+    counts = np.diff(cache.target_offsets)
+
+    # The state of every trial.
+    failure_modes = cache.failure_modes[output_idx]
+    scores = cache_scores[output_idx].astype(np.float64)
+    rq_counts = np.zeros((num_trials, num_targets), dtype=int)
+
+    # Running counts for the error and rmae of every trial.
+    is_rmae = (failure_modes != correct_idx)*(
+        failure_modes != missed_detection_idx)
+    num_incorrect = (failure_modes != correct_idx).sum(axis=1)
+    num_rmae = is_rmae.sum(axis=1)
+
+    errors = np.zeros((num_trials, num_targets+1))
+    rmaes = np.zeros((num_trials, num_targets+1))
+
+    # Every step re-queries one target in every trial, so all trials reach
+    # the DDC after the same number of steps.
+    for step in range(num_targets):
+        errors[:, step] = num_incorrect/num_targets
+        rmaes[:, step] = num_rmae/num_targets
+
+        # Which target to re-query in each trial, and its replacement.
+        to_requery = scores.argmax(axis=1)
+        rq_counts[trials, to_requery] += 1
+        replacements = starts[to_requery]+(
+            uniforms[:, step]*counts[to_requery]).astype(np.int64)
+        replacement_scores = cache_scores[replacements]
+
+        # Naive replacement always takes the new failure mode. Smart
+        # replacement only takes it if the new score is lower.
+        previous_failure_modes = failure_modes[trials, to_requery]
+        if method == "naive":
+            new_failure_modes = cache.failure_modes[replacements]
+        else:
+            new_failure_modes = np.where(
+                replacement_scores < scores[trials, to_requery],
+                cache.failure_modes[replacements], previous_failure_modes)
+        num_incorrect += (new_failure_modes != correct_idx).astype(int)-(
+            previous_failure_modes != correct_idx)
+        num_rmae += ((new_failure_modes != correct_idx)*(
+            new_failure_modes != missed_detection_idx)).astype(int)-(
+                (previous_failure_modes != correct_idx)*(
+                    previous_failure_modes != missed_detection_idx))
+        failure_modes[trials, to_requery] = new_failure_modes
+
+        # Targets that have reached the DDC get a very low score, so they
+        # aren't re-queried.
+        scores[trials, to_requery] = np.where(
+            rq_counts[trials, to_requery] >= max_depth, -1e6,
+            replacement_scores)
+
+    errors[:, num_targets] = num_incorrect/num_targets
+    rmaes[:, num_targets] = num_rmae/num_targets
+
+    return errors, rmaes
@@ -0,0 +1,306 @@
+"""Bootstrap estimates of DEV, err@1, and their marginals.
+
+A replicate draws one trial (a row of the errors array) at random for every
+DDC. DEV is the mean, over DDCs, of the mean error of the drawn rows, and
+err@1 is the mean of their error with every query deferred (the last
+column). Rather than looping over replicates and DDCs, the row indices of
+every replicate are drawn at once as a (replicates, DDCs) array, and
+gathered from the per-row means in one fancy-indexing operation.
+
+Every method draws from its own generator, seeded from the base seed and the
+method's name, so results don't depend on how many workers there are.
+
+The rows of a replicate are independent and uniform, so the expectation and
+variance of DEV and err@1 can also be calculated exactly, with exact_dev.
+
+Typical usage:
+    with_depth_dict = group_by_method(data)
+    metrics = run_for_methods(bootstrap_dev, with_depth_dict, replicates=10000,
+                              workers=8, ci=95)
+"""
+import zlib
+from multiprocessing import Pool
+from statistics import NormalDist
+import numpy as np
+
+def group_by_method(data):
+    """Groups results by method, then DDC.
+
+    args:
+        data: a dict (or results store) from keys like
+            [split]-[net]-[source]-[dist]-[scoring]-[method]_[DDC] to dicts
+            with keys errors and rmaes.
+
+    returns:
+        a dict of dicts. The first key is the key without the DDC, the
+        second is the DDC.
+    """
+    with_depth_dict = {}
+    for key in data:
+        split_key = key.split("_")
+        if len(split_key) == 3:
+            split_key = ["_".join([split_key[0], split_key[1]]), split_key[2]]
+        method = split_key[0]
+        depth_constraint = int(split_key[1])
+
+        if method not in with_depth_dict.keys():
+            with_depth_dict[method] = {}
+
+        with_depth_dict[method][depth_constraint] = data[key]
+    return with_depth_dict
+
+def method_rng(method, seed):
+    """Makes the generator of one method.
+
+    args:
+        method: the name of the method.
+        seed: the base seed, or None for a fresh one.
+
+    returns:
+        a numpy Generator.
+    """
+    if seed is None:
+        return np.random.default_rng()
+    return np.random.default_rng([seed, zlib.crc32(method.encode())])
+
+def draw_rows(row_counts, replicates, rng):
+    """Draws one row per DDC for every replicate.
+
+    args:
+        row_counts: how many rows (trials) each DDC has.
+        replicates: how many replicates to draw.
+        rng: the numpy Generator to draw from.
+
+    returns:
+        a (replicates, DDCs) array of row indices.
+    """
+    return rng.integers(0, np.asarray(row_counts)[None, :],
+                        size=(replicates, len(row_counts)))
+
+def gather_row_values(row_values, rows):
+    """Looks up a per-row value of every drawn row.
+
+    args:
+        row_values: a list with an array of per-row values for each DDC.
+        rows: a (replicates, DDCs) array of row indices.
+
+    returns:
+        a (replicates, DDCs) array of values.
+    """
+    # Pad into one (DDCs, rows) table so the lookup is a single gather.
+    table = np.zeros((len(row_values), max(
+        values.shape[0] for values in row_values)))
+    for i, values in enumerate(row_values):
+        table[i, :values.shape[0]] = values
+    return table[np.arange(len(row_values))[None, :], rows]
+
+def percentile_ci(values, ci):
+    """Calculates a percentile confidence interval.
+
+    args:
+        values: the replicate values, along axis 0.
+        ci: the width of the interval, in percent.
+
+    returns:
+        the lower and upper bounds.
+    """
+    return np.percentile(values, [(100-ci)/2, 100-(100-ci)/2], axis=0)
+
+def bootstrap_dev(depth_runs, depths, replicates=100, ci=95, rng=None):
+    """Estimates DEV and err@1 of one method.
+
+    args:
+        depth_runs: a dict from DDC to a dict with key errors.
+        depths: the DDCs to integrate over.
+        replicates: how many bootstrap replicates to draw.
+        ci: the width of the confidence intervals, in percent.
+        rng: the numpy Generator to draw from.
+
+    returns:
+        a dict with keys mean, stderr, accs_1, and stderr_accs_1 (in
+        percent, with the standard error of the mean over replicates), and
+        ci and ci_accs_1 (the percentile interval of the replicates).
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    errors = [np.asarray(depth_runs[depth]['errors']) for depth in depths]
+    rows = draw_rows([run.shape[0] for run in errors], replicates, rng)
+    areas_under = gather_row_values(
+        [run.mean(axis=1) for run in errors], rows).mean(axis=1)*100
+    accs_1 = gather_row_values(
+        [run[:, -1] for run in errors], rows).mean(axis=1)*100
+
+    return {'mean': areas_under.mean(),
+            'stderr': areas_under.std()/np.sqrt(replicates),
+            'accs_1': accs_1.mean(),
+            'stderr_accs_1': accs_1.std()/np.sqrt(replicates),
+            'ci': percentile_ci(areas_under, ci),
+            'ci_accs_1': percentile_ci(accs_1, ci)}
+
+def exact_dev(depth_runs, depths, replicates=100, ci=95, rng=None):
+    """Calculates the expectation and spread of DEV and err@1 of one method
+    exactly, without drawing any replicates.
+
+    A replicate is the mean, over DDCs, of the value of one uniformly drawn
+    row per DDC. Its expectation is the mean over DDCs of each DDC's mean
+    row value, and its variance is the sum over DDCs of the variance of each
+    DDC's row values, over DDCs squared.
+
+    args:
+        depth_runs: a dict from DDC to a dict with key errors.
+        depths: the DDCs to integrate over.
+        replicates: the number of replicates the standard error is for, so
+            it is comparable to bootstrap_dev's.
+        ci: the width of the confidence intervals, in percent. These assume
+            a replicate is normally distributed.
+        rng: unused.
+
+    returns:
+        a dict with the same keys as bootstrap_dev.
+    """
+    errors = [np.asarray(depth_runs[depth]['errors']) for depth in depths]
+    z = NormalDist().inv_cdf(0.5+ci/200)
+    metrics = {}
+    for name, row_values in (("mean", [run.mean(axis=1) for run in errors]),
+                             ("accs_1", [run[:, -1] for run in errors])):
+        mean = np.mean([values.mean() for values in row_values])*100
+        std = np.sqrt(np.sum([values.var() for values in row_values]))/\
+                len(row_values)*100
+        stderr_name = "stderr" if name == "mean" else "stderr_accs_1"
+        ci_name = "ci" if name == "mean" else "ci_accs_1"
+        metrics[name] = mean
+        metrics[stderr_name] = std/np.sqrt(replicates)
+        metrics[ci_name] = np.array([mean-z*std, mean+z*std])
+    return metrics
+
+def bootstrap_depth_marginal(depth_runs, depths, replicates=100, ci=95,
+                             rng=None):
+    """Estimates the mean error of one method at every DDC.
+
+    args:
+        depth_runs: a dict from DDC to a dict with key errors.
+        depths: the DDCs to estimate.
+        replicates: how many bootstrap replicates to draw.
+        ci: the width of the confidence intervals, in percent.
+        rng: the numpy Generator to draw from.
+
+    returns:
+        a dict with keys mean, stderr, and ci, each with one value per DDC,
+        in percent.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    errors = [np.asarray(depth_runs[depth]['errors']) for depth in depths]
+    rows = draw_rows([run.shape[0] for run in errors], replicates, rng)
+    areas_under = gather_row_values(
+        [run.mean(axis=1) for run in errors], rows)*100
+
+    return {'mean': areas_under.mean(axis=0),
+            'stderr': areas_under.std(axis=0)/np.sqrt(replicates),
+            'ci': percentile_ci(areas_under, ci)}
+
+def bootstrap_dr_marginal(depth_runs, depths, replicates=100, ci=None,
+                          rng=None, chunk_size=1000):
+    """Estimates the error of one method at every deferral rate, averaged
+    over DDCs.
+
+    Every replicate is a whole row of errors, so replicates are gathered
+    chunk_size at a time, and their mean and variance combined across
+    chunks, to bound memory.
+
+    args:
+        depth_runs: a dict from DDC to a dict with key errors.
+        depths: the DDCs to average over.
+        replicates: how many bootstrap replicates to draw.
+        ci: unused; percentile intervals would need every replicate kept.
+        rng: the numpy Generator to draw from.
+        chunk_size: how many replicates to gather at once.
+
+    returns:
+        a dict with keys mean and stderr, each with one value per deferral
+        rate, in percent.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    errors = [np.asarray(depth_runs[depth]['errors']) for depth in depths]
+    rows = draw_rows([run.shape[0] for run in errors], replicates, rng)
+
+    count = 0
+    mean = np.zeros(errors[0].shape[1])
+    sum_squares = np.zeros(errors[0].shape[1])
+    for start in range(0, replicates, chunk_size):
+        chunk_rows = rows[start:start+chunk_size]
+        chunk = np.zeros((chunk_rows.shape[0], errors[0].shape[1]))
+        for i, run in enumerate(errors):
+            chunk += run[chunk_rows[:, i]]
+        chunk *= 100/len(errors)
+
+        # Chan et al.'s update of the mean and sum of squared deviations.
+        chunk_mean = chunk.mean(axis=0)
+        delta = chunk_mean-mean
+        total = count+chunk.shape[0]
+        mean = mean+delta*chunk.shape[0]/total
+        sum_squares += ((chunk-chunk_mean)**2).sum(axis=0)+\
+                delta**2*count*chunk.shape[0]/total
+        count = total
+
+    return {'mean': mean,
+            'stderr': np.sqrt(sum_squares/count)/np.sqrt(replicates)}
+
+def run_method(function, method, depth_runs, depths, replicates, ci, seed):
+    """Runs a bootstrap function for one method, with its own generator.
+
+    args:
+        function: bootstrap_dev, exact_dev, bootstrap_depth_marginal, or
+            bootstrap_dr_marginal.
+        method: the name of the method.
+        depth_runs: a dict from DDC to a dict with key errors.
+        depths: the DDCs to use.
+        replicates: how many bootstrap replicates to draw.
+        ci: the width of the confidence intervals, in percent.
+        seed: the base seed, or None for a fresh one.
+
+    returns:
+        the result of function.
+    """
+    return function(depth_runs, depths, replicates, ci,
+                    method_rng(method, seed))
+
+def run_for_methods(function, with_depth_dict, depths=None, replicates=100,
+                    ci=95, workers=1, seed=0):
+    """Runs a bootstrap function for every method, in parallel.
+
+    args:
+        function: bootstrap_dev, exact_dev, bootstrap_depth_marginal, or
+            bootstrap_dr_marginal.
+        with_depth_dict: the output of group_by_method.
+        depths: the DDCs to use. Defaults to every DDC from 1 to 10 that
+            each method has.
+        replicates: how many bootstrap replicates to draw.
+        ci: the width of the confidence intervals, in percent.
+        workers: how many processes to run methods in.
+        seed: the base seed, or None for a fresh one.
+
+    returns:
+        a dict from method to the result of function.
+    """
+    jobs = []
+    for method in with_depth_dict:
+        method_depths = depths
+        if method_depths is None:
+            method_depths = [depth for depth in with_depth_dict[method]
+                             if 0 < depth <= 10]
+        # Only the errors are needed, and memory-mapped arrays are read
+        # here so workers are sent plain arrays.
+        depth_runs = {depth: {'errors': np.asarray(
+            with_depth_dict[method][depth]['errors'])} for depth in
+                      method_depths}
+        jobs.append((function, method, depth_runs, method_depths,
+                     replicates, ci, seed))
+
+    if workers > 1:
+        with Pool(workers) as pool:
+            results = pool.starmap(run_method, jobs)
+    else:
+        results = [run_method(*job) for job in jobs]
+    return {job[1]: result for job, result in zip(jobs, results)}
@@ -1,7 +1,9 @@
 """Calculation utils used across many scripts."""
 import sys
 import numpy as np
-from IPython import embed
+
+# Every method supported by calc_rejection_score.
+rejection_score_methods = ["entropy", "sr"]
 
 def computeIoU(box1, box2):
     """Computes the IoU of two boxes.
@@ -45,6 +47,93 @@ def compute_all_IoUs(target, candidate_boxes):
 
     return iou_list
 
+def compute_IoUs_batched(boxes, targets):
+    """Calculates the IoU between many pairs of boxes at once.
+
+    Vectorized version of computeIoU, with the same pixel conventions.
+
+    args:
+        boxes: an (N, 4) array of boxes (tlx, tly, brx, bry)
+        targets: an (N, 4) array of boxes (tlx, tly, brx, bry), where row i
+            is compared against row i of boxes.
+
+    returns:
+        a float64 array of N IoUs.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64)
+    targets = np.asarray(targets, dtype=np.float64)
+    inter_x1 = np.maximum(boxes[:, 0], targets[:, 0])
+    inter_y1 = np.maximum(boxes[:, 1], targets[:, 1])
+    inter_x2 = np.minimum(boxes[:, 2]-1, targets[:, 2]-1)
+    inter_y2 = np.minimum(boxes[:, 3]-1, targets[:, 3]-1)
+
+    overlaps = (inter_x1 < inter_x2)*(inter_y1 < inter_y2)
+    inter = np.where(overlaps, (inter_x2-inter_x1+1)*(inter_y2-inter_y1+1), 0)
+    union = (boxes[:, 2]-boxes[:, 0])*(boxes[:, 3]-boxes[:, 1]) +\
+            (targets[:, 2]-targets[:, 0])*(targets[:, 3]-targets[:, 1]) - inter
+
+    return inter/union
+
+def compute_output_IoUs(det_buffer, det_offsets, target_boxes):
+    """Calculates the IoU of every detection of many outputs against the
+    target of its output.
+
+    args:
+        det_buffer: an (M, 4) array of detections (tlx, tly, w, h) for all
+            outputs, one after the other.
+        det_offsets: output i has detections det_offsets[i] to
+            det_offsets[i+1].
+        target_boxes: an (outputs, 4) array of target boxes
+            (tlx, tly, brx, bry).
+
+    returns:
+        a float64 array of M IoUs, laid out like det_buffer.
+    """
+    # Same conversion as database_commands.convert_boxes_to_corners.
+    corners = np.concatenate(
+        (det_buffer[:, :2], det_buffer[:, :2]+det_buffer[:, 2:]), axis=1)
+    per_detection_targets = np.repeat(
+        np.asarray(target_boxes), np.diff(det_offsets), axis=0)
+    return compute_IoUs_batched(corners, per_detection_targets)
+
+def segment_argmax(values, offsets):
+    """Finds the argmax of every segment of a ragged array.
+
+    Like np.argmax, the first maximum (or first NaN) wins. Segments must not
+    be empty.
+
+    args:
+        values: a flat array holding every segment, one after the other.
+        offsets: segment i is values[offsets[i]:offsets[i+1]].
+
+    returns:
+        the argmax of each segment, relative to the segment's start.
+    """
+    offsets = np.asarray(offsets)
+    if offsets.shape[0] < 2:
+        return np.zeros(0, dtype=np.int64)
+    starts = offsets[:-1]
+    segment_ids = np.repeat(np.arange(starts.shape[0]), np.diff(offsets))
+    maxes = np.maximum.reduceat(values, starts)
+    is_max = (values == maxes[segment_ids])+np.isnan(values)
+    positions = np.where(is_max, np.arange(values.shape[0]), values.shape[0])
+    return np.minimum.reduceat(positions, starts)-starts
+
+def group_any(flags, groups):
+    """Checks whether any flag is set in every group.
+
+    args:
+        flags: a boolean array.
+        groups: the group of each flag, e.g. a target id.
+
+    returns:
+        a boolean array with one value per unique group, in sorted order of
+        the groups.
+    """
+    unique_groups, inverse = np.unique(groups, return_inverse=True)
+    return np.bincount(inverse.reshape(-1), weights=flags,
+                       minlength=unique_groups.shape[0]) > 0
+
 def calc_rmae(draw):
     """Calculates the accuracy of a set of examples.
 
@@ -68,6 +157,37 @@ def calc_error(draw):
     """
     return (np.array(draw['failure_modes']) != 5).mean()
 
+def fill_skipped_coverages(run):
+    """Fills coverages that were never written with the previous value.
+
+    For some of our methods, we don't update every coverage, e.g., because
+    we need 3 queries to decide. Where a coverage is zero across every trial,
+    it takes the value of the previous (higher coverage) column. This is done
+    in one gather: every column takes the value of the last column at or
+    before it that isn't zero. Leading zero columns take the last column, as
+    the first column's "previous" column is column -1.
+
+    args:
+        run: a dict with keys rmaes and errors, each (trials, coverages).
+            Modified in place.
+
+    returns:
+        the same dict.
+    """
+    written = run['rmaes'].sum(axis=0) != 0
+    if not written.all():
+        num_columns = written.shape[0]
+        sources = np.maximum.accumulate(
+            np.where(written, np.arange(num_columns), -1))
+        sources[sources < 0] = num_columns-1
+        run['rmaes'][:] = run['rmaes'][:, sources]
+        run['errors'][:] = run['errors'][:, sources]
+    return run
+
+# How many NaN and inf scores calc_rejection_score has returned in this
+# process. A warning is printed the first time each is seen.
+num_invalid_scores = {"nan": 0, "inf": 0}
+
 def calc_rejection_score(distribution, method):
     """Calculates the rejection score.
 
@@ -76,7 +196,8 @@ def calc_rejection_score(distribution, method):
         method: the method used for calculating score from this distribution.
 
     returns:
-        a float representing the model's prediction confidence.
+        a float representing the model's prediction confidence. NaN and inf
+        scores are returned as-is, and counted in num_invalid_scores.
     """
     # Remember higher score corresponds to higher predicted AE
     if method == "entropy":
@@ -86,10 +207,52 @@ def calc_rejection_score(distribution, method):
     else:
         print("Invalid scoring method selected")
         sys.exit()
-    if np.isnan(to_return.sum()) or np.isinf(to_return.sum()):
-        embed()
+    for kind, is_invalid in (("nan", np.isnan), ("inf", np.isinf)):
+        if is_invalid(to_return):
+            if num_invalid_scores[kind] == 0:
+                print(f"WARNING: {kind} {method} rejection score, from a "\
+                      f"distribution summing to {distribution.sum()}")
+            num_invalid_scores[kind] += 1
     return to_return
 
+def calc_all_rejection_scores(prob_buffer, prob_offsets, method):
+    """Calculates the rejection score of many distributions at once.
+
+    Vectorized version of calc_rejection_score, which gives bit-identical
+    results. Distributions of the same length are stacked and reduced along
+    their last axis, so numpy sums each one exactly as it would alone.
+
+    args:
+        prob_buffer: every softmax distribution, one after the other.
+        prob_offsets: distribution i is prob_buffer[offsets[i]:offsets[i+1]].
+        method: the method used for calculating score from a distribution.
+
+    returns:
+        an array with the score of every distribution. Empty distributions
+        are NaN, and NaN or inf scores are returned as-is.
+    """
+    prob_offsets = np.asarray(prob_offsets)
+    lengths = np.diff(prob_offsets)
+    if method == "entropy":
+        terms = -prob_buffer*np.log(prob_buffer+1e-32)
+    elif method == "sr":
+        terms = prob_buffer
+    else:
+        print("Invalid scoring method selected")
+        sys.exit()
+
+    scores = np.full(lengths.shape[0], np.nan, dtype=prob_buffer.dtype)
+    for length in np.unique(lengths):
+        if length == 0:
+            continue
+        rows = np.where(lengths == length)[0]
+        stacked = terms[prob_offsets[rows][:, None]+np.arange(length)]
+        if method == "entropy":
+            scores[rows] = stacked.sum(axis=1)
+        else:
+            scores[rows] = -stacked.max(axis=1)
+    return scores
+
 def get_which_to_requery(draw, scoring_method):
     """Returns the index of the referring expression to requery.
 
@@ -0,0 +1,152 @@
+"""An on-disk store of finished trials, so long runs can be resumed.
+
+Every trial is written, in its own transaction, as soon as it finishes. Each
+is keyed by (split, group, distribution, scoring, method, trial), so a
+restarted run can skip the trials that are already done. Once a run is
+complete, compact() gives the results in the saved_runs layout of
+generate_performance_pickles.py.
+
+Typical usage:
+    checkpoint = CheckpointStore("armae_arrays/run.checkpoint", seed)
+    done = checkpoint.completed_trials(split, group, distribution_id,
+                                       scoring_method, replacement_method)
+    checkpoint.add_trial(split, group, distribution_id, scoring_method,
+                         replacement_method, trial, errors, rmaes)
+    saved_runs = checkpoint.compact()
+"""
+import os
+import pickle
+import sqlite3
+import numpy as np
+
+class CheckpointStore():
+    """Finished trials, in a sqlite file."""
+    def __init__(self, path, seed=0):
+        """Opens the store, creating it if it doesn't exist.
+
+        args:
+            path: the sqlite file.
+            seed: the base seed of the run. Trials from a run with another
+                seed can't be resumed.
+        """
+        self.path = path
+        self.con = sqlite3.connect(path)
+        # Each commit is durable, without blocking readers.
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("PRAGMA synchronous=NORMAL")
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS trials (split TEXT, grp TEXT, "
+            "distribution INTEGER, scoring TEXT, method TEXT, trial "
+            "INTEGER, errors blob, rmaes blob, PRIMARY KEY (split, grp, "
+            "distribution, scoring, method, trial))")
+        self.con.execute("CREATE TABLE IF NOT EXISTS settings (seed INTEGER)")
+        row = self.con.execute("SELECT seed FROM settings").fetchone()
+        if row is None:
+            self.con.execute("INSERT INTO settings VALUES (?)", (seed,))
+        elif row[0] != seed:
+            raise ValueError(f"{path} holds trials with seed {row[0]}, "
+                             f"not {seed}")
+        self.con.commit()
+
+    def completed_trials(self, split, group, distribution, scoring, method):
+        """Gets the trials that are already done for one scenario.
+
+        args:
+            split: val, testA, or testB.
+            group: the name of the group, e.g. UNITER-gt.
+            distribution: the distribution ID.
+            scoring: the scoring method.
+            method: the replacement method.
+
+        returns:
+            a dict from trial number to its errors and rmaes arrays.
+        """
+        query = "SELECT trial, errors, rmaes FROM trials WHERE split=? AND "\
+                "grp=? AND distribution=? AND scoring=? AND method=?"
+        rows = self.con.execute(
+            query, (split, group, distribution, scoring, method)).fetchall()
+        return {trial: (np.frombuffer(errors, dtype=np.float64),
+                        np.frombuffer(rmaes, dtype=np.float64))
+                for trial, errors, rmaes in rows}
+
+    def add_trial(self, split, group, distribution, scoring, method, trial,
+                  errors, rmaes):
+        """Writes one finished trial.
+
+        The trial is committed before this returns, so it survives the
+        process being killed straight after.
+
+        args:
+            split: val, testA, or testB.
+            group: the name of the group, e.g. UNITER-gt.
+            distribution: the distribution ID.
+            scoring: the scoring method.
+            method: the replacement method.
+            trial: the trial number.
+            errors: the error at every number of re-queries.
+            rmaes: the rmae at every number of re-queries.
+        """
+        with self.con:
+            self.con.execute(
+                "INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (split, group, int(distribution), scoring, method, int(trial),
+                 np.asarray(errors, dtype=np.float64).tobytes(),
+                 np.asarray(rmaes, dtype=np.float64).tobytes()))
+
+    def compact(self, num_trials=100):
+        """Gathers every trial in the store into the saved_runs layout.
+
+        args:
+            num_trials: how many trials each scenario has. Trials that
+                weren't run are left as rows of zeros.
+
+        returns:
+            a dict from keys like [split]-[group]-[dist]-[scoring]-[method]
+            to dicts with keys errors and rmaes, each a (num_trials,
+            targets+1) array.
+        """
+        saved_runs = {}
+        query = "SELECT split, grp, distribution, scoring, method, trial, "\
+                "errors, rmaes FROM trials ORDER BY split, grp, distribution,"\
+                " scoring, method, trial"
+        for split, group, distribution, scoring, method, trial, errors,\
+                rmaes in self.con.execute(query):
+            key = f'{split}-{group}-{distribution}-{scoring}-{method}'
+            errors = np.frombuffer(errors, dtype=np.float64)
+            rmaes = np.frombuffer(rmaes, dtype=np.float64)
+            if key not in saved_runs:
+                saved_runs[key] = {
+                    'errors': np.zeros((num_trials, errors.shape[0])),
+                    'rmaes': np.zeros((num_trials, rmaes.shape[0]))}
+            saved_runs[key]['errors'][trial] = errors
+            saved_runs[key]['rmaes'][trial] = rmaes
+
+        return saved_runs
+
+    def close(self):
+        """Closes the store."""
+        self.con.close()
+
+    def remove(self):
+        """Closes the store and deletes its files."""
+        self.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(f"{self.path}{suffix}"):
+                os.remove(f"{self.path}{suffix}")
+
+def atomic_pickle_dump(obj, path):
+    """Pickles an object so that path is never left partly written.
+
+    The pickle is written to a temporary file next to path, which then
+    replaces path in one step.
+
+    args:
+        obj: the object to pickle.
+        path: where to write it.
+    """
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as out_file:
+        pickle.dump(obj, out_file)
+        out_file.flush()
+        os.fsync(out_file.fileno())
+    os.replace(temp_path, path)
@@ -0,0 +1,327 @@
+"""A read-only stand-in for DatabaseObject, backed by the columnar store.
+
+Opens the store written by export_columnar.py. Every column is memory-mapped,
+so opening takes milliseconds whatever the size of the database, and
+processes reading the same store share pages through the OS cache. Output
+caches are built from views into the mapped files, without decoding blobs.
+
+Typical usage:
+    database = ColumnarObject()
+    cache = database.get_output_cache(model, distribution, split)
+"""
+import json
+import os
+import numpy as np
+from util.output_cache import OutputCache
+from util.calculation_utils import rejection_score_methods
+
+class ColumnarObject():
+    """Serves the same reads as DatabaseObject, from the columnar store.
+
+    There is no SQL connection, so get_cursor and get_temp_table are not
+    available.
+    """
+    def __init__(self, path="data/columnar"):
+        """Maps the store.
+
+        args:
+            path: the directory written by export_columnar.py.
+        """
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as meta_file:
+            meta = json.load(meta_file)
+
+        self.models = meta['models']
+        self.slices = {key: tuple(value) for key, value in
+                       meta['slices'].items()}
+        self.has_ious = meta['has_ious']
+        self.has_scores = meta['has_scores']
+        self.idx_to_failure_dict = {
+            int(idx): name for idx, name in meta['failure_modes'].items()}
+        self.failure_to_idx_dict = {
+            name: idx for idx, name in self.idx_to_failure_dict.items()}
+        self.idx_to_distribution_dict = {
+            int(idx): name for idx, name in meta['distributions'].items()}
+        self.distribution_to_idx_dict = {
+            name: idx for idx, name in self.idx_to_distribution_dict.items()}
+
+        self.outputs = self._map_table("outputs")
+        self.sentences = self._map_table("sentences")
+        self.targets = self._map_table("targets")
+
+        # Keep track of the link between model names and DB indices
+        self.model_id_dict = {}
+
+        # Columnar caches of (model, distribution, split) slices.
+        self.output_caches = {}
+
+    def _map_table(self, table):
+        """Maps every column of a table.
+
+        args:
+            table: the name of the table.
+
+        returns:
+            a dict from column name to read-only memmap.
+        """
+        columns = {}
+        for file_name in os.listdir(os.path.join(self.path, table)):
+            if file_name.endswith(".npy"):
+                columns[file_name[:-4]] = np.load(
+                    os.path.join(self.path, table, file_name), mmap_mode="r")
+        return columns
+
+    def distribution_to_idx(self, distribution):
+        """Converts a string distribution to the corresponding db ID.
+
+        args:
+            distribution: the distribution in string form.
+
+        returns:
+            the database ID for that distribution.
+        """
+        return self.distribution_to_idx_dict[distribution]
+
+    def idx_to_distribution(self, idx):
+        """Converts a database ID to a string distribution.
+
+        args:
+            idx: the database ID.
+
+        Returns:
+            A string describing the distribution in human terms.
+        """
+        return self.idx_to_distribution_dict[idx]
+
+    def failure_to_idx(self, failure):
+        """Converts a string failure to the corresponding db ID.
+
+        args:
+            failure: the failure in string form.
+
+        returns:
+            the database ID for that failure.
+        """
+        return self.failure_to_idx_dict[failure]
+
+    def idx_to_failure(self, idx):
+        """Converts a database ID to a string failure.
+
+        args:
+            idx: the database ID.
+
+        Returns:
+            A string describing the failure in human terms.
+        """
+        return self.idx_to_failure_dict[idx]
+
+    def get_architectures_and_sources(self):
+        """gets a list of architectures and sources
+
+        Returns:
+            a list of architectures and sources."""
+        architectures_and_sources = []
+        for model in self.models:
+            result = {'architecture': model['architecture'],
+                      'object_source': model['object_source']}
+            if result not in architectures_and_sources:
+                architectures_and_sources.append(result)
+
+        return architectures_and_sources
+
+    def get_model_ids(self, model, obj_src):
+        """Get the database IDs corresponding to a model name.
+
+        args:
+            model: String database name.
+            obj_src: detect or ground truth objects?
+
+        Returns:
+            A list of IDs corresponding to model ids in the database.
+        """
+        if obj_src is None:
+            obj_src = "None"
+        id_dict_key = f'{model}-{obj_src}'
+        if id_dict_key not in self.model_id_dict.keys():
+            self.model_id_dict[id_dict_key] = [
+                row['id'] for row in self.models if
+                row['architecture'] == model and
+                (obj_src == "None" or row['object_source'] == obj_src)]
+
+        return self.model_id_dict[id_dict_key]
+
+    def get_model_groups(self):
+        """Groups model IDs by architecture and object source.
+
+        Returns:
+            a dict from a key like UNITER-gt to a list of model IDs.
+        """
+        groups = {}
+        for result in self.get_architectures_and_sources():
+            key = f"{result['architecture']}-{result['object_source']}"
+            groups[key] = self.get_model_ids(
+                result['architecture'], result['object_source'])
+
+        return groups
+
+    def get_slice(self, model, distribution, split):
+        """Gets the rows of the outputs for a model, distribution, and split.
+
+        args:
+            model: the model ID.
+            distribution: the distribution ID.
+            split: the data split.
+
+        returns:
+            the first row and one past the last row, which are equal if
+            there are no outputs.
+        """
+        return self.slices.get(f"{model}-{distribution}-{split}", (0, 0))
+
+    def get_output_cache(self, model, distribution, split):
+        """Retrieves the columnar cache of all outputs for a model,
+        distribution, and split.
+
+        Creates said cache if it does not already exist. The buffers are
+        views into the mapped store.
+
+        args:
+            model: the model ID.
+            distribution: the distribution ID.
+            split: the data split.
+
+        returns:
+            an OutputCache holding the slice.
+        """
+        cache_key = (model, distribution, split)
+        if cache_key not in self.output_caches:
+            start, stop = self.get_slice(model, distribution, split)
+            outputs = self.outputs
+            prob_offsets = outputs['probabilities_offsets'][start:stop+1]
+            det_offsets = outputs['detections_offsets'][start:stop+1]
+            prob_range = slice(prob_offsets[0], prob_offsets[-1])
+            det_range = slice(det_offsets[0], det_offsets[-1])
+            output_targets = outputs['target'][start:stop]
+
+            # Materialized IoUs and scores are only used if every output in
+            # the slice has them.
+            ious = None
+            argmax_correct = None
+            if self.has_ious and not np.isnan(
+                    outputs['ious'][det_range]).any():
+                ious = outputs['ious'][det_range]
+                argmax_correct = outputs['argmax_correct'][start:stop]
+            scores = {}
+            if self.has_scores:
+                for method in rejection_score_methods:
+                    if not np.isnan(outputs[method][start:stop]).any():
+                        scores[method] = outputs[method][start:stop]
+
+            self.output_caches[cache_key] = OutputCache.from_arrays(
+                model, distribution, split, outputs['id'][start:stop],
+                outputs['sentence'][start:stop], output_targets,
+                outputs['failure_mode'][start:stop],
+                prob_offsets-prob_offsets[0],
+                outputs['probabilities'][prob_range],
+                det_offsets-det_offsets[0], outputs['detections'][det_range],
+                self.targets['boxes'][self._target_rows(output_targets)],
+                ious, argmax_correct, scores)
+
+        return self.output_caches[cache_key]
+
+    def _target_rows(self, target_ids):
+        """Finds the rows of targets in the targets table.
+
+        args:
+            target_ids: the database IDs of the targets.
+
+        returns:
+            the row of every target.
+        """
+        return np.searchsorted(self.targets['id'], target_ids)
+
+    def _text(self, table, name, row):
+        """Decodes one value of a text column.
+
+        args:
+            table: the table, e.g. self.sentences.
+            name: the name of the column.
+            row: the row of the value.
+
+        returns:
+            the string.
+        """
+        offsets = table[f"{name}_offsets"]
+        return table[name][offsets[row]:offsets[row+1]].tobytes().decode(
+            errors='ignore')
+
+    def get_all_targets(self, network, split, obj_src):
+        """Gets all the target ids for a network and split
+
+        Args:
+            network: the network architecture.
+            split: the data split.
+            obj_src: are the objects from ground truth or det?
+
+        Returns:
+            a list of target ids corresponding to the inputs.
+        """
+        model_id = self.get_model_ids(network, obj_src)[0]
+        start, stop = self.get_slice(model_id, 1, split)
+
+        return np.unique(self.outputs['target'][start:stop]).tolist()
+
+    def get_sentence_text(self, sentence_id):
+        """Retrieves the text corresponding to a sentence_id
+
+        args:
+            sentence_id: the sentence id in the database.
+
+        returns:
+            the text (column phrase) corresponding to that id.
+        """
+        row = np.searchsorted(self.sentences['id'], sentence_id)
+        return self._text(self.sentences, "phrase", row)
+
+    def get_image_loc_and_target_loc(self, target_id):
+        """Gets the image location and target bbox from the target id
+
+        args:
+            target_id: the target id
+
+        returns:
+            dict with keys tlx, tly, brx, bry, image_loc.
+        """
+        row = self._target_rows(target_id)
+        box = self.targets['boxes'][row]
+        return {'id': target_id, 'tlx': box[0], 'tly': box[1],
+                'brx': box[2], 'bry': box[3],
+                'image_loc': self._text(self.targets, "image_loc", row)}
+
+    def get_all_re_by_target(self, target, model, distribution, split):
+        """Gets all the referring expressions corresponding to a target.
+
+        args:
+            target: the target id in the database
+            model: the id in the model table
+            distribution: the distribution that is used
+            split: the split
+
+        returns:
+            detections, probabilities, failure mode, and sentence.
+        """
+        cache = self.get_output_cache(model, distribution, split)
+        if target not in cache.target_to_idx:
+            return []
+        target_idx = cache.target_to_idx[target]
+
+        results = []
+        for output_idx in range(cache.target_offsets[target_idx],
+                                cache.target_offsets[target_idx+1]):
+            results.append(
+                {'detections': cache.detections(output_idx),
+                 'probabilities': cache.probabilities(output_idx),
+                 'failure_mode': int(cache.failure_modes[output_idx]),
+                 'sentence': int(cache.sentence_ids[output_idx])})
+
+        return results
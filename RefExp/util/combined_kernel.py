@@ -0,0 +1,201 @@
+"""Compiled kernel for trials of combined replacement.
+
+Combined replacement multiplies the distribution of a re-queried target by
+the distribution of its replacement, renormalizes, and re-scores it. This runs
+a whole trial of that natively, from flat arrays, using numba if it is
+installed (and as plain Python if not). The distributions are kept as log
+probabilities, so repeated products don't underflow.
+
+The trial consumes its seed stream exactly as simulation.run_trial does (one
+uniform per re-query), so it follows the same re-queries and gives the same
+error curve. Scores are computed in float64 rather than float32, so targets
+whose scores differ by less than float32 precision may be re-queried in a
+different order.
+
+Typical usage:
+    errors, rmaes = run_trial_combined(cache, output_idx, uniforms,
+                                       "entropy", "combined_3", failure_ids)
+"""
+import numpy as np
+
+try:
+    from numba import njit
+    numba_available = True
+except ImportError:
+    numba_available = False
+
+    def njit(*args, **kwargs):
+        """Runs the kernel as plain Python when numba isn't installed."""
+        return lambda function: function
+
+def supports_kernel(replacement_method):
+    """Checks whether a replacement method can run in the kernel.
+
+    args:
+        replacement_method: e.g. naive_3, combined_3.
+
+    returns:
+        True if run_trial_combined supports it.
+    """
+    return replacement_method.split("_")[0] == "combined"
+
+@njit(cache=True)
+def _normalize_and_score(log_probs, use_entropy):
+    """Normalizes log probabilities in place, and scores the distribution.
+
+    args:
+        log_probs: the log probabilities of one distribution.
+        use_entropy: score with entropy if True, and sr if False.
+
+    returns:
+        the rejection score, as calc_rejection_score would give it.
+    """
+    max_log_prob = log_probs.max()
+    if max_log_prob == -np.inf:
+        return np.nan
+    total = 0.
+    for i in range(log_probs.shape[0]):
+        total += np.exp(log_probs[i]-max_log_prob)
+    log_total = max_log_prob+np.log(total)
+    score = 0.
+    for i in range(log_probs.shape[0]):
+        log_probs[i] -= log_total
+        if use_entropy and log_probs[i] > -np.inf:
+            score -= np.exp(log_probs[i])*log_probs[i]
+    if not use_entropy:
+        score = -np.exp(log_probs.max())
+    return score
+
+@njit(cache=True)
+def _combined_trial(prob_offsets, prob_buffer, det_offsets, iou_buffer,
+                    target_offsets, output_idx, target_idx, scores,
+                    failure_modes, uniforms, max_depth, use_entropy,
+                    correct_idx, missed_detection_idx, undefined_idx, errors,
+                    rmaes):
+    """Runs one trial of combined replacement, until the DDC is reached.
+
+    args:
+        prob_offsets, prob_buffer: every distribution of the cache.
+        det_offsets, iou_buffer: every detection IoU of the cache.
+        target_offsets: the outputs of target t are rows target_offsets[t]
+            to target_offsets[t+1] of the cache.
+        output_idx: the output row of the initial draw, one per target.
+        target_idx: the cache target of every output in output_idx.
+        scores: the initial rejection score of every target. Updated.
+        failure_modes: the initial failure mode of every target. Updated.
+        uniforms: the uniform used to pick the replacement at every step.
+        max_depth: the DDC.
+        use_entropy: score with entropy if True, and sr if False.
+        correct_idx, missed_detection_idx, undefined_idx: failure mode IDs.
+        errors, rmaes: filled with the error and rmae at every step.
+    """
+    num_targets = output_idx.shape[0]
+
+    # The log probabilities of every target in the draw, in one buffer.
+    offsets = np.zeros(num_targets+1, dtype=np.int64)
+    for target in range(num_targets):
+        output = output_idx[target]
+        offsets[target+1] = offsets[target]+(
+            prob_offsets[output+1]-prob_offsets[output])
+    log_probs = np.empty(offsets[num_targets])
+    for target in range(num_targets):
+        start = prob_offsets[output_idx[target]]
+        for i in range(offsets[target+1]-offsets[target]):
+            log_probs[offsets[target]+i] = np.log(
+                np.float64(prob_buffer[start+i]))
+
+    rq_counts = np.zeros(num_targets, dtype=np.int64)
+    num_incorrect = 0
+    num_rmae = 0
+    for target in range(num_targets):
+        if failure_modes[target] != correct_idx:
+            num_incorrect += 1
+            if failure_modes[target] != missed_detection_idx:
+                num_rmae += 1
+
+    for step in range(num_targets):
+        errors[step] = num_incorrect/num_targets
+        rmaes[step] = num_rmae/num_targets
+
+        # Re-query the target with the highest score.
+        to_requery = np.argmax(scores)
+        rq_counts[to_requery] += 1
+        first_output = target_offsets[target_idx[to_requery]]
+        count = target_offsets[target_idx[to_requery]+1]-first_output
+        replacement = first_output+np.int64(uniforms[step]*count)
+
+        # Multiply in the replacement's distribution, then renormalize.
+        target_log_probs = log_probs[
+            offsets[to_requery]:offsets[to_requery+1]]
+        start = prob_offsets[replacement]
+        for i in range(target_log_probs.shape[0]):
+            target_log_probs[i] += np.log(np.float64(prob_buffer[start+i]))
+        score = _normalize_and_score(target_log_probs, use_entropy)
+        if rq_counts[to_requery] >= max_depth:
+            scores[to_requery] = -1e6
+        else:
+            scores[to_requery] = score
+
+        # Correct if the new argmax overlaps the target. If not, either leave
+        # as missed detection, or set to undefined.
+        previous = failure_modes[to_requery]
+        new = previous
+        guess = np.argmax(target_log_probs)
+        if iou_buffer[det_offsets[replacement]+guess] >= 0.5:
+            new = correct_idx
+        elif previous != missed_detection_idx:
+            new = undefined_idx
+        if previous != correct_idx:
+            num_incorrect -= 1
+            if previous != missed_detection_idx:
+                num_rmae -= 1
+        if new != correct_idx:
+            num_incorrect += 1
+            if new != missed_detection_idx:
+                num_rmae += 1
+        failure_modes[to_requery] = new
+
+    errors[num_targets] = num_incorrect/num_targets
+    rmaes[num_targets] = num_rmae/num_targets
+
+def run_trial_combined(cache, output_idx, uniforms, scoring_method,
+                       replacement_method, failure_ids):
+    """Runs a single trial of combined replacement in the kernel.
+
+    args:
+        cache: the OutputCache for the trial's model, distribution, and split.
+        output_idx: the output rows of the initial draw, one per target.
+        uniforms: one uniform in [0, 1) per target, used in turn to pick the
+            replacement at every re-query.
+        scoring_method: the scoring function applied to the distribution.
+        replacement_method: combined_[DDC].
+        failure_ids: dict from failure mode name to database ID.
+
+    returns:
+        the error and the rmae at every number of re-queries, as two arrays
+        of length targets+1.
+    """
+    output_idx = np.asarray(output_idx, dtype=np.int64)
+    num_targets = output_idx.shape[0]
+    errors = np.zeros(num_targets+1)
+    rmaes = np.zeros(num_targets+1)
+
+    # The kernel looks replacements up by target, so map each output row
+    # to the row range of its target.
+    target_idx = np.searchsorted(
+        cache.target_offsets, output_idx, side="right")-1
+
+    # Zero probabilities are -inf in log space.
+    with np.errstate(divide="ignore"):
+        _combined_trial(
+            cache.prob_offsets, cache.prob_buffer, cache.det_offsets,
+            cache.ious, cache.target_offsets, output_idx, target_idx,
+            cache.scores[scoring_method][output_idx].astype(np.float64),
+            cache.failure_modes[output_idx].copy(),
+            np.asarray(uniforms, dtype=np.float64),
+            int(replacement_method.split("_")[-1]),
+            scoring_method == "entropy",
+            failure_ids['correct'], failure_ids['missed_detection'],
+            failure_ids['undefined'], errors, rmaes)
+
+    return errors, rmaes
@@ -0,0 +1,159 @@
+"""Converged accuracy of every fusion method, with segment reductions.
+
+The converged guess for a target fuses the distributions of every output for
+that target. Rather than looping over targets and outputs, every output of a
+slice is handled at once on the ragged buffers of an OutputCache: all
+outputs of a target share a length, so element k of every output of target
+t falls in slot k of that target, and each fusion is a reduction into the
+slots of the slice.
+
+    combined: sum of log probabilities (a product that can't underflow).
+        This is float64 rather than the original float32 product, so exact
+        ties can in principle break differently.
+    mean: sum of probabilities, accumulated in float32 one output at a time,
+        in output order, as the original loop did. Variation ratios are
+        discrete fractions, so exact ties between slots are common, and the
+        rounding of that sum decides which one wins.
+    consensus: count of each output's argmax
+    smart: the output with the lowest entropy; the first output wins ties,
+        and keeps its place if its entropy is NaN, as in the original loop
+
+A target is correct if the IoU of the guess, among the detections of its
+first output, is over 0.5.
+
+Typical usage:
+    accuracies = get_converged_accuracies(cache, varratio=False)
+    every_slice = get_all_converged_accuracies(dbo)
+"""
+import numpy as np
+from util.calculation_utils import segment_argmax
+
+# Every fusion method of get_converged_accuracies.
+fusion_methods = ["combined", "mean", "consensus", "smart"]
+
+def get_converged_guesses(cache, varratio=False):
+    """Finds the converged guess of every target, for every fusion method.
+
+    args:
+        cache: the OutputCache of a slice.
+        varratio: whether the distribution is a variation ratio. 1e-6 is
+            added to each target's first distribution, to prevent zeros.
+
+    returns:
+        a dict from fusion method to an array with the index of the guess,
+        within the target's distributions, for every target.
+    """
+    target_offsets = np.asarray(cache.target_offsets)
+    prob_offsets = np.asarray(cache.prob_offsets)
+    raw_probabilities = np.asarray(cache.prob_buffer, dtype=np.float32)
+    probabilities = raw_probabilities.astype(np.float64)
+    num_outputs = prob_offsets.shape[0]-1
+    counts = np.diff(target_offsets)
+    output_targets = np.repeat(np.arange(counts.shape[0]), counts)
+    first_outputs = target_offsets[:-1]
+
+    # Every output of a target must be the same length to be fused.
+    lengths = np.diff(prob_offsets)
+    target_lengths = lengths[first_outputs]
+    if not np.array_equal(lengths, target_lengths[output_targets]):
+        raise ValueError("Outputs of a target have distributions of "\
+                         "different lengths")
+    slot_offsets = np.zeros(counts.shape[0]+1, dtype=np.int64)
+    np.cumsum(target_lengths, out=slot_offsets[1:])
+
+    # The slot of every probability.
+    element_outputs = np.repeat(np.arange(num_outputs), lengths)
+    slots = slot_offsets[output_targets[element_outputs]]+\
+            np.arange(probabilities.shape[0])-prob_offsets[element_outputs]
+
+    if varratio:
+        is_first = np.zeros(num_outputs, dtype=bool)
+        is_first[first_outputs] = True
+        raw_probabilities = raw_probabilities.copy()
+        raw_probabilities[is_first[element_outputs]] += np.float32(1e-6)
+        probabilities[is_first[element_outputs]] += 1e-6
+
+    guesses = {}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_sums = np.bincount(slots, weights=np.log(probabilities),
+                               minlength=slot_offsets[-1])
+        guesses['combined'] = segment_argmax(log_sums, slot_offsets)
+
+        # np.add.at is unbuffered, so each slot is summed in buffer (output)
+        # order, rounding to float32 after every addition.
+        sums = np.zeros(slot_offsets[-1], dtype=np.float32)
+        np.add.at(sums, slots, raw_probabilities)
+        guesses['mean'] = segment_argmax(sums, slot_offsets)
+
+        output_guesses = segment_argmax(probabilities, prob_offsets)
+        votes = np.bincount(slot_offsets[output_targets]+output_guesses,
+                            minlength=slot_offsets[-1])
+        guesses['consensus'] = segment_argmax(votes.astype(np.float64),
+                                              slot_offsets)
+
+        # Entropies without an epsilon, so zeros give NaN as they did.
+        entropies = -np.bincount(
+            element_outputs, weights=probabilities*np.log(probabilities),
+            minlength=num_outputs)
+    # A later output only replaces the current one with a strictly lower
+    # entropy, so the first minimum wins, outputs with NaN entropy are never
+    # picked, and a first output with NaN entropy is never replaced.
+    keys = np.where(np.isnan(entropies), np.inf, entropies)
+    keys[first_outputs[np.isnan(entropies[first_outputs])]] = -np.inf
+    chosen = first_outputs+segment_argmax(-keys, target_offsets)
+    guesses['smart'] = output_guesses[chosen]
+
+    return guesses
+
+def get_converged_accuracies(cache, varratio=False):
+    """Gets the converged accuracy of a slice, for every fusion method.
+
+    args:
+        cache: the OutputCache of a slice.
+        varratio: whether the distribution is a variation ratio.
+
+    returns:
+        a dict from fusion method to accuracy, which is -1 if the slice has
+        no outputs.
+    """
+    if cache.num_targets == 0:
+        return {method: -1 for method in fusion_methods}
+
+    guesses = get_converged_guesses(cache, varratio)
+    first_detections = np.asarray(cache.det_offsets)[
+        np.asarray(cache.target_offsets)[:-1]]
+    ious = np.asarray(cache.ious)
+    return {method: (ious[first_detections+guesses[method]] > 0.5).mean()
+            for method in fusion_methods}
+
+def get_all_converged_accuracies(dbo, models=None, distributions=None,
+                                 splits=("val", "testA", "testB")):
+    """Gets the converged accuracy of many slices, for every fusion method.
+
+    args:
+        dbo: a DatabaseObject or ColumnarObject.
+        models: model IDs. Defaults to every model.
+        distributions: distribution IDs. Defaults to every distribution.
+        splits: the splits.
+
+    returns:
+        a dict from (model, distribution, split) to the output of
+        get_converged_accuracies. Slices without outputs are left out.
+    """
+    if models is None:
+        models = sorted(model for group in dbo.get_model_groups().values()
+                        for model in group)
+    if distributions is None:
+        distributions = sorted(dbo.idx_to_distribution_dict)
+
+    accuracies = {}
+    for model in models:
+        for distribution in distributions:
+            varratio = "varratio" in dbo.idx_to_distribution_dict[distribution]
+            for split in splits:
+                cache = dbo.get_output_cache(model, distribution, split)
+                if cache.num_targets == 0:
+                    continue
+                accuracies[(model, distribution, split)] =\
+                        get_converged_accuracies(cache, varratio)
+    return accuracies
@@ -4,15 +4,186 @@ import random
 import numpy as np
 from PIL import Image, ImageDraw
 import matplotlib.pyplot as plt
-from util import calculation_utils
+from util import converged_accuracy
 
 coco_dir = "/z/dat/mscoco/images/train2014/"
 
+# How many draw tables (see get_draw_table) to keep on a connection, and
+# roughly how many bytes they may hold together. None for no limit. The
+# least recently used tables are dropped once over either.
+max_draw_tables = 4
+max_draw_table_bytes = None
+
+def get_draw_table(model, distribution, split, cur):
+    """Gets the joined outputs, sentences, and targets for one slice.
+
+    The table is built the first time it is needed on this connection, and
+    kept for later calls until invalidate_draw_tables drops it, or it is the
+    least recently used once over max_draw_tables or max_draw_table_bytes.
+    Usage and sizes are tracked in temp.draw_table_usage. It is indexed by
+    target, so looking up the outputs for a target doesn't scan the slice.
+
+    args:
+        model: Database ID of the model.
+        distribution: Database ID of the distribution.
+        split: the split. Val, testA, or testB.
+        cur: the DB cursor.
+
+    returns:
+        the name of the table, with columns tlx, tly, brx, bry,
+        outputs_detections, outputs_probabilities, sentence_target,
+        outputs_sentence, outputs_failure_mode.
+    """
+    if not str(split).isalnum():
+        raise ValueError(f"Invalid split {split}")
+    table_name = f"drawtable_{int(model)}_{int(distribution)}_{split}"
+
+    query = "CREATE TEMPORARY TABLE IF NOT EXISTS draw_table_usage (name "\
+            "TEXT PRIMARY KEY, last_used INTEGER, bytes INTEGER)"
+    cur.execute(query)
+    query = "SELECT COALESCE(MAX(last_used), 0)+1 FROM temp.draw_table_usage"
+    cur.execute(query)
+    last_used = cur.fetchone()[0]
+
+    query = "SELECT name FROM sqlite_temp_master WHERE type='table' AND "\
+            "name=?"
+    cur.execute(query, (table_name,))
+    if len(cur.fetchall()) == 0:
+        # One join, rather than building and joining an intermediate table.
+        query = f"CREATE TEMPORARY TABLE {table_name} AS SELECT "\
+                "targets.tlx AS tlx, targets.tly AS tly, targets.brx AS brx, "\
+                "targets.bry AS bry, outputs.detections AS "\
+                "outputs_detections, outputs.probabilities AS "\
+                "outputs_probabilities, sentences.target AS sentence_target, "\
+                "outputs.sentence AS outputs_sentence, outputs.failure_mode "\
+                "AS outputs_failure_mode FROM outputs JOIN sentences ON "\
+                "sentences.id=outputs.sentence JOIN targets ON "\
+                "targets.id=sentences.target WHERE outputs.model=? AND "\
+                "outputs.distribution=? AND outputs.split=?"
+        cur.execute(query, (model, distribution, split))
+        query = f"CREATE INDEX temp.index_{table_name} ON {table_name} "\
+                "(sentence_target)"
+        cur.execute(query)
+
+        # Blobs dominate the size. Count the other columns too.
+        query = "SELECT TOTAL(LENGTH(outputs_detections)+"\
+                "LENGTH(outputs_probabilities))+COUNT(*)*64 FROM "\
+                f"temp.{table_name}"
+        cur.execute(query)
+        query = "INSERT OR REPLACE INTO temp.draw_table_usage(name, "\
+                "last_used, bytes) VALUES (?, ?, ?)"
+        cur.execute(query, (table_name, last_used, int(cur.fetchone()[0])))
+        evict_draw_tables(cur)
+    else:
+        query = "UPDATE temp.draw_table_usage SET last_used=? WHERE name=?"
+        cur.execute(query, (last_used, table_name))
+
+    return f"temp.{table_name}"
+
+def evict_draw_tables(cur):
+    """Drops the least recently used draw tables until within
+    max_draw_tables and max_draw_table_bytes.
+
+    The most recently used table is always kept.
+
+    args:
+        cur: the DB cursor.
+    """
+    query = "SELECT name, bytes FROM temp.draw_table_usage ORDER BY last_used"
+    cur.execute(query)
+    usage = [(row[0], row[1]) for row in cur.fetchall()]
+    total_bytes = sum(table_bytes for _, table_bytes in usage)
+    while len(usage) > 1 and (
+            (max_draw_tables is not None and len(usage) > max_draw_tables) or
+            (max_draw_table_bytes is not None and
+             total_bytes > max_draw_table_bytes)):
+        table_name, table_bytes = usage.pop(0)
+        total_bytes -= table_bytes
+        drop_draw_table(table_name, cur)
+
+def drop_draw_table(table_name, cur):
+    """Drops a draw table, its usage row, and temp.temptable if it is a view
+    of the table.
+
+    args:
+        table_name: the name of the draw table, without temp.
+        cur: the DB cursor.
+    """
+    query = "SELECT sql FROM sqlite_temp_master WHERE name='temptable'"\
+            " AND type='view'"
+    cur.execute(query)
+    view = cur.fetchall()
+    if len(view) > 0 and view[0][0].endswith(f"temp.{table_name}"):
+        drop_temptable("temptable", cur)
+    cur.execute(f"DROP TABLE IF EXISTS temp.{table_name}")
+    query = "SELECT name FROM sqlite_temp_master WHERE type='table' AND "\
+            "name='draw_table_usage'"
+    cur.execute(query)
+    if len(cur.fetchall()) > 0:
+        cur.execute("DELETE FROM temp.draw_table_usage WHERE name=?",
+                    (table_name,))
+
+def drop_temptable(name, cur):
+    """Drops temp.[name], whether it is a table or a view.
+
+    args:
+        name: the name of the temp table or view.
+        cur: the DB cursor.
+    """
+    query = "SELECT type FROM sqlite_temp_master WHERE name=?"
+    cur.execute(query, (name,))
+    for row in cur.fetchall():
+        if row[0] == "view":
+            cur.execute(f"DROP VIEW IF EXISTS temp.{name}")
+        elif row[0] == "table":
+            cur.execute(f"DROP TABLE IF EXISTS temp.{name}")
+
+def use_draw_table(model, distribution, split, cur):
+    """Points temp.temptable at the draw table for one slice.
+
+    temp.temptable becomes a view of the draw table, so the functions that
+    read temp.temptable (e.g. get_re_by_target) read that slice.
+
+    args:
+        model: Database ID of the model.
+        distribution: Database ID of the distribution.
+        split: the split. Val, testA, or testB.
+        cur: the DB cursor.
+    """
+    table_name = get_draw_table(model, distribution, split, cur)
+    drop_temptable("temptable", cur)
+    cur.execute(f"CREATE TEMPORARY VIEW temptable AS SELECT * FROM "\
+                f"{table_name}")
+
+def invalidate_draw_tables(cur, model=None, distribution=None, split=None):
+    """Drops cached draw tables, so they are rebuilt from the database.
+
+    Call this after changing outputs, sentences, or targets. If temp.temptable
+    is a view of a dropped table, it is dropped too.
+
+    args:
+        cur: the DB cursor.
+        model: only drop the tables of this model ID, if given.
+        distribution: only drop the tables of this distribution ID, if given.
+        split: only drop the tables of this split, if given.
+    """
+    query = "SELECT name FROM sqlite_temp_master WHERE type='table' AND "\
+            "name LIKE 'drawtable_%'"
+    cur.execute(query)
+    for row in cur.fetchall():
+        _, table_model, table_distribution, table_split = row[0].split("_", 3)
+        if (model is None or int(table_model) == model) and\
+                (distribution is None or
+                 int(table_distribution) == distribution) and\
+                (split is None or table_split == split):
+            drop_draw_table(row[0], cur)
+
 def get_all_re_by_target_notemp(target_id, model, distribution, split, cur):
     """Gets all of the model outputs corresponding to the target id.
 
     This is different from get_all_re_by_target in that it does not reference
-    temp.temptable (which may not reference the right model and dist). This
+    temp.temptable (which may not reference the right model and dist). It
+    reads the cached draw table of the slice (see get_draw_table). This
     will be deprecated when everything is running through util.database_object
 
     args:
@@ -25,40 +196,12 @@ def get_all_re_by_target_notemp(target_id, model, distribution, split, cur):
     Returns:
         A list containing all responses matching the target/network.
     """
-    # Setting up the appropriate temporary table is many many times faster.
-    query = "DROP TABLE IF EXISTS temp.temptable2_join1"
-    cur.execute(query)
-    query = "DROP TABLE IF EXISTS temp.temptable2"
-    cur.execute(query)
-
-    # Setting up the appropriate temporary table is many many times faster.
-    query = "CREATE TEMPORARY TABLE IF NOT EXISTS temp.temptable2_join1"\
-            "AS SELECT outputs.detections AS outputs_detections,"\
-            " outputs.probabilities AS outputs_probabilities, "\
-            "sentences.target as sentence_target, "\
-            "outputs.sentence AS outputs_sentence, "\
-            "outputs.failure_mode AS outputs_failure_mode FROM "\
-            "outputs JOIN sentences on sentences.id=outputs.sentence "\
-            "WHERE outputs.model=? AND outputs.distribution=? AND "\
-            "outputs.split=?"
-    cur.execute(query, (model, distribution, split))
-
-    query = "CREATE TEMPORARY TABLE IF NOT EXISTS temp.temptable2 "\
-            "AS SELECT targets.tlx AS tlx, targets.tly AS tly, targets.brx "\
-            "AS brx, targets.bry AS bry, "\
-            "temp.temptable2_join1.outputs_detections AS outputs_detections, "\
-            "temp.temptable2_join1.outputs_probabilities AS "\
-            "outputs_probabilities, temp.temptable2_join1.sentence_target "\
-            "as sentence_target, temp.temptable2_join1.outputs_sentence AS "\
-            "outputs_sentence, temp.temptable2_join1.outputs_failure_mode AS "\
-            "outputs_failure_mode FROM temp.temptable2_join1 JOIN targets "\
-            "on temp.temptable2_join1.sentence_target = targets.id"
-    cur.execute(query)
+    table_name = get_draw_table(model, distribution, split, cur)
 
     query = "SELECT outputs_sentence, outputs_failure_mode, "\
             "outputs_probabilities AS 'probabilities [probabilities]', "\
             "outputs_detections AS 'detections [detections]', tlx, tly, "\
-            "brx, bry FROM temp.temptable2 WHERE sentence_target=?"
+            f"brx, bry FROM {table_name} WHERE sentence_target=?"
     cur.execute(query, (target_id,))
     response = cur.fetchall()
     if len(response) == 0:
@@ -71,7 +214,8 @@ def get_re_by_target_notemp(target_id, model, distribution, split, cur):
     the temp table.
 
     This is different from get_re_by_target in that it does not reference
-    temp.temptable (which may not reference the right model and dist). This
+    temp.temptable (which may not reference the right model and dist). It
+    reads the cached draw table of the slice (see get_draw_table). This
     will be deprecated when everything is running through util.database_object
 
     args:
@@ -84,41 +228,12 @@ def get_re_by_target_notemp(target_id, model, distribution, split, cur):
     Returns:
         A randomly chosen response matching the target/network.
     """
-    # Setting up the appropriate temporary table is many many times faster.
-    # Speed doesn't matter so much here, but creating these tables makes
-    # the queries more readable.
-    query = "DROP TABLE IF EXISTS temp.temptable2_join1"
-    cur.execute(query)
-    query = "DROP TABLE IF EXISTS temp.temptable2"
-    cur.execute(query)
-
-    query = "CREATE TEMPORARY TABLE IF NOT EXISTS temp.temptable2_join1 "\
-            "AS SELECT outputs.detections AS outputs_detections, "\
-            "outputs.probabilities AS outputs_probabilities, "\
-            "sentences.target as sentence_target, outputs.sentence "\
-            "AS outputs_sentence, outputs.failure_mode AS "\
-            "outputs_failure_mode FROM outputs JOIN sentences on "\
-            "sentences.id=outputs.sentence WHERE outputs.model=? AND "\
-            "outputs.distribution=? AND outputs.split=?"
-    cur.execute(query, (model, distribution, split))
-
-    query = "CREATE TEMPORARY TABLE IF NOT EXISTS temp.temptable2 AS "\
-            "SELECT targets.tlx AS tlx, targets.tly AS tly, targets.brx "\
-            "AS brx, targets.bry AS bry, "\
-            "temp.temptable2_join1.outputs_detections AS "\
-            "outputs_detections, "\
-            "temp.temptable2_join1.outputs_probabilities AS "\
-            "outputs_probabilities, temp.temptable2_join1.sentence_target "\
-            "as sentence_target, temp.temptable2_join1.outputs_sentence AS "\
-            "outputs_sentence, temp.temptable2_join1.outputs_failure_mode "\
-            "AS outputs_failure_mode FROM temp.temptable2_join1 JOIN "\
-            "targets on temp.temptable2_join1.sentence_target = targets.id"
-    cur.execute(query)
+    table_name = get_draw_table(model, distribution, split, cur)
 
     query = "SELECT outputs_sentence, outputs_failure_mode, "\
             "outputs_probabilities AS 'probabilities [probabilities]', "\
             "outputs_detections AS 'detections [detections]', tlx, tly, "\
-            "brx, bry FROM temp.temptable2 WHERE sentence_target=?"
+            f"brx, bry FROM {table_name} WHERE sentence_target=?"
     cur.execute(query, (target_id,))
     response = cur.fetchall()
     if len(response) == 0:
@@ -181,106 +296,27 @@ def get_converged_accuracy(model, distribution, split, cur, method="combined"):
     """Gets the converged accuracy for a model, distribution, and split.
 
     In this case, the converged guess is simply the guess produced by the
-    product of the distributions produced by all refexps.
+    product of the distributions produced by all refexps. The slice is
+    loaded into an OutputCache, and fused with the segment reductions of
+    converged_accuracy.py.
 
     Args:
         model: the model ID
         distribution: which distribution we're using
         split: val, testA, testB
         cur: the cursor
-        method: combined or mean
+        method: combined, mean, consensus, or smart
 
     Returns:
         The converged accuracy of that model, split, and distribution.
     """
+    # Imported here, as output_cache imports this module.
+    from util.output_cache import OutputCache
 
-    # This temptable makes it easier to get the right info.
-    query = "DROP TABLE IF EXISTS temp.temptable_join1"
-    cur.execute(query)
-    query = "DROP TABLE IF EXISTS temp.temptable"
-    cur.execute(query)
-
-    query = "CREATE TEMPORARY TABLE IF NOT EXISTS temp.temptable_join1 "\
-            "AS SELECT outputs.detections AS outputs_detections, "\
-            "outputs.probabilities AS outputs_probabilities, "\
-            "sentences.target as sentence_target, outputs.sentence AS "\
-            "outputs_sentence, outputs.failure_mode AS outputs_failure_mode "\
-            "FROM outputs JOIN sentences on sentences.id=outputs.sentence "\
-            "WHERE outputs.model=? AND outputs.distribution=? AND "\
-            "outputs.split=?"
-    cur.execute(query, (model, distribution, split))
-
-    query = "CREATE TEMPORARY TABLE IF NOT EXISTS temp.temptable AS SELECT "\
-            "targets.tlx AS tlx, targets.tly AS tly, targets.brx AS brx, "\
-            "targets.bry AS bry, temp.temptable_join1.outputs_detections AS "\
-            "outputs_detections, temp.temptable_join1.outputs_probabilities "\
-            "AS outputs_probabilities, temp.temptable_join1.sentence_target "\
-            "as sentence_target, temp.temptable_join1.outputs_sentence AS "\
-            "outputs_sentence, temp.temptable_join1.outputs_failure_mode AS "\
-            "outputs_failure_mode FROM temp.temptable_join1 JOIN targets on "\
-            "temp.temptable_join1.sentence_target = targets.id"
-    cur.execute(query)
-
-    # Get all of the targets
-    query = "SELECT DISTINCT sentence_target FROM temp.temptable"
-    cur.execute(query)
-    targets = cur.fetchall()
-
-    if len(targets) == 0:
-        return -1
+    cache = OutputCache(cur, model, distribution, split)
     distribution_dict = get_distribution_dict(cur)
-
-    # Loop through all the targets, and track how many end up being correct.
-    correct = 0
-    total = 0
-    for target in targets:
-        target_reduced = target[0]
-        # get every output for this target/model.
-        all_targets = get_all_re_by_target(target_reduced, cur)
-
-        # Find the product of all targets.
-        # For variation ratio, add a small value to prevent zero arrays.
-        if method != "consensus":
-            probability_product = all_targets[0]['probabilities'].copy()
-        else:
-            probability_product = np.zeros(all_targets[0]['probabilities'].shape)
-            probability_product[all_targets[0]['probabilities'].argmax()] += 1
-
-        if "varratio" in distribution_dict[distribution]:
-            probability_product += 1e-6
-        for i in range(1, len(all_targets)):
-            if method == "mean":
-                probability_product = probability_product+all_targets[i]['probabilities']
-            elif method == "combined":
-                probability_product = probability_product*all_targets[i]['probabilities']
-            elif method == "consensus":
-                probability_product[all_targets[i]['probabilities'].argmax()] += 1
-            elif method == "smart":
-                prev_entropy = -(probability_product*np.log(probability_product)).sum()
-                cur_entropy = -(all_targets[i]['probabilities']*np.log(
-                    all_targets[i]['probabilities'])).sum()
-
-                if cur_entropy < prev_entropy:
-                    probability_product = all_targets[i]['probabilities']
-
-        # Find the guess.
-        guess = probability_product.argmax()
-
-        # Figure out whether or not it's correct.
-        # Start by getting the detected bboxes.
-        converted_boxes = convert_boxes_to_corners(
-            all_targets[0]['detections'])
-        # Then calculate the IoUs with the ground truth.
-        ious = calculation_utils.compute_all_IoUs(
-            (all_targets[0]['tlx'], all_targets[0]['tly'],
-             all_targets[0]['brx'], all_targets[0]['bry']), converted_boxes)
-
-        if ious[guess] > 0.5:
-            correct += 1
-        total += 1
-
-    # Return the accuracy.
-    return correct*1.0/total
+    return converged_accuracy.get_converged_accuracies(
+        cache, "varratio" in distribution_dict[distribution])[method]
 
 def get_random_draw(model, distribution, split, cur):
     """Draws one referring expression for every object.
@@ -296,32 +332,9 @@ def get_random_draw(model, distribution, split, cur):
         detections respectively.
     """
 
-    query = "DROP TABLE IF EXISTS temp.temptable_join1"
-    cur.execute(query)
-    query = "DROP TABLE IF EXISTS temp.temptable"
-    cur.execute(query)
-
-    # Setting up the appropriate temporary table is many many times faster.
-    query = "CREATE TEMPORARY TABLE IF NOT EXISTS temp.temptable_join1 "\
-            "AS SELECT outputs.detections AS outputs_detections, "\
-            "outputs.probabilities AS outputs_probabilities, "\
-            "sentences.target as sentence_target, outputs.sentence AS "\
-            "outputs_sentence, outputs.failure_mode AS outputs_failure_mode "\
-            "FROM outputs JOIN sentences on sentences.id=outputs.sentence "\
-            "WHERE outputs.model=? AND outputs.distribution=? AND "\
-            "outputs.split=?"
-    cur.execute(query, (model, distribution, split))
-
-    query = "CREATE TEMPORARY TABLE IF NOT EXISTS temp.temptable AS SELECT "\
-            "targets.tlx AS tlx, targets.tly AS tly, targets.brx AS brx, "\
-            "targets.bry AS bry, temp.temptable_join1.outputs_detections AS "\
-            "outputs_detections, temp.temptable_join1.outputs_probabilities "\
-            "AS outputs_probabilities, temp.temptable_join1.sentence_target "\
-            "as sentence_target, temp.temptable_join1.outputs_sentence AS "\
-            "outputs_sentence, temp.temptable_join1.outputs_failure_mode AS "\
-            "outputs_failure_mode FROM temp.temptable_join1 JOIN targets on "\
-            "temp.temptable_join1.sentence_target = targets.id"
-    cur.execute(query)
+    # Point temp.temptable at this slice. The joined slice is only built the
+    # first time, and reused by every later draw.
+    use_draw_table(model, distribution, split, cur)
 
     # Get all of the targets
     query = "SELECT DISTINCT sentence_target FROM temp.temptable"
@@ -379,8 +392,8 @@ def get_all_draw(model, distribution, split, cur):
 
     query = "DROP TABLE IF EXISTS temp.temptable_join1"
     cur.execute(query)
-    query = "DROP TABLE IF EXISTS temp.temptable"
-    cur.execute(query)
+    # temp.temptable may be a view from use_draw_table.
+    drop_temptable("temptable", cur)
 
     query = "CREATE TEMPORARY TABLE IF NOT EXISTS temp.temptable_join1 AS "\
             "SELECT outputs.detections AS outputs_detections, "\
@@ -526,6 +539,28 @@ def convert_reshape_array(text):
     #print("---")
     return np.frombuffer(text, dtype=np.float32).reshape(-1, 4)
 
+def convert_ragged_arrays(blobs, width=1):
+    """Converts many bytestrings from the DB to one flat array.
+
+    Batch version of convert_array (width 1) and convert_reshape_array
+    (width 4).
+
+    args:
+        blobs: a list of bytestrings
+        width: how many float32 values make up one item.
+
+    returns:
+        an offsets array, where blob i holds items offsets[i] to
+        offsets[i+1], and a read-only (items, width) array of every item (or
+        a flat array, if width is 1).
+    """
+    offsets = np.zeros(len(blobs)+1, dtype=np.int64)
+    np.cumsum([len(blob)//(4*width) for blob in blobs], out=offsets[1:])
+    buffer = np.frombuffer(b"".join(blobs), dtype=np.float32)
+    if width != 1:
+        buffer = buffer.reshape(-1, width)
+    return offsets, buffer
+
 def get_distribution_dict(cur):
     """Get a dictionary of distributions
 
@@ -612,6 +647,33 @@ def get_outputs_one_run(model, split, distribution, cur):
 
     return cur.fetchall()
 
+def get_targets_and_failure_modes(model, split, distribution, cur):
+    """Gets the target and failure mode of every output of one run, in one
+    query.
+
+        args:
+            model: the id of the target model
+            split: val, testA, testB
+            distribution: softmax, ..., varratio
+            cur: sqlite3 cursor.
+
+        returns:
+            two int64 arrays: the target of every output, and its failure
+            mode.
+    """
+    if isinstance(distribution, str):
+        query = "SELECT id FROM distributions WHERE name=?"
+        cur.execute(query, (distribution,))
+        distribution = cur.fetchall()[0][0]
+    query = "SELECT sentences.target, outputs.failure_mode FROM outputs JOIN "\
+            "sentences ON sentences.id=outputs.sentence WHERE "\
+            "outputs.model=? AND outputs.distribution=? AND outputs.split=?"
+    cur.execute(query, (model, distribution, split))
+    rows = np.array([tuple(row) for row in cur.fetchall()],
+                    dtype=np.int64).reshape(-1, 2)
+
+    return rows[:, 0], rows[:, 1]
+
 def get_target_from_sentence(sentence_id, cur):
     """Gets the target given a sentence id
 
@@ -720,6 +782,52 @@ def add_row_to_detections(model_arch, model_instance, obj_src,
         cur.execute(query, (distribution_type))
         target_distribution_id = cur.fetchall()
 
+def format_phrase(raw):
+    """Collapses a referring expression for the phrase_formatted column.
+
+    args:
+        raw: the raw sentence.
+
+    returns:
+        the sentence, lowercased and without spaces or punctuation.
+    """
+    collapsed_string = raw.lower()
+    collapsed_string = collapsed_string.replace("w/ ","with")
+    for char in [".",",",";"," ","/","'","!","-","?",")",
+               "(",":","&","@","#","$","%","^","*","<",
+               ">","\\","`","~","\""]:
+        collapsed_string = collapsed_string.replace(char, "")
+    return collapsed_string
+
+def get_target_row(dataset_entry, mscoco):
+    """Gets the targets row of a dataset entry.
+
+    args:
+        dataset_entry: an entry from the refs(unc).p list.
+        mscoco: dict from MSCOCO annotation id to bbox (x, y, w, h).
+
+    returns:
+        the values of the row: id, tlx, tly, brx, bry, image_loc.
+    """
+    target = mscoco[dataset_entry['ann_id']]
+    return (dataset_entry['ann_id'], target[0], target[1],
+            target[0]+target[2], target[1]+target[3],
+            dataset_entry["file_name"])
+
+def get_sentence_rows(dataset_entry):
+    """Gets the sentences rows of a dataset entry.
+
+    args:
+        dataset_entry: an entry from the refs(unc).p list.
+
+    returns:
+        a list with the values of each row: id, phrase, phrase_formatted,
+        target.
+    """
+    return [(sentence['sent_id'], sentence['raw'],
+             format_phrase(sentence['raw']), dataset_entry['ann_id'])
+            for sentence in dataset_entry['sentences']]
+
 def add_rows_from_dataset_entry(dataset_entry, mscoco, cur):
     """Adds a row of data from the dataset entry.
 
@@ -741,26 +849,14 @@ def add_rows_from_dataset_entry(dataset_entry, mscoco, cur):
     # the same image.
 
     # Insert the target object into the database.
-    target = mscoco[dataset_entry['ann_id']]
     query_string = "insert into targets(id, tlx, tly, brx, bry, image_loc) "\
             "VALUES (?, ?, ?, ?, ?, ?)"
-    cur.execute(query_string, (dataset_entry['ann_id'], target[0],
-                               target[1], target[0]+target[2],
-                               target[1]+target[3],
-                               dataset_entry["file_name"]))
+    cur.execute(query_string, get_target_row(dataset_entry, mscoco))
 
     # Insert the sentence into the referring expression.
-    for sentence in dataset_entry['sentences']:
-        query_string = "insert into sentences(id, phrase, "\
-                "phrase_formatted, target) VALUES (?, ?, ?, ?)"
-        collapsed_string = sentence['raw'].lower()
-        collapsed_string = collapsed_string.replace("w/ ","with")
-        for char in [".",",",";"," ","/","'","!","-","?",")",
-                   "(",":","&","@","#","$","%","^","*","<",
-                   ">","\\","`","~","\""]:
-            collapsed_string = collapsed_string.replace(char, "")
-        cur.execute(query_string, (sentence['sent_id'], sentence['raw'],
-                                   collapsed_string, dataset_entry['ann_id']))
+    query_string = "insert into sentences(id, phrase, "\
+            "phrase_formatted, target) VALUES (?, ?, ?, ?)"
+    cur.executemany(query_string, get_sentence_rows(dataset_entry))
 
 def get_random_gt_render():
     """Returns the data required to draw a random referring expression.
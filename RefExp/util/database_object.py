@@ -4,12 +4,15 @@ Typical usage:
     database = DatabaseObject()
 """
 import sqlite3
+import time
+from collections import OrderedDict
 import numpy as np
 from util.database_commands import adapt_array, convert_array,\
-        convert_reshape_array,\
+        convert_reshape_array, invalidate_draw_tables,\
         get_failure_mode_dict, get_failure_mode_dict_reversed,\
         get_distribution_dict,\
         get_distribution_dict_reversed
+from util.output_cache import OutputCache
 
 class DatabaseObject():
     """A class that allows for easy access to the database.
@@ -17,35 +20,91 @@ class DatabaseObject():
     Abstracts away a lot of the setup, and holds temporary tables to speed
     up computation.
     """
-    def __init__(self, memory=True):
+    def __init__(self, memory=True, read_only=False, models=None,
+                 distributions=None, splits=None, verbose=True,
+                 max_temp_tables=None, max_temp_table_bytes=None):
         """Connects to the database.
 
+        If any of models, distributions, or splits is given, only the
+        outputs matching all of them (and the sentences, targets, and
+        materialized IoUs and scores they reference) are copied to memory.
+        The small tables are always copied in full.
+
         Args:
             memory: Copy the database to memory (faster, no permanent write)?
+            read_only: If not copying to memory, open the file read-only and
+                serve reads through a memory map.
+            models: model IDs to copy.
+            distributions: distribution IDs or names to copy.
+            splits: splits to copy.
+            verbose: Print how long startup took and the memory it used?
+            max_temp_tables: How many temp tables to keep at once, or None
+                for no limit.
+            max_temp_table_bytes: Roughly how many bytes of temp tables to
+                keep at once, or None for no limit. The draw tables of
+                database_commands.get_draw_table have their own budget,
+                database_commands.max_draw_tables and max_draw_table_bytes.
         """
+        start_time = time.time()
+
         # This will probably be useful in other methods
         self.memory = memory
 
         # We may generate temporary tables to speed up computation.
-        # Track them here.
-        self.temp_tables = {}
+        # Track them here, least recently used first, with their
+        # approximate size in bytes. Once over budget, the least recently
+        # used tables are dropped.
+        self.temp_tables = OrderedDict()
+        self.temp_table_slices = {}
+        self.max_temp_tables = max_temp_tables
+        self.max_temp_table_bytes = max_temp_table_bytes
+        self.temp_table_hits = 0
+        self.temp_table_misses = 0
+        self.temp_table_evictions = 0
 
         # We might generate temporary tables to
         # Connect to the database
         sqlite3.register_adapter(np.ndarray, adapt_array)
         sqlite3.register_converter("detections", convert_reshape_array)
         sqlite3.register_converter("probabilities", convert_array)
-        con_tmp = sqlite3.connect(
-            "data/redatabase.sqlite3", detect_types=sqlite3.PARSE_COLNAMES)
 
         if not memory:
-            self.con = con_tmp
-        else:
+            if read_only:
+                self.con = sqlite3.connect(
+                    "file:data/redatabase.sqlite3?mode=ro", uri=True,
+                    detect_types=sqlite3.PARSE_COLNAMES)
+                # sqlite caps this at its compile-time maximum.
+                self.con.execute(f"PRAGMA mmap_size={2**40}")
+            else:
+                self.con = sqlite3.connect(
+                    "data/redatabase.sqlite3",
+                    detect_types=sqlite3.PARSE_COLNAMES)
+        elif models is None and distributions is None and splits is None:
             # Copy db to memory, for faster access.
+            con_tmp = sqlite3.connect(
+                "data/redatabase.sqlite3", detect_types=sqlite3.PARSE_COLNAMES)
             self.con = sqlite3.connect(
                 ':memory:', detect_types=sqlite3.PARSE_COLNAMES)
             con_tmp.backup(self.con)
             con_tmp.close()
+        else:
+            # A URI, so the file can be attached read-only.
+            self.con = sqlite3.connect(
+                'file::memory:', uri=True,
+                detect_types=sqlite3.PARSE_COLNAMES)
+            self.copy_subset(models, distributions, splits)
+
+        # How long startup took, and how much memory the database holds.
+        self.startup_time = time.time()-start_time
+        if memory:
+            page_count = self.con.execute("PRAGMA page_count").fetchone()[0]
+            page_size = self.con.execute("PRAGMA page_size").fetchone()[0]
+            self.memory_used = page_count*page_size
+        else:
+            self.memory_used = 0
+        if verbose:
+            print(f"Database ready in {self.startup_time:.2f}s, "\
+                  f"{self.memory_used/2**20:.1f} MB in memory")
 
         # This line allows us to access the query results as a dict
         self.con.text_factory = lambda b: b.decode(errors='ignore')
@@ -57,14 +116,79 @@ class DatabaseObject():
         # Keep track of the link between model names and DB indices
         self.model_id_dict = {}
 
-        # Temporary tables that can be queried.
-        self.temp_table_list = []
+        # Columnar caches of (model, distribution, split) slices.
+        self.output_caches = {}
 
         self.idx_to_failure_dict = get_failure_mode_dict_reversed(self.cur)
         self.failure_to_idx_dict = get_failure_mode_dict(self.cur)
         self.idx_to_distribution_dict = get_distribution_dict(self.cur)
         self.distribution_to_idx_dict = get_distribution_dict_reversed(self.cur)
 
+    def copy_subset(self, models, distributions, splits):
+        """Copies a subset of the database file into the connection.
+
+        args:
+            models: model IDs to copy, or None for all of them.
+            distributions: distribution IDs or names to copy, or None for all
+                of them.
+            splits: splits to copy, or None for all of them.
+        """
+        self.con.execute("ATTACH DATABASE 'file:data/redatabase.sqlite3?"\
+                         "mode=ro' AS source")
+        schema = self.con.execute(
+            "SELECT type, name, sql FROM source.sqlite_master WHERE sql IS "
+            "NOT NULL AND name NOT LIKE 'sqlite_%'").fetchall()
+        for object_type, _, sql in schema:
+            if object_type == "table":
+                self.con.execute(sql)
+
+        # Which outputs to copy.
+        conditions = []
+        parameters = []
+        if distributions is not None:
+            distribution_ids = []
+            for distribution in distributions:
+                if isinstance(distribution, str):
+                    distribution = self.con.execute(
+                        "SELECT id FROM source.distributions WHERE name=?",
+                        (distribution,)).fetchone()[0]
+                distribution_ids.append(distribution)
+            distributions = distribution_ids
+        for column, values in (("model", models),
+                               ("distribution", distributions),
+                               ("split", splits)):
+            if values is not None:
+                conditions.append(
+                    f"{column} IN ({', '.join(['?']*len(values))})")
+                parameters.extend(values)
+
+        # Outputs first, then only what they reference. Every other table is
+        # small, so it is copied in full.
+        copies = {
+            "outputs": (f"WHERE {' AND '.join(conditions)}", parameters),
+            "sentences": ("WHERE id IN (SELECT sentence FROM main.outputs)",
+                          []),
+            "targets": ("WHERE id IN (SELECT target FROM main.sentences)", []),
+            "output_ious": (
+                "WHERE output IN (SELECT id FROM main.outputs)", []),
+            "output_scores": (
+                "WHERE output IN (SELECT id FROM main.outputs)", [])}
+        tables = [name for object_type, name, _ in schema
+                  if object_type == "table"]
+        for table in [table for table in copies if table in tables]+\
+                [table for table in tables if table not in copies]:
+            condition, table_parameters = copies.get(table, ("", []))
+            self.con.execute(
+                f"INSERT INTO main.{table} SELECT * FROM source.{table} "
+                f"{condition}", table_parameters)
+
+        # Indexes are faster to build once the rows are in.
+        for object_type, _, sql in schema:
+            if object_type != "table":
+                self.con.execute(sql)
+        self.con.commit()
+        self.con.execute("DETACH DATABASE source")
+
     def distribution_to_idx(self, distribution):
         """Converts a string distribution to the corresponding db ID.
 
@@ -156,11 +280,27 @@ class DatabaseObject():
 
         return self.model_id_dict[id_dict_key]
 
+    def get_model_groups(self):
+        """Groups model IDs by architecture and object source.
+
+        Returns:
+            a dict from a key like UNITER-gt to a list of model IDs.
+        """
+        groups = {}
+        for result in self.get_architectures_and_sources():
+            key = f"{result['architecture']}-{result['object_source']}"
+            groups[key] = self.get_model_ids(
+                result['architecture'], result['object_source'])
+
+        return groups
+
     def get_temp_table(self, network, distribution, split):
         """Retrieves a temporary table containing all outputs (and more) for a
         model, split, object source.
 
-        Creates said table if it does not already exist.
+        Creates said table if it does not already exist. Creating it may drop
+        the least recently used temp tables, to stay within budget, but never
+        the one returned.
 
         args:
             network: The model architecture.
@@ -172,7 +312,11 @@ class DatabaseObject():
         """
         temp_table_key = f'{split}{network}{distribution}'
 
-        if temp_table_key not in self.temp_table_list:
+        if temp_table_key in self.temp_tables:
+            self.temp_table_hits += 1
+            self.temp_tables.move_to_end(temp_table_key)
+        else:
+            self.temp_table_misses += 1
 
             # Setting up the appropriate temporary table is many many times faster.
             query = f"CREATE TEMPORARY TABLE IF NOT EXISTS temp.{temp_table_key}"\
@@ -186,8 +330,111 @@ class DatabaseObject():
                     "outputs.split=?"
             self.cur.execute(query, (network, distribution, split))
 
+            # Blobs dominate the size. Count the integer columns too.
+            query = "SELECT TOTAL(LENGTH(outputs_detections)+"\
+                    "LENGTH(outputs_probabilities))+COUNT(*)*24 FROM "\
+                    f"temp.{temp_table_key}"
+            self.cur.execute(query)
+            self.temp_tables[temp_table_key] = int(self.cur.fetchone()[0])
+            self.temp_table_slices[temp_table_key] = (
+                network, distribution, split)
+            self.evict_temp_tables()
+
         return f'temp.{temp_table_key}'
 
+    def prefetch(self, model, distribution, split):
+        """Builds the temp table for a model, distribution, and split ahead
+        of time.
+
+        Does not count towards the hit and miss counters.
+
+        args:
+            model: the model ID.
+            distribution: the distribution ID.
+            split: the data split.
+        """
+        hits, misses = self.temp_table_hits, self.temp_table_misses
+        self.get_temp_table(model, distribution, split)
+        self.temp_table_hits, self.temp_table_misses = hits, misses
+
+    def evict_temp_tables(self):
+        """Drops the least recently used temp tables until within budget.
+
+        The most recently used table is always kept.
+        """
+        while len(self.temp_tables) > 1 and (
+                (self.max_temp_tables is not None and
+                 len(self.temp_tables) > self.max_temp_tables) or
+                (self.max_temp_table_bytes is not None and
+                 sum(self.temp_tables.values()) > self.max_temp_table_bytes)):
+            temp_table_key, _ = self.temp_tables.popitem(last=False)
+            del self.temp_table_slices[temp_table_key]
+            self.cur.execute(f"DROP TABLE IF EXISTS temp.{temp_table_key}")
+            self.temp_table_evictions += 1
+
+    def invalidate(self, model=None, distribution=None, split=None):
+        """Drops every cached copy of the outputs, so they are rebuilt from
+        the database.
+
+        Call this after changing outputs, sentences, or targets. Drops the
+        temp tables, the output caches, and the draw tables of
+        database_commands.get_draw_table.
+
+        args:
+            model: only drop the caches of this model ID, if given.
+            distribution: only drop the caches of this distribution ID, if
+                given.
+            split: only drop the caches of this split, if given.
+        """
+        def matches(cache_slice):
+            return all(value is None or value == cached for value, cached in
+                       zip((model, distribution, split), cache_slice))
+
+        for temp_table_key, cache_slice in list(
+                self.temp_table_slices.items()):
+            if matches(cache_slice):
+                del self.temp_tables[temp_table_key]
+                del self.temp_table_slices[temp_table_key]
+                self.cur.execute(
+                    f"DROP TABLE IF EXISTS temp.{temp_table_key}")
+        for cache_key in list(self.output_caches):
+            if matches(cache_key):
+                del self.output_caches[cache_key]
+        invalidate_draw_tables(self.cur, model, distribution, split)
+
+    def get_temp_table_stats(self):
+        """Summarizes the temp table cache.
+
+        returns:
+            dict with keys tables, bytes, hits, misses, evictions.
+        """
+        return {'tables': len(self.temp_tables),
+                'bytes': sum(self.temp_tables.values()),
+                'hits': self.temp_table_hits,
+                'misses': self.temp_table_misses,
+                'evictions': self.temp_table_evictions}
+
+    def get_output_cache(self, model, distribution, split):
+        """Retrieves the columnar cache of all outputs for a model,
+        distribution, and split.
+
+        Creates said cache if it does not already exist.
+
+        args:
+            model: the model ID.
+            distribution: the distribution ID.
+            split: the data split.
+
+        returns:
+            an OutputCache holding the slice.
+        """
+        cache_key = (model, distribution, split)
+        if cache_key not in self.output_caches:
+            self.output_caches[cache_key] = OutputCache(
+                self.cur, model, distribution, split)
+
+        return self.output_caches[cache_key]
+
     def get_all_targets(self, network, split, obj_src):
         """Gets all the target ids for a network and split
 
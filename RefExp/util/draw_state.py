@@ -0,0 +1,195 @@
+"""Keeps track of a draw while it is being deferred.
+
+The simulation re-queries the highest-scoring output at every step, and each
+step only changes the score and failure mode of the output it re-queried.
+Rather than taking the argmax of every score and the mean of every failure
+mode each step, the scores live in a max segment tree and the error and RMAE
+are running counts. The lookup of the next output to re-query is O(log N),
+and the error and RMAE are O(1).
+
+Typical usage:
+    state = DrawState(draw, "entropy")
+    to_requery = state.get_which_to_requery()
+    state.requery(to_requery)
+    state.set_failure_mode(to_requery, new_failure_mode)
+    state.set_score(to_requery, new_score)
+"""
+import math
+import numpy as np
+from util import calculation_utils
+
+class DrawState():
+    """A draw, plus a segment tree over its rejection scores and running
+    counts of its errors."""
+    def __init__(self, draw, scoring_method, correct_idx=5,
+                 missed_detection_idx=2, scores=None):
+        """Scores every output in the draw and builds the tree.
+
+        args:
+            draw: a dict with keys target_ids, failure_modes, probabilities.
+            scoring_method: the scoring function applied to the distribution.
+            correct_idx: the database ID of the correct failure mode.
+            missed_detection_idx: the database ID of the missed_detection
+                failure mode.
+            scores: precomputed rejection scores for the draw. Calculated
+                from the probabilities if None.
+        """
+        self.draw = draw
+        self.num_items = len(draw['probabilities'])
+        self.correct_idx = correct_idx
+        self.missed_detection_idx = missed_detection_idx
+
+        # Re-queries per output, and in total.
+        self.rq_counts = np.zeros(self.num_items, dtype=int)
+        self.num_requeries = 0
+
+        # Running counts for calc_error and calc_rmae.
+        failure_modes = np.asarray(draw['failure_modes'])
+        self.num_incorrect = int((failure_modes != correct_idx).sum())
+        self.num_rmae = int(((failure_modes != correct_idx)*(
+            failure_modes != missed_detection_idx)).sum())
+
+        # Leaves start at self.size. Unused leaves hold -inf so they never win.
+        self.size = 1
+        while self.size < self.num_items:
+            self.size *= 2
+        self.tree_scores = [float('-inf')]*(2*self.size)
+        self.tree_argmax = [0]*(2*self.size)
+        for i in range(self.size):
+            self.tree_argmax[self.size+i] = i
+        if scores is None:
+            scores = [calculation_utils.calc_rejection_score(
+                probabilities, scoring_method)
+                      for probabilities in draw['probabilities']]
+        for i in range(self.num_items):
+            self.tree_scores[self.size+i] = float(scores[i])
+        for node in range(self.size-1, 0, -1):
+            self._pull(node)
+
+        # NaN scores are the easiest ordering to get wrong, so check the
+        # tree against segment_argmax, which the vectorized paths use,
+        # whenever a draw has one.
+        initial_scores = np.array(self.tree_scores[self.size:], dtype=float)
+        if np.isnan(initial_scores).any():
+            expected = calculation_utils.segment_argmax(
+                initial_scores, [0, self.size])[0]
+            if self.get_which_to_requery() != expected:
+                raise RuntimeError(
+                    f"DrawState picked {self.get_which_to_requery()}, but "\
+                    f"segment_argmax picked {expected}")
+
+    def _pull(self, node):
+        """Recomputes an internal node from its two children.
+
+        NaN ranks above every other score, and ties (including two NaNs) go
+        to the left child, so the tree returns the first maximum, or the
+        first NaN, the same as np.argmax and segment_argmax.
+
+        args:
+            node: the index of the internal node.
+        """
+        left = 2*node
+        right = left+1
+        left_score = self.tree_scores[left]
+        right_score = self.tree_scores[right]
+        if math.isnan(left_score) or (not math.isnan(right_score) and
+                                      left_score >= right_score):
+            self.tree_scores[node] = self.tree_scores[left]
+            self.tree_argmax[node] = self.tree_argmax[left]
+        else:
+            self.tree_scores[node] = self.tree_scores[right]
+            self.tree_argmax[node] = self.tree_argmax[right]
+
+    def get_score(self, idx):
+        """Gets the current rejection score of an output.
+
+        args:
+            idx: the index of the output in the draw.
+
+        returns:
+            the score.
+        """
+        return self.tree_scores[self.size+idx]
+
+    def set_score(self, idx, score):
+        """Updates the rejection score of an output in O(log N).
+
+        args:
+            idx: the index of the output in the draw.
+            score: the new score. Higher is re-queried first.
+        """
+        node = self.size+idx
+        self.tree_scores[node] = float(score)
+        node //= 2
+        while node >= 1:
+            self._pull(node)
+            node //= 2
+
+    def requery(self, idx, count=1):
+        """Counts re-queries against an output.
+
+        args:
+            idx: the index of the output in the draw.
+            count: how many re-queries were made.
+
+        returns:
+            the total number of re-queries for that output.
+        """
+        self.rq_counts[idx] += count
+        self.num_requeries += count
+        return self.rq_counts[idx]
+
+    def set_failure_mode(self, idx, failure_mode):
+        """Updates the failure mode of an output, and the running counts.
+
+        args:
+            idx: the index of the output in the draw.
+            failure_mode: the new failure mode database ID.
+        """
+        previous = self.draw['failure_modes'][idx]
+        self.num_incorrect += int(failure_mode != self.correct_idx)-int(
+            previous != self.correct_idx)
+        self.num_rmae += int(failure_mode != self.correct_idx and\
+                             failure_mode != self.missed_detection_idx)-int(
+                                 previous != self.correct_idx and\
+                                 previous != self.missed_detection_idx)
+        self.draw['failure_modes'][idx] = failure_mode
+
+    def calc_error(self):
+        """Drop-in for calculation_utils.calc_error, in O(1).
+
+        returns:
+            a floating point error (0->1)
+        """
+        return self.num_incorrect/self.num_items
+
+    def calc_rmae(self):
+        """Drop-in for calculation_utils.calc_rmae, in O(1).
+
+        returns:
+            a floating point rmae (0->1)
+        """
+        return self.num_rmae/self.num_items
+
+    def record(self, errors, rmaes, row):
+        """Writes the current error and RMAE into the result arrays.
+
+        The column is the number of re-queries made so far.
+
+        args:
+            errors: a preallocated (trials, coverages) error array.
+            rmaes: a preallocated (trials, coverages) rmae array.
+            row: the trial to write.
+        """
+        errors[row, self.num_requeries] = self.calc_error()
+        rmaes[row, self.num_requeries] = self.calc_rmae()
+
+    def get_which_to_requery(self):
+        """Returns the index of the referring expression to requery.
+
+        Drop-in for calculation_utils.get_which_to_requery.
+
+        returns:
+            index of the element with the highest score.
+        """
+        return self.tree_argmax[1]
@@ -0,0 +1,120 @@
+"""Marginals of a results file, computed once and cached on disk.
+
+The depth marginals and deferral rate marginals of every method (see
+util/bootstrap.py), and the deferral rate marginal of every key, are
+computed in one pass over a results pickle or store. They are saved under
+marginal_cache/ next to the results, named by a hash of the results' content
+and the bootstrap settings, so plotting scripts only redo the aggregation
+when the results change.
+
+Typical usage:
+    marginals = load_marginals("armae_arrays/compiled.pickle")
+    depth_marginals = marginals['depth']
+"""
+import hashlib
+import os
+import pickle
+import time
+import numpy as np
+from util.results_store import open_results, is_results_store
+from util.bootstrap import group_by_method, run_for_methods,\
+        bootstrap_depth_marginal, bootstrap_dr_marginal
+from util.checkpoint import atomic_pickle_dump
+
+# Bump when the contents of the cache change, so old caches aren't read.
+cache_version = 1
+
+def hash_results(path):
+    """Hashes the content of a results pickle or store.
+
+    args:
+        path: a results pickle, or the directory of a store.
+
+    returns:
+        the hex sha256 of the pickle, or of the store's index and every
+        array file it points to.
+    """
+    if is_results_store(path):
+        files = [os.path.join(path, "index.json")]
+        store = open_results(path)
+        for key in sorted(store.index):
+            files += [os.path.join(path, file_name) for file_name in
+                      store.index[key]['files']]
+    else:
+        files = [path]
+
+    content_hash = hashlib.sha256()
+    for file_path in files:
+        with open(file_path, "rb") as in_file:
+            for block in iter(lambda: in_file.read(1 << 20), b""):
+                content_hash.update(block)
+    return content_hash.hexdigest()
+
+def compute_marginals(path, replicates=100, workers=1, seed=0):
+    """Computes every marginal of a results file.
+
+    args:
+        path: a results pickle, or the directory of a store.
+        replicates: how many bootstrap replicates to draw.
+        workers: how many processes to run methods in.
+        seed: the base seed of the bootstrap.
+
+    returns:
+        a dict with keys depth and dr, each a dict from method to a dict with
+        keys mean and stderr (see util/bootstrap.py), and keys, a dict from
+        result key to a dict with the mean and stderr of its errors at every
+        deferral rate. Everything is in percent.
+    """
+    data = open_results(path)
+    with_depth_dict = group_by_method(data)
+    marginals = {}
+    marginals['depth'] = run_for_methods(
+        bootstrap_depth_marginal, with_depth_dict, depths=[*range(1, 11)],
+        replicates=replicates, workers=workers, seed=seed)
+    # Drawn separately from the depth marginals, with another seed.
+    marginals['dr'] = run_for_methods(
+        bootstrap_dr_marginal, with_depth_dict, depths=[*range(1, 11)],
+        replicates=replicates, workers=workers, seed=seed+1)
+
+    marginals['keys'] = {}
+    for key in data:
+        errors = np.asarray(data[key]['errors'])
+        marginals['keys'][key] = {
+            'mean': errors.mean(axis=0)*100,
+            'stderr': errors.std(axis=0)/np.sqrt(errors.shape[0])*100}
+    return marginals
+
+def load_marginals(path, replicates=100, workers=1, seed=0, cache_dir=None):
+    """Loads the marginals of a results file, computing them if they aren't
+    cached.
+
+    args:
+        path: a results pickle, or the directory of a store.
+        replicates: how many bootstrap replicates to draw.
+        workers: how many processes to run methods in.
+        seed: the base seed of the bootstrap.
+        cache_dir: where the cache is kept. Defaults to marginal_cache/ in
+            the directory holding the results.
+
+    returns:
+        the output of compute_marginals.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(
+            os.path.dirname(os.path.abspath(path)), "marginal_cache")
+    cache_path = os.path.join(
+        cache_dir, f"{hash_results(path)}-v{cache_version}-{replicates}-"\
+        f"{seed}.pickle")
+
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as in_file:
+            print(f"Loaded marginals from {cache_path}")
+            return pickle.load(in_file)
+
+    start_time = time.time()
+    marginals = compute_marginals(path, replicates, workers, seed)
+    os.makedirs(cache_dir, exist_ok=True)
+    atomic_pickle_dump(marginals, cache_path)
+    print(f"Computed marginals in {time.time()-start_time:.1f}s, "\
+          f"cached to {cache_path}")
+    return marginals
@@ -0,0 +1,72 @@
+"""Versioned schema migrations for existing databases.
+
+The schema version of a database is stored in PRAGMA user_version, and every
+migration moves it up by one. New databases are created at the latest
+version by data/ReDatabase.sql followed by data/ReDatabaseIndexes.sql, so
+migrations only need to be run on older databases.
+
+Typical usage:
+    migrate(con)
+"""
+import sqlite3
+
+# Migration i takes a database from version i to version i+1.
+migrations = [
+    # 0 -> 1: indexes for the query shapes of database_commands.py,
+    # DatabaseObject, and OutputCache. Every slice of outputs is selected by
+    # model, distribution, and split together; failure_mode and sentence
+    # make the index covering for queries that don't read the blobs (and
+    # failure_mode comes before sentence, so get_correct_outputs_one_run can
+    # seek on all four of its equality columns). Model groups are looked up
+    # by architecture and object source.
+    ["CREATE INDEX IF NOT EXISTS index_outputs_slice ON outputs "
+     "(model, distribution, split, failure_mode, sentence)",
+     "CREATE INDEX IF NOT EXISTS index_models_architecture ON models "
+     "(architecture, object_source, instance)"],
+]
+
+def get_version(con):
+    """Gets the schema version of a database.
+
+    args:
+        con: the database connection.
+
+    returns:
+        the value of PRAGMA user_version.
+    """
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(con, verbose=True):
+    """Brings a database up to the latest schema version.
+
+    Each migration runs in its own transaction, together with the version
+    bump, so an interrupted migration can simply be run again. ANALYZE is
+    run afterwards, so the query planner has statistics for the new indexes.
+
+    args:
+        con: the database connection.
+        verbose: print each migration as it is applied?
+
+    returns:
+        the version the database was at before migrating.
+    """
+    start_version = get_version(con)
+    for version in range(start_version, len(migrations)):
+        # sqlite3 doesn't open a transaction for DDL on its own.
+        con.execute("BEGIN")
+        try:
+            for statement in migrations[version]:
+                con.execute(statement)
+            con.execute(f"PRAGMA user_version = {version+1}")
+        except sqlite3.Error:
+            con.rollback()
+            raise
+        con.commit()
+        if verbose:
+            print(f"Migrated from version {version} to {version+1}")
+
+    if start_version < len(migrations):
+        con.execute("ANALYZE")
+        con.commit()
+
+    return start_version
@@ -0,0 +1,363 @@
+"""A columnar, in-memory cache of the outputs for one model, distribution, and
+split.
+
+Re-querying a target in the simulation loop used to mean a SQL query against
+the temp table and a pass through the blob converters. Here, the whole slice
+is loaded once into contiguous NumPy arrays, and a re-query is an index lookup.
+
+Typical usage:
+    cache = dbo.get_output_cache(model, distribution, split)
+    replacement = cache.get_re_by_target(target_id)
+"""
+import random
+import numpy as np
+from util.database_commands import convert_ragged_arrays
+from util.calculation_utils import compute_output_IoUs, segment_argmax,\
+        calc_all_rejection_scores, rejection_score_methods
+
+class OutputCache():
+    """Holds every output of a (model, distribution, split) slice in arrays.
+
+    Outputs are sorted by target, so the outputs for the target at index t are
+    rows target_offsets[t] to target_offsets[t+1]. The probabilities and
+    detections are ragged, so they are stored as one flat buffer each, with
+    offsets indexed by output row.
+    """
+    def __init__(self, cur, model, distribution, split):
+        """Loads the slice from the database.
+
+        args:
+            cur: the database cursor.
+            model: the model ID.
+            distribution: the distribution ID.
+            split: val, testA, or testB.
+        """
+        self.model = model
+        self.distribution = distribution
+        self.split = split
+
+        # IoUs and rejection scores are read from the output_ious and
+        # output_scores tables if precompute_ious.py and precompute_scores.py
+        # have been run on this database.
+        query = "SELECT name FROM sqlite_master WHERE type='table'"
+        cur.execute(query)
+        tables = [row[0] for row in cur.fetchall()]
+        if "output_ious" in tables:
+            iou_columns = "output_ious.ious AS ious, "\
+                    "output_ious.argmax_correct AS argmax_correct"
+            iou_join = "LEFT JOIN output_ious ON output_ious.output=outputs.id "
+        else:
+            iou_columns = "NULL AS ious, NULL AS argmax_correct"
+            iou_join = ""
+        if "output_scores" in tables:
+            score_columns = ", ".join(
+                [f"output_scores.{method} AS {method}"
+                 for method in rejection_score_methods])
+            score_join = "LEFT JOIN output_scores ON "\
+                    "output_scores.output=outputs.id "
+        else:
+            score_columns = ", ".join(
+                [f"NULL AS {method}" for method in rejection_score_methods])
+            score_join = ""
+
+        # Blobs are selected without a type alias, so they come back as raw
+        # bytes and we can decode them in a single pass.
+        query = "SELECT outputs.id AS output_id, outputs.sentence AS "\
+                "sentence, sentences.target AS target, outputs.failure_mode "\
+                "AS failure_mode, outputs.probabilities AS probabilities, "\
+                "outputs.detections AS detections, targets.tlx AS tlx, "\
+                "targets.tly AS tly, targets.brx AS brx, targets.bry AS bry, "\
+                f"{iou_columns}, {score_columns} FROM outputs JOIN sentences "\
+                "ON sentences.id=outputs.sentence JOIN targets ON "\
+                f"targets.id=sentences.target {iou_join}{score_join}WHERE "\
+                "outputs.model=? AND outputs.distribution=? AND "\
+                "outputs.split=? ORDER BY sentences.target, outputs.id"
+        cur.execute(query, (model, distribution, split))
+        rows = cur.fetchall()
+
+        # Ragged probabilities, and detections (tlx, tly, w, h).
+        prob_offsets, prob_buffer = convert_ragged_arrays(
+            [row[4] for row in rows])
+        det_offsets, det_buffer = convert_ragged_arrays(
+            [row[5] for row in rows], 4)
+
+        # Materialized IoUs and scores, if every output has them.
+        ious = None
+        argmax_correct = None
+        if len(rows) > 0 and all(row[10] is not None for row in rows):
+            _, ious = convert_ragged_arrays([row[10] for row in rows])
+            argmax_correct = np.array([row[11] for row in rows], dtype=bool)
+        scores = {}
+        for column, method in enumerate(rejection_score_methods, 12):
+            if len(rows) > 0 and all(row[column] is not None for row in rows):
+                scores[method] = np.array(
+                    [row[column] for row in rows], dtype=np.float32)
+
+        self._set_arrays(
+            np.array([row[0] for row in rows], dtype=np.int64),
+            np.array([row[1] for row in rows], dtype=np.int64),
+            np.array([row[2] for row in rows], dtype=np.int64),
+            np.array([row[3] for row in rows], dtype=np.int64),
+            prob_offsets, prob_buffer, det_offsets, det_buffer,
+            np.array([[row[6], row[7], row[8], row[9]] for row in rows],
+                     dtype=np.float64).reshape(-1, 4),
+            ious, argmax_correct, scores)
+
+    @classmethod
+    def from_arrays(cls, model, distribution, split, output_ids, sentence_ids,
+                    output_targets, failure_modes, prob_offsets, prob_buffer,
+                    det_offsets, det_buffer, target_boxes, ious=None,
+                    argmax_correct=None, scores=None):
+        """Builds a cache from arrays that are already in memory (or mapped).
+
+        The buffers are used as they are, without copying.
+
+        args:
+            model: the model ID.
+            distribution: the distribution ID.
+            split: val, testA, or testB.
+            output_ids, sentence_ids, output_targets, failure_modes: one per
+                output, with outputs sorted by target.
+            prob_offsets, prob_buffer: the ragged probabilities.
+            det_offsets, det_buffer: the ragged (items, 4) detections.
+            target_boxes: the (tlx, tly, brx, bry) box of every output's
+                target.
+            ious, argmax_correct: the materialized IoUs and argmax
+                correctness, or None to compute them.
+            scores: dict from scoring method to the materialized scores.
+                Missing methods are computed.
+
+        returns:
+            an OutputCache holding the slice.
+        """
+        cache = cls.__new__(cls)
+        cache.model = model
+        cache.distribution = distribution
+        cache.split = split
+        cache._set_arrays(
+            output_ids, sentence_ids, output_targets, failure_modes,
+            prob_offsets, prob_buffer, det_offsets, det_buffer, target_boxes,
+            ious, argmax_correct, {} if scores is None else scores)
+        return cache
+
+    def _set_arrays(self, output_ids, sentence_ids, output_targets,
+                    failure_modes, prob_offsets, prob_buffer, det_offsets,
+                    det_buffer, target_boxes, ious, argmax_correct, scores):
+        """Sets up the cache from per-output arrays.
+
+        Groups the outputs by target, and computes the IoUs and scores that
+        weren't materialized. See from_arrays for the arguments.
+        """
+        self.output_ids = output_ids
+        self.sentence_ids = sentence_ids
+        self.failure_modes = failure_modes
+        self.prob_offsets = prob_offsets
+        self.prob_buffer = prob_buffer
+        self.det_offsets = det_offsets
+        self.det_buffer = det_buffer
+
+        # Group the outputs by target.
+        if output_targets.shape[0] > 0:
+            starts = np.concatenate(
+                ([0], np.where(np.diff(output_targets) != 0)[0]+1))
+        else:
+            starts = np.zeros(0, dtype=np.int64)
+        self.target_ids = np.asarray(output_targets[starts], dtype=np.int64)
+        self.target_offsets = np.append(
+            starts, output_targets.shape[0]).astype(np.int64)
+        self.target_boxes = np.asarray(
+            target_boxes[starts], dtype=np.float64).reshape(-1, 4)
+        self.target_to_idx = {
+            target_id: idx for idx, target_id in enumerate(
+                self.target_ids.tolist())}
+
+        # IoU of every detection against the target, laid out like
+        # det_buffer, and whether each output's argmax is correct (at the
+        # materialized threshold, or 0.5). Computed here if they weren't
+        # materialized. argmax_correct is informational only: the
+        # simulation judges fused distributions against the IoUs at 0.5,
+        # the threshold the failure modes were labelled at.
+        if ious is not None and argmax_correct is not None:
+            self.ious = ious
+            self.argmax_correct = argmax_correct
+        else:
+            # float32, as precompute_ious.py stores them, so verdicts near
+            # the threshold don't depend on whether it was run.
+            self.ious = compute_output_IoUs(
+                self.det_buffer, self.det_offsets, np.repeat(
+                    self.target_boxes, np.diff(self.target_offsets),
+                    axis=0)).astype(np.float32)
+            # An argmax past the last detection is never correct.
+            guesses = segment_argmax(self.prob_buffer, self.prob_offsets)
+            has_guess = guesses < np.diff(self.det_offsets)
+            self.argmax_correct = np.zeros(guesses.shape[0], dtype=bool)
+            self.argmax_correct[has_guess] = self.ious[
+                self.det_offsets[:-1][has_guess]+guesses[has_guess]] >= 0.5
+
+        # Rejection score of every output, by scoring method.
+        self.scores = {}
+        for method in rejection_score_methods:
+            if method in scores:
+                self.scores[method] = scores[method]
+            else:
+                self.scores[method] = calc_all_rejection_scores(
+                    self.prob_buffer, self.prob_offsets, method)
+
+        # The simulation never writes into these, and a stray in-place
+        # operation on a returned view would silently corrupt the cache.
+        for array in (self.output_ids, self.sentence_ids, self.failure_modes,
+                      self.prob_offsets, self.det_offsets, self.target_ids,
+                      self.target_offsets, self.target_boxes, self.ious,
+                      self.argmax_correct, *self.scores.values()):
+            if array.flags.writeable:
+                array.setflags(write=False)
+
+    def __len__(self):
+        """The number of outputs in the cache."""
+        return self.output_ids.shape[0]
+
+    @property
+    def num_targets(self):
+        """The number of distinct targets in the cache."""
+        return self.target_ids.shape[0]
+
+    def probabilities(self, output_idx):
+        """Gets the probability distribution of one output.
+
+        args:
+            output_idx: the row of the output in the cache.
+
+        returns:
+            a read-only view into the probability buffer.
+        """
+        return self.prob_buffer[
+            self.prob_offsets[output_idx]:self.prob_offsets[output_idx+1]]
+
+    def detections(self, output_idx):
+        """Gets the detections (tlx, tly, w, h) of one output.
+
+        args:
+            output_idx: the row of the output in the cache.
+
+        returns:
+            a read-only view into the detection buffer.
+        """
+        return self.det_buffer[
+            self.det_offsets[output_idx]:self.det_offsets[output_idx+1]]
+
+    def output_ious(self, output_idx):
+        """Gets the IoU of each detection of one output against its target.
+
+        args:
+            output_idx: the row of the output in the cache.
+
+        returns:
+            a read-only view into the IoU buffer.
+        """
+        return self.ious[
+            self.det_offsets[output_idx]:self.det_offsets[output_idx+1]]
+
+    def rejection_score(self, output_idx, method):
+        """Gets the precomputed rejection score of one output.
+
+        args:
+            output_idx: the row of the output in the cache.
+            method: the scoring method, e.g. entropy or sr.
+
+        returns:
+            the score, as calc_rejection_score would compute it.
+        """
+        return self.scores[method][output_idx]
+
+    def sample_output(self, target_idx, rng=random):
+        """Picks a random output for a target.
+
+        args:
+            target_idx: the index (not database ID) of the target.
+            rng: anything with a random() method returning a float in [0, 1).
+
+        returns:
+            the row of the chosen output in the cache.
+        """
+        start = self.target_offsets[target_idx]
+        count = self.target_offsets[target_idx+1]-start
+        return int(start+int(rng.random()*count))
+
+    def sample_outputs(self, rng=np.random, num_trials=None):
+        """Picks one random output for every target at once.
+
+        args:
+            rng: a numpy Generator or RandomState (or np.random itself).
+            num_trials: if given, draw this many independent trials.
+
+        returns:
+            an array of output rows, of shape (targets,) or
+            (num_trials, targets).
+        """
+        counts = np.diff(self.target_offsets)
+        if num_trials is None:
+            shape = counts.shape
+        else:
+            shape = (num_trials, counts.shape[0])
+        # Scaling a uniform by the group size picks a row within the group.
+        return self.target_offsets[:-1]+(
+            rng.random(shape)*counts).astype(np.int64)
+
+    def get_random_draw(self, rng=np.random, output_idx=None):
+        """Draws one referring expression for every target.
+
+        Replaces database_commands.get_random_draw without any SQL.
+
+        args:
+            rng: a numpy Generator or RandomState (or np.random itself).
+            output_idx: the output rows to use, e.g. one row of the result of
+                sample_outputs(num_trials=...). Sampled if None.
+
+        returns:
+            A dict with keys 'target_ids', 'output_idx', 'failure_modes',
+            'probabilities', 'detections'. Failure modes are a writable copy,
+            and the ragged probabilities and detections are lists of
+            read-only views into the cache.
+        """
+        if output_idx is None:
+            output_idx = self.sample_outputs(rng)
+        return {'target_ids': self.target_ids,
+                'output_idx': output_idx,
+                'failure_modes': self.failure_modes[output_idx],
+                'probabilities': [self.probabilities(i) for i in output_idx],
+                'detections': [self.detections(i) for i in output_idx]}
+
+    def get_output(self, output_idx):
+        """Gets one output in the same form as get_re_by_target.
+
+        args:
+            output_idx: the row of the output in the cache.
+
+        returns:
+            a dict with keys output_idx, outputs_sentence,
+            outputs_failure_mode, probabilities, detections, ious, tlx, tly,
+            brx, bry.
+        """
+        target_idx = np.searchsorted(
+            self.target_offsets, output_idx, side='right')-1
+        box = self.target_boxes[target_idx]
+        return {'output_idx': output_idx,
+                'outputs_sentence': int(self.sentence_ids[output_idx]),
+                'outputs_failure_mode': int(self.failure_modes[output_idx]),
+                'probabilities': self.probabilities(output_idx),
+                'detections': self.detections(output_idx),
+                'ious': self.output_ious(output_idx),
+                'tlx': box[0], 'tly': box[1], 'brx': box[2], 'bry': box[3]}
+
+    def get_re_by_target(self, target_id, rng=random):
+        """Drop-in for database_commands.get_re_by_target.
+
+        args:
+            target_id: Database ID of the target.
+            rng: anything with a random() method returning a float in [0, 1).
+
+        returns:
+            A randomly chosen response matching the target.
+        """
+        return self.get_output(
+            self.sample_output(self.target_to_idx[target_id], rng))
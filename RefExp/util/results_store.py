@@ -0,0 +1,151 @@
+"""A results store that can be read one key at a time.
+
+A store is a directory with a small index (index.json) and the arrays of
+every key in their own files: errors and rmaes as two .npy files, which are
+memory-mapped when read, or as one compressed .npz file. Opening a store only
+reads the index, and the arrays of a key are only read when the key is.
+
+An index entry can point at files in another store, so combining stores only
+writes a new index. Entries can also be marked to have fill_skipped_coverages
+applied when they are read, so combining doesn't need to rewrite arrays for
+that either.
+
+A store can be used in place of the dict in a results pickle, and
+open_results opens either.
+
+Typical usage:
+    store = ResultsStore("armae_arrays/entropy-naive_1-testA.store")
+    store.write(key, {'errors': errors, 'rmaes': rmaes})
+    store.flush()
+
+    data = open_results("armae_arrays/compiled.store")
+    errors = data[key]['errors']
+"""
+import json
+import os
+import pickle
+from collections.abc import Mapping
+import numpy as np
+from util.calculation_utils import fill_skipped_coverages
+
+class ResultsStore(Mapping):
+    """A lazily loaded dict from result keys to dicts of errors and rmaes."""
+    def __init__(self, path, compress=False):
+        """Opens a store, creating it if it doesn't exist.
+
+        args:
+            path: the directory of the store.
+            compress: write new keys as compressed .npz files, which can't be
+                memory-mapped.
+        """
+        self.path = path
+        self.compress = compress
+        self.index_path = os.path.join(path, "index.json")
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as index_file:
+                self.index = json.load(index_file)
+
+    def __getitem__(self, key):
+        """Reads the arrays of one key.
+
+        args:
+            key: the result key.
+
+        returns:
+            a dict with keys errors and rmaes. Uncompressed arrays are
+            read-only memory maps, unless coverages had to be filled.
+        """
+        entry = self.index[key]
+        if entry['format'] == "npz":
+            with np.load(os.path.join(self.path, entry['files'][0])) as arrays:
+                run = {'errors': arrays['errors'], 'rmaes': arrays['rmaes']}
+        else:
+            run = {name: np.load(os.path.join(self.path, file_name),
+                                 mmap_mode="r") for name, file_name in
+                   zip(("errors", "rmaes"), entry['files'])}
+        if entry['fill_skipped']:
+            run = fill_skipped_coverages(
+                {name: np.array(array) for name, array in run.items()})
+        return run
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def write(self, key, run):
+        """Writes the arrays of one key.
+
+        The index isn't written until flush is called.
+
+        args:
+            key: the result key.
+            run: a dict with keys errors and rmaes.
+        """
+        os.makedirs(os.path.join(self.path, "arrays"), exist_ok=True)
+        file_name = os.path.join("arrays", key.replace(os.sep, "_"))
+        if self.compress:
+            files = [f"{file_name}.npz"]
+            np.savez_compressed(os.path.join(self.path, files[0]),
+                                errors=run['errors'], rmaes=run['rmaes'])
+        else:
+            files = [f"{file_name}.errors.npy", f"{file_name}.rmaes.npy"]
+            np.save(os.path.join(self.path, files[0]), run['errors'])
+            np.save(os.path.join(self.path, files[1]), run['rmaes'])
+        self.index[key] = {
+            'files': files, 'format': "npz" if self.compress else "npy",
+            'shape': list(np.shape(run['errors'])), 'fill_skipped': False}
+
+    def link(self, key, other, other_key=None, fill_skipped=False):
+        """Adds a key whose arrays are in another store, without copying them.
+
+        The index isn't written until flush is called.
+
+        args:
+            key: the result key in this store.
+            other: the ResultsStore holding the arrays.
+            other_key: the key in the other store. Defaults to key.
+            fill_skipped: apply fill_skipped_coverages when the key is read.
+        """
+        entry = dict(other.index[key if other_key is None else other_key])
+        entry['files'] = [os.path.relpath(
+            os.path.join(other.path, file_name), self.path)
+                          for file_name in entry['files']]
+        entry['fill_skipped'] = entry['fill_skipped'] or fill_skipped
+        self.index[key] = entry
+
+    def flush(self):
+        """Writes the index, replacing the old one in one step."""
+        os.makedirs(self.path, exist_ok=True)
+        temp_path = f"{self.index_path}.tmp"
+        with open(temp_path, "w") as index_file:
+            json.dump(self.index, index_file, indent=1)
+        os.replace(temp_path, self.index_path)
+
+def is_results_store(path):
+    """Checks whether a path is a results store.
+
+    args:
+        path: a file or directory.
+
+    returns:
+        True if path is a directory with a store index.
+    """
+    return os.path.isfile(os.path.join(path, "index.json"))
+
+def open_results(path):
+    """Opens results saved as either a pickle or a store.
+
+    args:
+        path: a results pickle, or the directory of a store.
+
+    returns:
+        a dict (from a pickle) or a ResultsStore, both from result keys to
+        dicts with keys errors and rmaes.
+    """
+    if is_results_store(path):
+        return ResultsStore(path)
+    with open(path, "rb") as in_file:
+        return pickle.load(in_file)
@@ -0,0 +1,416 @@
+"""Runs the deferral simulation.
+
+Every trial is independent: it is given the outputs of its initial draw and
+its own random number generator, and returns its error and rmae at every
+coverage. This means trials can be spread across a process pool, and the
+results don't depend on how many workers there are. Naive and smart trials can
+instead be run together with batched_simulation, and combined trials in the
+compiled kernel of combined_kernel.
+
+Typical usage:
+    errors, rmaes = run_trials(caches, models, distribution_id, split,
+                               "entropy", "naive_3", failure_ids,
+                               group=group, pool=pool)
+"""
+import zlib
+from collections import Counter
+from itertools import groupby
+import numpy as np
+from util.draw_state import DrawState
+from util import calculation_utils
+from util import batched_simulation
+from util import combined_kernel
+
+# Caches available to pool workers, keyed by (model, distribution, split).
+# Set by init_worker.
+worker_caches = {}
+
+def run_trial(cache, output_idx, scoring_method, replacement_method,
+              failure_ids, rng):
+    """Runs a single trial, from the initial draw until the DDC is reached.
+
+    args:
+        cache: the OutputCache for the trial's model, distribution, and split.
+        output_idx: the output rows of the initial draw, one per target.
+        scoring_method: the scoring function applied to the distribution.
+        replacement_method: e.g. naive_3, combined_3, ensemble_mean_3.
+        failure_ids: dict from failure mode name to database ID.
+        rng: the numpy Generator used for every re-query in this trial.
+
+    returns:
+        the error and the rmae at every number of re-queries, as two arrays
+        of length targets+1.
+    """
+    draw = cache.get_random_draw(output_idx=output_idx)
+    num_targets = len(draw['target_ids'])
+    errors = np.zeros((1, num_targets+1))
+    rmaes = np.zeros((1, num_targets+1))
+
+    # Scores are kept in a segment tree, so picking the next output
+    # to re-query doesn't require an argmax over every score, and
+    # error/rmae are running counts rather than a mean over the draw.
+    state = DrawState(
+        draw, scoring_method, failure_ids['correct'],
+        failure_ids['missed_detection'],
+        cache.scores[scoring_method][draw['output_idx']])
+
+    # Loop through until DDC.
+    # We use a while loop here, since some methods require multiple
+    # queries per-update.
+    while state.num_requeries < num_targets:
+        # Write error and rmae at the current coverage.
+        state.record(errors, rmaes, 0)
+        to_requery = state.get_which_to_requery()
+        replacement = cache.get_re_by_target(
+            draw['target_ids'][to_requery], rng)
+
+        # Update the belief based on the selection fn.
+
+        # In naive replacement, we always use the replacement seed.
+        if "naive" in replacement_method:
+            max_depth = int(replacement_method.split("_")[-1])
+            # We shift the RQ count by 1.
+            state.requery(to_requery)
+            # Naive replacement is simple: we can just update the
+            # failure_mode column.
+            state.set_failure_mode(
+                to_requery, replacement['outputs_failure_mode'])
+            # If we've reached max depth, we set the score to a very
+            # low value, so it doesn't get re-queried.
+            if state.rq_counts[to_requery] >= max_depth:
+                state.set_score(to_requery, -1e6)
+            else:
+                state.set_score(to_requery, cache.rejection_score(
+                    replacement['output_idx'], scoring_method))
+
+        elif "combined" in replacement_method:
+            max_depth = int(replacement_method.split("_")[-1])
+            # in combined replacement, we need to update everything.
+            state.requery(to_requery)
+
+            # Update the probabilities.
+            draw['probabilities'][to_requery] = \
+                    draw['probabilities'][to_requery] *\
+                    replacement['probabilities']
+
+            # Normalize
+            draw['probabilities'][to_requery] = draw['probabilities']\
+                    [to_requery]/draw['probabilities'][to_requery].sum()
+
+            # low value, so it doesn't get re-queried.
+            if state.rq_counts[to_requery] >= max_depth:
+                state.set_score(to_requery, -1e6)
+            else:
+                # Update the rejection score for the next query.
+                state.set_score(
+                    to_requery, calculation_utils.calc_rejection_score(
+                        draw['probabilities'][to_requery],
+                        scoring_method))
+
+            # Figure out whether or not it's correct, using the
+            # precomputed IoUs of the detections with the ground truth.
+            ious = replacement['ious']
+
+            # If correct, set as correct. If not, either leave as
+            # missed detection, or set to undefined.
+            if ious[draw['probabilities'][to_requery].argmax()] >= 0.5:
+                state.set_failure_mode(
+                    to_requery, failure_ids['correct'])
+            elif draw['failure_modes'][to_requery] !=\
+                    failure_ids['missed_detection']:
+                state.set_failure_mode(
+                    to_requery, failure_ids['undefined'])
+        elif "smart" in replacement_method:
+            max_depth = int(replacement_method.split("_")[-1])
+            # Smart replacement is pretty straightforward.
+            # Updates one at a time.
+            state.requery(to_requery)
+
+            # Get the previous and new scores.
+            score_previous = state.get_score(to_requery)
+            score_new = cache.rejection_score(
+                replacement['output_idx'], scoring_method)
+
+            # Set the failure mode based on which score is lower.
+            if score_new < score_previous:
+                state.set_failure_mode(
+                    to_requery, replacement['outputs_failure_mode'])
+            # And then update the score so that it doesn't get
+            # re-re-queried.
+            if state.rq_counts[to_requery] >= max_depth:
+                state.set_score(to_requery, -1e6)
+            else:
+                state.set_score(to_requery, cache.rejection_score(
+                    replacement['output_idx'], scoring_method))
+
+        elif "ensemble_mean" in replacement_method:
+            # For ensemble mean, we use the name of the replacement
+            # method to set the ensemble size parameter.
+            # i.e., how many seeds we ensemble.
+            ensemble_size = int(replacement_method.split("_")[-1])
+
+            # We have to update the re-query count by more than one.
+            # The original refexp counts as part of the ensemble.
+            # So, i.e., for an ensemble of size 3, we would have the
+            # original and two re-queries. meaning RQ count goes
+            # up by 2.
+            state.requery(to_requery, ensemble_size)
+
+            # Get every ensembled solution
+            solutions = []
+            for i in range(ensemble_size):
+                solutions.append(cache.get_re_by_target(
+                    draw['target_ids'][to_requery], rng))
+
+            # Find the mean of all the queries.
+            new_dist = draw['probabilities'][to_requery].copy()
+            solution = None # Make sure solution has been defined.
+            for solution in solutions:
+                new_dist += solution['probabilities']
+            new_dist = new_dist/(ensemble_size+1)
+
+            # Figure out whether or not the detection occurred,
+            # using the precomputed IoUs.
+            ious = solution['ious']
+
+            # If the IoU is greater than 0.5, set to correct.
+            if ious[new_dist.argmax()] >= 0.5:
+                state.set_failure_mode(
+                    to_requery, failure_ids['correct'])
+            elif draw['failure_modes'][to_requery] !=\
+                    failure_ids['missed_detection']:
+                # if it's not, either leave it as "missed detection", or
+                # use unknown. This is relevant for RMAE.
+                state.set_failure_mode(
+                    to_requery, failure_ids['undefined'])
+            # And set score to a very low value so it isn't requeried.
+            state.set_score(to_requery, -1e6)
+        elif "ensemble_consensus" in replacement_method:
+            # Consensus follows much the same method as mean, but,
+            # obviously, we select via mode instead of argmax mean.
+
+            # So ensemble size is from the method string, and requery
+            # count updates appropriately.
+            ensemble_size = int(replacement_method.split("_")[-1])
+            state.requery(to_requery, ensemble_size)
+
+            # Pull n solutions
+            solutions = []
+            for i in range(ensemble_size):
+                solutions.append(cache.get_re_by_target(
+                    draw['target_ids'][to_requery], rng))
+            # Choices are the indices of selected values.
+            choices = [draw['probabilities'][to_requery].argmax()]
+            solution = None # Make sure solution has been defined.
+            for solution in solutions:
+                choices.append(solution['probabilities'].argmax())
+
+            # The precomputed IoUs of detected bounding boxes.
+            ious = solution['ious']
+
+            # Select the mode and figure out if it's correct.
+            freqs = groupby(Counter(choices).most_common(), lambda x:x[1])
+            mode_list = [val for val, count in next(freqs)[1]]
+            if ious[mode_list[rng.integers(len(mode_list))]] >= 0.5:
+                state.set_failure_mode(
+                    to_requery, failure_ids['correct'])
+            elif draw['failure_modes'][to_requery] !=\
+                    failure_ids['missed_detection']:
+                state.set_failure_mode(
+                    to_requery, failure_ids['undefined'])
+            state.set_score(to_requery, -1e6)
+
+    # Since the ensemble methods don't always divide evenly,
+    # add a check to make sure our coverage isn't less than zero.
+    if state.num_requeries < errors.shape[1]\
+       or "ensemble" not in replacement_method:
+        state.record(errors, rmaes, 0)
+
+    return errors[0], rmaes[0]
+
+def init_worker(caches):
+    """Makes the output caches available to a pool worker.
+
+    args:
+        caches: dict from (model, distribution, split) to OutputCache.
+    """
+    worker_caches.update(caches)
+
+def run_trial_in_worker(trial):
+    """Runs a single trial in a pool worker.
+
+    args:
+        trial: a tuple of cache key, initial draw output rows, SeedSequence,
+            scoring method, replacement method, failure mode IDs, and whether
+            to run combined trials in the compiled kernel.
+
+    returns:
+        the error and the rmae at every number of re-queries.
+    """
+    cache_key, output_idx, seed_sequence, scoring_method,\
+            replacement_method, failure_ids, jit = trial
+    if jit and combined_kernel.supports_kernel(replacement_method):
+        # One uniform per re-query, as run_trial would draw them.
+        rng = np.random.default_rng(seed_sequence)
+        return combined_kernel.run_trial_combined(
+            worker_caches[cache_key], output_idx,
+            rng.random(len(output_idx)), scoring_method, replacement_method,
+            failure_ids)
+    return run_trial(worker_caches[cache_key], output_idx, scoring_method,
+                     replacement_method, failure_ids,
+                     np.random.default_rng(seed_sequence))
+
+def run_trials(caches, models, distribution_id, split, scoring_method,
+               replacement_method, failure_ids, num_trials=100, seed=0,
+               group="", pool=None, batched=False, jit=False,
+               checkpoint=None):
+    """Runs every trial for one group of models, distribution, and split.
+
+    Each trial picks a random model from the group. The seed streams depend
+    on the seed, split, group, and distribution, but not the method, so every
+    method sees the same initial draws.
+
+    args:
+        caches: dict from (model, distribution, split) to OutputCache. Must
+            hold every model in models.
+        models: the model IDs in the group.
+        distribution_id: the distribution ID.
+        split: val, testA, or testB.
+        scoring_method: the scoring function applied to the distribution.
+        replacement_method: e.g. naive_3, combined_3, ensemble_mean_3.
+        failure_ids: dict from failure mode name to database ID.
+        num_trials: how many trials to run.
+        seed: the base seed.
+        group: the name of the group, e.g. UNITER-gt.
+        pool: a multiprocessing Pool, initialized with init_worker and the
+            same caches. Trials run in this process if None.
+        batched: if True, naive and smart trials that share a model are run
+            together in this process by batched_simulation. Other methods
+            ignore it.
+        jit: if True, combined trials are run in the compiled kernel of
+            combined_kernel. Other methods ignore it.
+        checkpoint: a CheckpointStore. If given, trials already in it are
+            not run again, and every trial is written to it as it finishes.
+
+    returns:
+        (num_trials, targets+1) arrays of errors and rmaes, or None if there
+        were no outputs.
+    """
+    # One seed stream for the setup, and one for every trial.
+    root_seed = np.random.SeedSequence(
+        [seed, zlib.crc32(f"{split}-{group}-{distribution_id}".encode())])
+    setup_seed, *trial_seeds = root_seed.spawn(num_trials+1)
+    setup_rng = np.random.default_rng(setup_seed)
+
+    # Pick a random model for every trial, then select one output per
+    # target for all of the trials that share a model in one go.
+    trial_keys = [(models[i], distribution_id, split) for i in
+                  setup_rng.integers(len(models), size=num_trials)]
+    trial_outputs = [None]*num_trials
+    for cache_key in sorted(set(trial_keys)):
+        model_runs = [run for run in range(num_trials)
+                      if trial_keys[run] == cache_key]
+        model_outputs = caches[cache_key].sample_outputs(
+            setup_rng, num_trials=len(model_runs))
+        for run, output_idx in zip(model_runs, model_outputs):
+            trial_outputs[run] = output_idx
+
+    # If there is no response, skip that trial and every one after it.
+    num_runs = num_trials
+    for run in range(num_trials):
+        if caches[trial_keys[run]].num_targets == 0:
+            num_runs = run
+            break
+    if num_runs == 0:
+        return None
+
+    # Trials that finished before a restart don't need to run again.
+    checkpoint_key = (split, group, distribution_id, scoring_method,
+                      replacement_method)
+    finished = {}
+    if checkpoint is not None:
+        finished = {run: result for run, result in
+                    checkpoint.completed_trials(*checkpoint_key).items()
+                    if run < num_runs}
+    pending = [run for run in range(num_runs) if run not in finished]
+
+    if batched and batched_simulation.supports_batched(replacement_method):
+        if len(pending) > 0:
+            errors, rmaes = run_trials_batched(
+                caches, [trial_keys[run] for run in pending],
+                [trial_outputs[run] for run in pending],
+                [trial_seeds[run] for run in pending], scoring_method,
+                replacement_method, failure_ids, len(pending))
+            for i, run in enumerate(pending):
+                finished[run] = (errors[i], rmaes[i])
+                if checkpoint is not None:
+                    checkpoint.add_trial(*checkpoint_key, run, errors[i],
+                                         rmaes[i])
+    else:
+        trials = [(trial_keys[run], trial_outputs[run], trial_seeds[run],
+                   scoring_method, replacement_method, failure_ids, jit)
+                  for run in pending]
+        if pool is not None:
+            results = pool.imap(run_trial_in_worker, trials)
+        else:
+            init_worker(caches)
+            results = map(run_trial_in_worker, trials)
+        # Results come back in order, as each trial finishes.
+        for run, (errors, rmaes) in zip(pending, results):
+            finished[run] = (errors, rmaes)
+            if checkpoint is not None:
+                checkpoint.add_trial(*checkpoint_key, run, errors, rmaes)
+
+    # This tracks errors across all runs and all coverages.
+    errors, rmaes = finished[0]
+    all_run_errors = np.zeros((num_trials, errors.shape[0]))
+    all_run_rmaes = np.zeros((num_trials, rmaes.shape[0]))
+    for run, (errors, rmaes) in finished.items():
+        all_run_errors[run] = errors
+        all_run_rmaes[run] = rmaes
+
+    return all_run_errors, all_run_rmaes
+
+def run_trials_batched(caches, trial_keys, trial_outputs, trial_seeds,
+                       scoring_method, replacement_method, failure_ids,
+                       num_trials):
+    """Runs naive or smart trials together, one batch per model.
+
+    Each trial draws the uniforms for its re-queries from its own seed
+    stream, exactly as run_trial does, so the results are the same.
+
+    args:
+        caches: dict from (model, distribution, split) to OutputCache.
+        trial_keys: the cache key of every trial to run.
+        trial_outputs: the initial draw output rows of every trial to run.
+        trial_seeds: the SeedSequence of every trial to run.
+        scoring_method: the scoring function applied to the distribution.
+        replacement_method: naive_[DDC] or smart_[DDC].
+        failure_ids: dict from failure mode name to database ID.
+        num_trials: the number of rows to return. Rows past the trials run
+            are left at zero.
+
+    returns:
+        (num_trials, targets+1) arrays of errors and rmaes.
+    """
+    all_run_errors = None
+    all_run_rmaes = None
+    for cache_key in sorted(set(trial_keys)):
+        model_runs = [run for run in range(len(trial_keys))
+                      if trial_keys[run] == cache_key]
+        num_targets = caches[cache_key].num_targets
+        uniforms = np.stack(
+            [np.random.default_rng(trial_seeds[run]).random(num_targets)
+             for run in model_runs])
+        errors, rmaes = batched_simulation.run_trials_batched(
+            caches[cache_key], np.stack([trial_outputs[run] for run in
+                                         model_runs]),
+            uniforms, scoring_method, replacement_method, failure_ids)
+
+        if all_run_errors is None:
+            all_run_errors = np.zeros((num_trials, errors.shape[1]))
+            all_run_rmaes = np.zeros((num_trials, rmaes.shape[1]))
+        all_run_errors[model_runs] = errors
+        all_run_rmaes[model_runs] = rmaes
+
+    return all_run_errors, all_run_rmaes
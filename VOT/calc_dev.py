@@ -1,5 +1,18 @@
-"""Calculates the DEV metric for a method."""
+"""Calculates the DEV metric for a method.
+
+With --exact, DEV and Acc@1 are also calculated exactly, as the expectation
+and standard error of a replicate that takes an independent, uniformly drawn
+run for every depth constraint. The expectation is the same grand mean as the
+per-run estimate, but the per-run standard error pairs run r across every
+depth constraint, so the ratio of the two standard errors is printed: above
+1, runs are positively correlated across depth constraints.
+
+Typical usage:
+    python calc_dev.py
+    python calc_dev.py --exact
+"""
 import os
+import sys
 import pickle
 import numpy as np
 import matplotlib.pyplot as plt
@@ -10,6 +23,32 @@ plt.rc('xtick',labelsize=18)
 plt.rc('ytick',labelsize=18)
 plt.rc('legend',fontsize=18)
 
+exact = "--exact" in sys.argv
+
+def exact_dev(errors):
+    """Calculates DEV and Acc@1 exactly.
+
+    A replicate is the mean, over depth constraints, of one uniformly drawn
+    run per depth constraint. Its expectation is the mean over depth
+    constraints of the mean over runs, and its variance is the sum over
+    depth constraints of the variance over runs, over depth constraints
+    squared.
+
+    args:
+        errors: a (depth constraints, DRs, runs) array of errors.
+
+    returns:
+        DEV, its standard error, Acc@1, and its standard error. Standard
+        errors are for the mean of as many replicates as there are runs.
+    """
+    num_runs = errors.shape[2]
+    results = []
+    for run_values in (errors.mean(axis=1), errors[:, -1, :]):
+        results.append(run_values.mean(axis=1).mean())
+        results.append(np.sqrt(run_values.var(axis=1).sum())/
+                       run_values.shape[0]/np.sqrt(num_runs))
+    return results
+
 # Get all of the stochastic runs generated by perform_runs.py
 files = os.listdir("better_smear")
 
@@ -69,6 +108,21 @@ for method in run_dict:
     # print results
     print(f"{method}-DEV: {au_metric}+-{au_stderr}. Acc@1: {acc_1}+-{acc_1_stderr}")
 
+    if exact:
+        exact_au, exact_au_stderr, exact_acc_1, exact_acc_1_stderr = \
+                exact_dev(method_where_not_zero)
+        print(f"{method}-DEV (exact): {exact_au}+-{exact_au_stderr}. "\
+              f"Acc@1 (exact): {exact_acc_1}+-{exact_acc_1_stderr}")
+        # The means are algebraically the same as the estimates above, so
+        # only the standard errors can differ. The per-run ones keep each
+        # run's depth constraints together, the exact ones draw them
+        # independently.
+        for name, stderr, exact_stderr in (
+                ("DEV", au_stderr, exact_au_stderr),
+                ("Acc@1", acc_1_stderr, exact_acc_1_stderr)):
+            print(f"{method}-{name} stderr per-run/exact: "\
+                  f"{stderr/max(exact_stderr, 1e-12)}")
+
     # Now calc and plot the marginals
     rqr_marginal = method_where_not_zero.mean(axis=0)
     rqr_marginal_stderr = rqr_marginal.std(axis=1)/np.sqrt(